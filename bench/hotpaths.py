@@ -0,0 +1,202 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import statistics
+import tempfile
+import time
+
+import discord
+from discord.ext import commands
+
+from bench.stubs import SilentSource, StubContext, StubGuild, StubMessage, build_tree
+from utils.cleanup import CleanupScheduler
+from utils.decoders import Admission, DecoderPool
+from utils.metrics import Metrics
+from utils.outbound import Outbox
+from utils.search import SoundSearch
+from utils.sound_index import SoundIndex
+from utils.transcode import TranscodeCache
+from utils.usage import UsageStore
+from utils.voice_pool import VoicePool
+
+# Library sizes benchmarked by default
+SIZES = (10, 1000, 50000, 100000)
+# Cogs the benchmark loads
+COGS = ("help", "list", "voice")
+# Default report file, in a directory git ignores
+OUTPUT = os.path.join("bench", "results", "hotpaths.json")
+
+
+class BenchBot(commands.Bot):
+    """
+    Bot with the real cogs and sound index but stubbed Discord I/O
+    """
+    def __init__(self, root: str, logger) -> None:
+        super().__init__(command_prefix="<AudioBot> ", intents=discord.Intents.none(), help_command=None)
+        self.logger = logger
+        self.ready = True
+        self.data_dir = root
+        # No rate limit, so sends don't skew timings
+        self.outbox = Outbox(logger, rate=10 ** 9, per=1.0, burst=10 ** 9)
+        self.cleanup = CleanupScheduler(logger)
+        self.metrics = Metrics(logger)
+        self.voice_pool = VoicePool(logger, idle_timeout=0)
+        # Empty caches and play history next to the library, no warm decoders to spawn
+        cache = os.path.join(os.path.dirname(root), "cache")
+        self.transcodes = TranscodeCache(os.path.join(cache, "opus"), logger)
+        self.decoders = DecoderPool(Admission(8), logger, warm=0)
+        self.usage = UsageStore(os.path.join(cache, "usage.db"), logger)
+        started = time.perf_counter()
+        self.sounds = SoundIndex(root, logger)
+        self.sounds.build()
+        self.search = SoundSearch(self.sounds)
+        self.search.build()
+        self.sounds.add_listener(self.search.refresh)
+        # Seconds spent indexing the library
+        self.index_seconds = time.perf_counter() - started
+
+
+def summarize(timings: list) -> dict:
+    """
+    Gets mean and percentiles of timings in milliseconds
+    """
+    timings = sorted(timings)
+    return {
+        "runs": len(timings),
+        "mean_ms": statistics.fmean(timings),
+        "p50_ms": timings[len(timings) // 2],
+        "p99_ms": timings[max(0, int(len(timings) * 0.99) - 1)],
+        "max_ms": timings[-1],
+    }
+
+
+async def settle() -> None:
+    """
+    Lets background tasks (player, outbox) run between timed calls
+    """
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+async def timed(call, runs: int, before=None) -> dict:
+    """
+    Times an async call, running before (untimed) ahead of each run
+    """
+    timings = []
+    for i in range(runs):
+        if before is not None:
+            before(i)
+        started = time.perf_counter()
+        await call(i)
+        timings.append((time.perf_counter() - started) * 1000)
+        await settle()
+    return summarize(timings)
+
+
+async def bench_library(size: int, root: str, runs: int, logger) -> dict:
+    """
+    Runs every hot path against one synthetic library
+    """
+    dirs = build_tree(root, size)
+    bot = BenchBot(root, logger)
+    for cog in COGS:
+        await bot.load_extension(f"lib.cogs.{cog}")
+    voice, listing, help_cog = bot.get_cog("Voice"), bot.get_cog("List"), bot.get_cog("Help")
+    # No FFmpeg or transcodes, every sound ends right away
+    voice.make_source = lambda path, pcm=False, seek=None, opus=False: SilentSource()
+    voice.needs_decoder = lambda path, pcm, seek=None: False
+
+    guild = StubGuild()
+    text, voice_channel = guild.channel("general"), guild.channel("voice")
+    context = lambda i: StubContext(bot, guild, text, voice_channel)
+    results = {"sounds": bot.sounds.sound_count(), "index_build_ms": bot.index_seconds * 1000}
+
+    # Name resolution: directory + track, top-level file, misspelled name
+    results["play_track"] = await timed(lambda i: voice.play(context(i), f"Dir{i % dirs + 1}", 1), runs)
+    results["play_file"] = await timed(lambda i: voice.play(context(i), "Sound_1"), runs)
+    results["play_fuzzy"] = await timed(lambda i: voice.play(context(i), f"Dirr{i % dirs + 1}", 1), runs)
+
+    # One fuzzy lookup alone, rotating a misspelled track, a misspelled file and a name close to nothing
+    queries = lambda i: (f"Dri{i % dirs + 1}_{i % 7 + 1}x", f"Sund_{i % 9 + 1}", "Henchmen")[i % 3]
+
+    async def fuzzy(i):
+        bot.search.best(queries(i))
+    results["fuzzy_best"] = await timed(fuzzy, runs)
+
+    # Listing, rendered from scratch and from the cache
+    everything = list(bot.sounds.directories())
+    results["list_cold"] = await timed(
+        lambda i: listing.list_sounds(context(i), "expand"), max(1, min(runs, 20)),
+        before=lambda i: listing.tree.invalidate(everything),
+    )
+    results["list_warm"] = await timed(lambda i: listing.list_sounds(context(i), "expand"), runs)
+
+    # Help rendering
+    results["help"] = await timed(lambda i: help_cog.custom_help(context(i)), runs)
+    results["help_command"] = await timed(lambda i: help_cog.custom_help(context(i), command_name="play"), runs)
+
+    # Cleanup of 1000 messages spread over 10 channels
+    channels = [guild.channel(f"text{n}") for n in range(10)]
+    schedule = lambda i: bot.cleanup.schedule(*(StubMessage(channels[n % 10]) for n in range(1000)), wait=15)
+    results["cleanup_1000"] = await timed(lambda i: bot.cleanup.drain(), max(1, min(runs, 20)), before=schedule)
+
+    # Sounds that reached the voice client, a sanity check for the play paths
+    results["played"] = guild.voice_client.played if guild.voice_client is not None else 0
+    for player in voice.players.values():
+        player.close()
+    bot.decoders.close()
+    await bot.usage.close()
+    return results
+
+
+async def run(sizes: list, runs: int, workdir: str) -> dict:
+    logger = logging.getLogger("AudioBot.bench")
+    # Errors mean a timed path failed, so they are shown
+    logger.setLevel(logging.ERROR)
+    results = {}
+    for size in sizes:
+        root = os.path.join(workdir, str(size), "data", "audio", "sounds")
+        started = time.perf_counter()
+        results[str(size)] = await bench_library(size, root, runs, logger)
+        print(f"{size:>7} sounds done in {time.perf_counter() - started:.1f}s")
+    return results
+
+
+def main() -> None:
+    """
+    Benchmarks the command hot paths and writes the timings as JSON
+    """
+    parser = argparse.ArgumentParser(description="Benchmark play, list, help and cleanup on synthetic libraries.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(SIZES), help="sounds per synthetic library")
+    parser.add_argument("--runs", type=int, default=200, help="timed runs per hot path")
+    parser.add_argument("--label", default="dev", help="version label stored with the results")
+    parser.add_argument("--output", default=OUTPUT, help="JSON file to write")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="audiobot-bench-") as workdir:
+        results = asyncio.run(run(args.sizes, args.runs, workdir))
+
+    report = {
+        "label": args.label,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "discord.py": discord.__version__,
+        "results": results,
+    }
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    print(f"{'sounds':>7} {'path':<14} {'mean ms':>9} {'p99 ms':>9}")
+    for size, paths in results.items():
+        for name, result in paths.items():
+            if isinstance(result, dict):
+                print(f"{size:>7} {name:<14} {result['mean_ms']:>9.3f} {result['p99_ms']:>9.3f}")
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
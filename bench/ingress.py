@@ -0,0 +1,188 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import time
+import types
+
+import discord
+from discord.ext import commands
+from discord.state import ConnectionState
+
+from bench.stubs import guild_payload, member_payload, message_payload
+from utils import ingress
+
+# Id of the bot user in every run
+BOT_ID = 1
+# Members of each synthetic guild, of which a few sit in voice
+MEMBERS = 5000
+VOICE_MEMBERS = 5
+# Share of messages that are commands, the rest is chatter
+COMMAND_RATIO = 0.01
+# Default report file, in a directory git ignores
+OUTPUT = os.path.join("bench", "results", "ingress.json")
+
+
+def connection(lean: bool) -> ConnectionState:
+    """
+    Gets the gateway state the bot ran with before (lean False) or runs with now (lean True)
+    """
+    if lean:
+        intents, flags = ingress.intents(), ingress.member_cache_flags()
+        max_messages, chunk = 100, False
+    else:
+        # Default intents plus members and message content, every member cached and chunked at startup
+        intents = discord.Intents.default()
+        intents.members = True
+        intents.message_content = True
+        flags, max_messages, chunk = discord.MemberCacheFlags.from_intents(intents), 1000, True
+    state = ConnectionState(
+        dispatch=lambda *args, **kwargs: None, handlers={}, hooks={}, http=None, intents=intents,
+        member_cache_flags=flags, max_messages=max_messages, chunk_guilds_at_startup=chunk,
+    )
+    state.user = types.SimpleNamespace(id=BOT_ID)
+    return state
+
+
+def rss() -> int:
+    """
+    Gets the resident set size of this process in bytes
+    """
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+
+def fill(lean: bool, guilds: int, messages: int) -> dict:
+    """
+    Feeds guilds, member chunks and messages through the gateway state and measures what stays in memory
+    """
+    state = connection(lean)
+    started = rss()
+    next_id = 10 ** 6
+    for n in range(guilds):
+        guild_id, text_id, voice_id = next_id, next_id + 1, next_id + 2
+        members = range(next_id + 3, next_id + 3 + MEMBERS)
+        next_id += 3 + MEMBERS
+        guild = state._add_guild_from_data(guild_payload(guild_id, text_id, voice_id, members, members[:VOICE_MEMBERS]))
+        if state._chunk_guilds:
+            # What the startup chunk requests put into the cache
+            for user_id in members:
+                guild._add_member(discord.Member(data=member_payload(user_id), guild=guild, state=state))
+        for m in range(messages // guilds):
+            state.parse_message_create(message_payload(next_id + m, guild_id, text_id, members[m % MEMBERS], "hello"))
+        next_id += messages // guilds
+    return {
+        "rss_mb": (rss() - started) / 2 ** 20,
+        "members": sum(len(guild._members) for guild in state.guilds),
+        "users": len(state._users),
+        "messages": len(state._messages) if state._messages is not None else 0,
+    }
+
+
+def _fill(connection_end, lean: bool, guilds: int, messages: int) -> None:
+    connection_end.send(fill(lean, guilds, messages))
+
+
+def measure_memory(lean: bool, guilds: int, messages: int) -> dict:
+    """
+    Runs fill in a fresh process so both configurations start from the same heap
+    """
+    context = multiprocessing.get_context("spawn")
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=_fill, args=(sender, lean, guilds, messages))
+    process.start()
+    result = receiver.recv()
+    process.join()
+    return result
+
+
+async def measure_messages(lean: bool, count: int) -> dict:
+    """
+    Times process_commands up to the context for a stream of mostly chatter, with or without the pre-filter
+    """
+    command_filter = ingress.CommandFilter()
+    command_filter.bind(BOT_ID)
+    if lean:
+        prefix = lambda bot, message: command_filter.prefixes
+    else:
+        prefix = commands.when_mentioned_or(ingress.PREFIX)
+    bot = commands.Bot(command_prefix=prefix, intents=discord.Intents.none(), help_command=None)
+    bot._connection.user = types.SimpleNamespace(id=BOT_ID)
+
+    async def play(ctx, *args) -> None:
+        pass
+    bot.add_command(commands.Command(play, name="play"))
+
+    # Real messages, so get_context does the work it does live
+    state = connection(lean=True)
+    guild_id, text_id, voice_id = 10 ** 6, 10 ** 6 + 1, 10 ** 6 + 2
+    guild = state._add_guild_from_data(guild_payload(guild_id, text_id, voice_id, [], []))
+    channel = guild.get_channel(text_id)
+    every = max(1, int(1 / COMMAND_RATIO))
+    stream = []
+    for n in range(count):
+        content = f"{ingress.PREFIX}play Dir{n % 10} 1" if n % every == 0 else f"just chatting about sound {n}"
+        payload = message_payload(10 ** 7 + n, guild_id, text_id, 10 ** 6 + 3 + n % 100, content)
+        # Some other bots talk too
+        payload["author"]["bot"] = n % 7 == 3
+        stream.append(discord.Message(state=state, channel=channel, data=payload))
+
+    contexts = 0
+    started = time.perf_counter()
+    for message in stream:
+        if lean:
+            if not command_filter.accepts(message):
+                continue
+        elif message.author.bot:
+            continue
+        ctx = await bot.get_context(message)
+        contexts += ctx.valid
+    elapsed = time.perf_counter() - started
+    return {"messages": count, "commands": contexts, "us_per_message": elapsed / count * 10 ** 6}
+
+
+def main() -> None:
+    """
+    Compares per-message cost and gateway cache memory before and after the lean ingress and writes JSON
+    """
+    parser = argparse.ArgumentParser(description="Benchmark message filtering and gateway cache memory.")
+    parser.add_argument("--messages", type=int, default=100000, help="messages pushed through the command check")
+    parser.add_argument("--guilds", type=int, default=20, help="synthetic guilds of 5000 members each")
+    parser.add_argument("--cached", type=int, default=20000, help="messages received across the guilds")
+    parser.add_argument("--label", default="dev", help="version label stored with the results")
+    parser.add_argument("--output", default=OUTPUT, help="JSON file to write")
+    args = parser.parse_args()
+
+    results = {}
+    for name, lean in (("before", False), ("after", True)):
+        results[name] = {
+            "per_message": asyncio.run(measure_messages(lean, args.messages)),
+            "memory": measure_memory(lean, args.guilds, args.cached),
+        }
+
+    report = {
+        "label": args.label,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "discord.py": discord.__version__,
+        "results": results,
+    }
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    print(f"{'config':<7} {'us/msg':>8} {'RSS MB':>8} {'members':>8} {'users':>8} {'messages':>9}")
+    for name, result in results.items():
+        memory = result["memory"]
+        print(
+            f"{name:<7} {result['per_message']['us_per_message']:>8.2f} {memory['rss_mb']:>8.1f} "
+            f"{memory['members']:>8} {memory['users']:>8} {memory['messages']:>9}"
+        )
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
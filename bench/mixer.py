@@ -0,0 +1,131 @@
+import argparse
+import statistics
+import threading
+import time
+
+import discord
+import numpy as np
+
+from utils.mixer import PCM_FRAME_SIZE, MixerSource
+from utils.playback import PrimedSource
+
+# Time budget of one 20 ms voice frame
+FRAME_BUDGET_MS = 20.0
+
+
+class NoiseSource(discord.AudioSource):
+    """
+    Endless PCM source replaying one random frame
+    """
+    def __init__(self, seed: int) -> None:
+        rng = np.random.default_rng(seed)
+        self._frame = rng.integers(-20000, 20000, PCM_FRAME_SIZE // 2, dtype=np.int16).tobytes()
+
+    def read(self) -> bytes:
+        return self._frame
+
+
+class SlowStartSource(NoiseSource):
+    """
+    Noise whose first read blocks, like a decoder waiting for a process slot and spawning FFmpeg
+    """
+    def __init__(self, seed: int, delay: float) -> None:
+        super().__init__(seed)
+        self.delay = delay
+
+    def read(self) -> bytes:
+        if self.delay:
+            time.sleep(self.delay)
+            self.delay = 0
+        return self._frame
+
+
+def summarize(timings: list) -> dict:
+    """
+    Gets mean, p99 and max of timings in milliseconds
+    """
+    timings = sorted(timings)
+    return {
+        "mean_ms": statistics.fmean(timings),
+        "p99_ms": timings[max(0, int(len(timings) * 0.99) - 1)],
+        "max_ms": timings[-1],
+    }
+
+
+def bench_slow_start(streams: int, frames: int, delay: float) -> dict:
+    """
+    Times MixerSource.read while one more stream joins with a slow first read, primed in another thread
+    as the player does
+    """
+    mixer = MixerSource()
+    for i in range(streams):
+        mixer.add(NoiseSource(i))
+    slow = PrimedSource(SlowStartSource(streams, delay))
+    mixer.add(slow)
+    threading.Thread(target=slow.prime, daemon=True).start()
+    timings, joined = [], None
+    for frame in range(frames):
+        start = time.perf_counter()
+        mixer.read()
+        timings.append((time.perf_counter() - start) * 1000)
+        if joined is None and slow.ready():
+            joined = frame
+        # Pace reads like the voice client so the slow start overlaps them
+        time.sleep(max(0.0, 0.002 - (time.perf_counter() - start)))
+    result = summarize(timings)
+    result.update({"streams": streams, "delay_ms": delay * 1000, "joined_frame": joined})
+    return result
+
+
+def bench_mixer(streams: int, frames: int) -> dict:
+    """
+    Times MixerSource.read with a number of active streams
+    """
+    mixer = MixerSource()
+    for i in range(streams):
+        # Mix half the streams below unity gain so both code paths run
+        mixer.add(NoiseSource(i), gain=1.0 if i % 2 == 0 else 0.5)
+    # Warm up
+    for _ in range(50):
+        mixer.read()
+    timings = []
+    for _ in range(frames):
+        start = time.perf_counter()
+        mixer.read()
+        timings.append((time.perf_counter() - start) * 1000)
+    result = summarize(timings)
+    result["streams"] = streams
+    return result
+
+
+def main() -> None:
+    """
+    Prints per-frame mix cost against the 20 ms frame budget
+    """
+    parser = argparse.ArgumentParser(description="Micro-benchmark of the multi-stream mixer.")
+    parser.add_argument("--frames", type=int, default=2000, help="frames to mix per run")
+    parser.add_argument("--streams", type=int, nargs="+", default=[1, 4, 8, 16, 32, 64], help="stream counts to test")
+    parser.add_argument("--slow-start", type=float, default=0.5, help="seconds the first read of the slow stream blocks")
+    args = parser.parse_args()
+
+    print(f"{'streams':>8} {'mean ms':>9} {'p99 ms':>9} {'max ms':>9} {'budget':>8}")
+    for streams in args.streams:
+        result = bench_mixer(streams, args.frames)
+        share = result["p99_ms"] / FRAME_BUDGET_MS * 100
+        print(f"{streams:>8} {result['mean_ms']:>9.4f} {result['p99_ms']:>9.4f} {result['max_ms']:>9.4f} {share:>7.2f}%")
+
+    # A stream that starts slowly must not push the others past the budget
+    print(f"\nOne more stream whose first read blocks {args.slow_start * 1000:.0f} ms:")
+    print(f"{'streams':>8} {'mean ms':>9} {'p99 ms':>9} {'max ms':>9} {'joined':>8}")
+    for streams in args.streams:
+        result = bench_slow_start(streams, args.frames, args.slow_start)
+        print(
+            f"{streams:>8} {result['mean_ms']:>9.4f} {result['p99_ms']:>9.4f} {result['max_ms']:>9.4f} "
+            f"{result['joined_frame']!s:>8}"
+        )
+        if result["max_ms"] > FRAME_BUDGET_MS:
+            print(f"{'':>8} over the {FRAME_BUDGET_MS:.0f} ms frame budget")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+import itertools
+import os
+import types
+
+import discord
+
+# Ids handed out to stub messages, channels and guilds
+_ids = itertools.count(1)
+
+
+class StubMessage(object):
+    """
+    Message that records its deletion instead of calling Discord
+    """
+    def __init__(self, channel, content: str = "", author=None) -> None:
+        self.id = next(_ids)
+        self.channel = channel
+        self.guild = channel.guild
+        self.content = content
+        self.author = author
+        self.created_at = discord.utils.utcnow()
+        self.deleted = False
+
+    async def delete(self) -> None:
+        self.deleted = True
+
+
+class StubChannel(object):
+    """
+    Text and voice channel in one, sends and connects without network
+    """
+    def __init__(self, guild, name: str = "general") -> None:
+        self.id = next(_ids)
+        self.guild = guild
+        self.name = name
+        self.sent = 0
+        self.bulk_deletes = 0
+
+    async def send(self, content: str, view=None) -> StubMessage:
+        self.sent += 1
+        return StubMessage(self, content)
+
+    async def delete_messages(self, messages: list) -> None:
+        self.bulk_deletes += 1
+        for message in messages:
+            message.deleted = True
+
+    async def connect(self, timeout: float = 30.0, reconnect: bool = True):
+        self.guild.voice_client = StubVoiceClient(self)
+        return self.guild.voice_client
+
+
+class StubVoiceClient(object):
+    """
+    Voice client that finishes every source right away
+    """
+    def __init__(self, channel: StubChannel) -> None:
+        self.channel = channel
+        self.guild = channel.guild
+        self.played = 0
+
+    def is_connected(self) -> bool:
+        return True
+
+    def is_playing(self) -> bool:
+        return False
+
+    def play(self, source, after=None) -> None:
+        self.played += 1
+        source.cleanup()
+        if after is not None:
+            after(None)
+
+    def stop(self) -> None:
+        pass
+
+    async def move_to(self, channel, timeout: float = 30.0) -> None:
+        self.channel = channel
+
+    async def disconnect(self, force: bool = False) -> None:
+        self.guild.voice_client = None
+
+
+class StubGuild(object):
+    """
+    Guild where the bot may manage messages
+    """
+    def __init__(self, name: str = "bench") -> None:
+        self.id = next(_ids)
+        self.name = name
+        self.voice_client = None
+        permissions = types.SimpleNamespace(manage_messages=True)
+        self.me = types.SimpleNamespace(id=0, guild_permissions=permissions)
+        self._channels = {}
+
+    def channel(self, name: str) -> StubChannel:
+        channel = StubChannel(self, name)
+        self._channels[channel.id] = channel
+        return channel
+
+    def get_channel(self, channel_id: int) -> StubChannel:
+        return self._channels.get(channel_id)
+
+
+class StubContext(object):
+    """
+    Command context of a user sitting in a voice channel
+    """
+    def __init__(self, bot, guild: StubGuild, channel: StubChannel, voice_channel: StubChannel) -> None:
+        self.bot = bot
+        self.guild = guild
+        self.channel = channel
+        author = types.SimpleNamespace(id=next(_ids), name="bench", bot=False, voice=types.SimpleNamespace(channel=voice_channel))
+        self.message = StubMessage(channel, author=author)
+
+    @property
+    def voice_client(self):
+        return self.guild.voice_client
+
+
+class SilentSource(discord.AudioSource):
+    """
+    Source that ends immediately, standing in for FFmpeg and the Opus cache
+    """
+    def read(self) -> bytes:
+        return b""
+
+
+def build_tree(root: str, count: int, per_dir: int = 100) -> int:
+    """
+    Creates count empty sounds under root in a Dir/Dir_N.mp3 layout with some nested dirs, returns dirs made
+    """
+    os.makedirs(root, exist_ok=True)
+    # About one percent are top-level files
+    top_files = max(1, count // 100)
+    for n in range(1, top_files + 1):
+        open(os.path.join(root, f"Sound_{n}.mp3"), "w").close()
+    remaining, dirs = count - top_files, 0
+    while remaining > 0:
+        dirs += 1
+        name = f"Dir{dirs}"
+        path = os.path.join(root, name)
+        os.makedirs(path)
+        files = min(per_dir, remaining)
+        # Every fifth dir keeps a quarter of its files in a nested dir
+        nested = files // 4 if dirs % 5 == 0 else 0
+        for n in range(1, files - nested + 1):
+            open(os.path.join(path, f"{name}_{n}.mp3"), "w").close()
+        if nested:
+            sub = os.path.join(path, f"{name}Extra")
+            os.makedirs(sub)
+            for n in range(1, nested + 1):
+                open(os.path.join(sub, f"{name}Extra_{n}.mp3"), "w").close()
+        remaining -= files
+    return dirs
+
+
+# Timestamp of every gateway payload below
+_TIMESTAMP = "2024-01-01T00:00:00+00:00"
+
+
+def user_payload(user_id: int) -> dict:
+    return {"id": str(user_id), "username": f"user{user_id}", "discriminator": "0", "avatar": None, "global_name": None}
+
+
+def member_payload(user_id: int) -> dict:
+    return {"user": user_payload(user_id), "roles": [], "joined_at": _TIMESTAMP, "deaf": False, "mute": False, "flags": 0}
+
+
+def guild_payload(guild_id: int, text_id: int, voice_id: int, members: list, voice_members: list) -> dict:
+    """
+    GUILD_CREATE of a large guild: only the members in voice are sent along, like Discord does
+    """
+    channel = {"position": 0, "permission_overwrites": []}
+    voice_state = {
+        "channel_id": str(voice_id), "session_id": "bench", "deaf": False, "mute": False, "self_deaf": False,
+        "self_mute": False, "self_video": False, "suppress": False, "request_to_speak_timestamp": None,
+    }
+    return {
+        "id": str(guild_id),
+        "name": f"guild{guild_id}",
+        "channels": [
+            dict(channel, id=str(text_id), type=0, name="general"),
+            dict(channel, id=str(voice_id), type=2, name="voice", bitrate=64000, user_limit=0),
+        ],
+        "roles": [{
+            "id": str(guild_id), "name": "@everyone", "permissions": "0", "position": 0, "color": 0,
+            "hoist": False, "managed": False, "mentionable": False,
+        }],
+        "members": [member_payload(user_id) for user_id in voice_members],
+        "voice_states": [dict(voice_state, user_id=str(user_id)) for user_id in voice_members],
+        "member_count": len(members),
+        "large": True,
+    }
+
+
+def message_payload(message_id: int, guild_id: int, channel_id: int, user_id: int, content: str) -> dict:
+    """
+    MESSAGE_CREATE of a member writing in a guild text channel
+    """
+    return {
+        "id": str(message_id), "guild_id": str(guild_id), "channel_id": str(channel_id),
+        "author": user_payload(user_id),
+        "member": {"roles": [], "joined_at": _TIMESTAMP, "deaf": False, "mute": False},
+        "content": content, "timestamp": _TIMESTAMP, "edited_timestamp": None, "tts": False,
+        "mention_everyone": False, "mentions": [], "mention_roles": [], "attachments": [], "embeds": [],
+        "pinned": False, "type": 0,
+    }
@@ -1,18 +1,43 @@
-from asyncio import sleep
+import asyncio
+import os
 from glob import glob
+from time import perf_counter
 
 import coloredlogs
-from discord import Intents, Message
+from discord import Message
+from discord.ext.commands import AutoShardedBot
 from discord.ext.commands import Bot as BotBase
 from discord.ext.commands import Context, when_mentioned_or
 
+from utils.cleanup import CleanupScheduler
+from utils.decoders import Admission, DecoderPool
+from utils.frame_cache import FrameCache
 from utils.funcs import *
+from utils.fingerprint import FINGERPRINT_FILE, Fingerprints, artifact_sizes, dedup_report, format_report
+from utils.loudness import LOUDNESS_FILE, LoudnessStore
+from utils.metrics import Metrics
+from utils.outbound import Outbox
+from utils.packs import PackMounts
+from utils import ingress, logs, settings
+from utils.playlists import PLAYLIST_DIR, PlaylistStore
+from utils.search import SoundSearch
+from utils.seek import FRAME_INDEX_DIR, FrameIndexStore
+from utils.sound_index import SoundIndex, SoundWatcher
+from utils.transcode import CACHE_DIR, TranscodeCache
+from utils.usage import USAGE_DB, UsageStore
+from utils.voice_pool import VoicePool
 
-# Enable intents
-INTENTS = Intents.default()
-INTENTS.messages = True
-INTENTS.message_content = True
-INTENTS.members = True
+# Sharding, set by the cluster launcher: SHARD_COUNT shards in total, SHARD_IDS run by this process
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "0")) or None
+SHARD_IDS = [int(shard_id) for shard_id in os.getenv("SHARD_IDS", "").split(",") if shard_id.strip()] or None
+# SHARDED=1 runs every shard Discord recommends in this process
+SHARDED = SHARD_COUNT is not None or os.getenv("SHARDED", "0") == "1"
+# Cluster this process belongs to, only cluster 0 writes the shared transcode cache
+CLUSTER_ID = int(os.getenv("CLUSTER_ID", "0"))
+ClientBase = AutoShardedBot if SHARDED else BotBase
+
+# Seconds startup waits for the most played sounds to be preloaded
+PRELOAD_TIMEOUT = 10.0
 
 # List of cog names
 COGS = [path.split(convert_path_os("\\"))[-1][:-3] for path in glob(convert_path_os("./lib/cogs/*.py"))]
@@ -20,10 +45,11 @@ COGS = [path.split(convert_path_os("\\"))[-1][:-3] for path in glob(convert_path
 
 def get_prefix(bot: BotBase, message: Message) -> list:
     """
-    Gets command prefix from database
+    Gets the command prefixes, built once per login instead of per message
     """
-    prefix = "<AudioBot> "
-    return when_mentioned_or(prefix)(bot, message)
+    if bot.ingress.prefixes is None:
+        return when_mentioned_or(ingress.PREFIX)(bot, message)
+    return bot.ingress.prefixes
 
 
 class Ready(object):
@@ -35,66 +61,327 @@ class Ready(object):
         self.itr = itr
         # Name of the type: example a list of cogs would be cog
         self.name = name
-        # Create attributes
-        for element in self.itr:
-            setattr(self, element, False)
+        # One event per element, set once it is ready
+        self._events = {element: asyncio.Event() for element in self.itr}
 
     def ready_up(self, element: str) -> None:
-        # Set specific element to true
-        setattr(self, element, True)
+        event = self._events[element]
+        if event.is_set():
+            return
+        # Set specific element to ready
+        event.set()
         # Log readiness
         bot.logger.info(f"{element} {self.name} ready")
 
-    def all_ready(self) -> list:
-        # If all elements in list are true
-        return all([getattr(self, element) for element in self.itr])
+    def all_ready(self) -> bool:
+        # If all elements are ready
+        return all(event.is_set() for event in self._events.values())
+
+    async def wait(self) -> None:
+        """
+        Waits until every element is ready
+        """
+        await asyncio.gather(*(event.wait() for event in self._events.values()))
 
 
-class Bot(BotBase):
+class Bot(ClientBase):
     """
     Bot instance used to interact with client
     """
     def __init__(self: BotBase) -> None:
+        # Startup phase -> perf_counter time it finished
+        self.phases = {"start": perf_counter()}
         # Name of bot
         self.name = 'AudioBot'
         # Bot ready and cogs ready
         self.ready = False
+        # perf_counter time of the last gateway disconnect
+        self.disconnected_at = None
         # Confirmation for cog init
         self.cogs_ready = Ready(COGS, 'cog')
         # Bot logger
         self.logger = load_logger()
+        # Typed settings from config.toml, reloaded when the file changes or on SIGHUP
+        self.settings = settings.loader
+        self.settings.logger = self.logger
+        self.config = self.settings.load()
+        self.settings.add_listener(self.apply_config)
+        # Levels, output format and sampling of the logging pipeline
+        logs.pipeline.configure(self.config)
         # Token used to run bot
         self.TOKEN = load_token(self.logger)
+        # Latency histograms and gauges served on a local Prometheus endpoint, port 0 turns it off
+        self.metrics = Metrics(self.logger)
+        self.metrics_host = self.config.metrics_host
+        self.metrics_port = self.config.metrics_port
+        # Rate limited outbound messages
+        self.outbox = Outbox(self.logger)
+        # Deletes command and status messages in bulk
+        self.cleanup = CleanupScheduler(self.logger)
         # Bot data dir
-        self.data_dir = "data/audio/sounds"
+        self.data_dir = self.config.data_dir
+        # Content hashes that every derived artifact is keyed by, written by the first cluster only
+        self.fingerprints = Fingerprints(FINGERPRINT_FILE, self.logger, readonly=CLUSTER_ID != 0)
+        # Last deduplication report of the library
+        self.dedup = None
+        # Sound library index shared by all cogs, built in setup_hook
+        self.sounds = SoundIndex(self.data_dir, self.logger, fingerprints=self.fingerprints)
+        # Keeps the sound index fresh
+        self.sound_watcher = SoundWatcher(self.sounds)
+        # Sound packs mounted from archives as directories
+        self.packs = PackMounts(self.sounds, self.config.packs_dir)
+        # Prefix and fuzzy name search over the sound index
+        self.search = SoundSearch(self.sounds)
+        self.sounds.add_listener(self.search.refresh)
+        # Saved playlists, played as one gapless sequence
+        self.playlists = PlaylistStore(PLAYLIST_DIR, self.logger)
+        # MP3 frame offsets for starting sounds part way through
+        self.frame_indexes = FrameIndexStore(FRAME_INDEX_DIR, self.logger)
+        # Loudness measurements used to normalize playback
+        self.loudness = LoudnessStore(LOUDNESS_FILE, self.logger)
+        # FFmpeg process budget shared by every guild, with a few decoders kept spawned for cache misses
+        self.decoders = DecoderPool(
+            Admission(self.config.decoder_limit, self.config.decoder_queue, self.config.decoder_timeout),
+            self.logger, warm=self.config.decoder_warm,
+        )
+        # Pre-transcoded Opus cache with loudness gain baked in, read-only in all but the first cluster;
+        # its FFmpeg runs count against the same budget
+        self.transcodes = TranscodeCache(
+            CACHE_DIR, self.logger, loudness=self.loudness, fingerprints=self.fingerprints, readonly=CLUSTER_ID != 0,
+            admission=self.decoders.admission,
+        )
+        # In-memory frames of hot short clips
+        self.frame_cache = FrameCache(
+            self.logger, budget=self.config.frame_cache_mb * 1024 * 1024, max_seconds=self.config.frame_cache_seconds,
+            admission=self.decoders.admission,
+        )
+        # Play history, which also decides what is preloaded at startup
+        self.usage = UsageStore(USAGE_DB, self.logger)
+        # Fingerprint and transcode sounds as they are added or changed
+        self.sounds.add_listener(lambda changed: self.loop.create_task(self.fingerprint_sounds(changed)))
+        # Warm voice connections, pre-connected when a user joins one of the autojoin channels
+        self.voice_pool = VoicePool(
+            self.logger, idle_timeout=self.config.idle_timeout, autojoin=self.config.autojoin_channels,
+            timeout=self.config.connect_timeout,
+        )
+        # Drops messages that can't be commands before a context is built
+        self.ingress = ingress.CommandFilter()
+        self.register_metrics()
 
         # Call parent object init
-        super().__init__(intents=INTENTS, command_prefix=get_prefix)
+        shards = {"shard_count": SHARD_COUNT, "shard_ids": SHARD_IDS} if SHARDED else {}
+        super().__init__(
+            intents=ingress.intents(self.config.message_content), command_prefix=get_prefix,
+            # Voice commands need neither the member list nor old messages
+            member_cache_flags=ingress.member_cache_flags(), chunk_guilds_at_startup=False,
+            max_messages=self.config.message_cache or None,
+            # Counts 429s for the rate_limit_hits gauge
+            http_trace=self.outbox.rate_limits.trace, **shards,
+        )
+        self.phases["init"] = perf_counter()
+
+    def register_metrics(self: BotBase) -> None:
+        """
+        Exposes the counters of bot components as metrics
+        """
+        metrics = self.metrics
+        metrics.describe("command_seconds", "histogram", "Time from message to command completion")
+        metrics.describe("commands_total", "counter", "Commands run, by outcome")
+        metrics.register("ffmpeg_spawn_seconds", "Time to start an FFmpeg decoder for playback", self.decoders.spawn_latency)
+        metrics.register(
+            "decoder_admission_wait_seconds", "Time a decoder waited for a slot of the FFmpeg process budget",
+            self.decoders.admission.wait_latency,
+        )
+        metrics.describe("first_packet_seconds", "histogram", "Time from play command to the first audio packet")
+        metrics.register("voice_connect_seconds", "Time to open a voice connection", self.voice_pool.connect_latency)
+        metrics.register("voice_move_seconds", "Time to move a voice connection", self.voice_pool.move_latency)
+        metrics.gauge("outbox_depth", "Messages waiting to be sent", lambda: self.outbox.depth)
+        metrics.gauge(
+            "outbox_messages", "Messages sent, merged into another, dropped as stale and held back by the token bucket",
+            lambda: {outcome: value for outcome, value in self.outbox.stats().items() if outcome not in ("depth", "rate_limit_hits")},
+            label="outcome",
+        )
+        metrics.gauge("rate_limit_hits", "429 responses from Discord", lambda: self.outbox.rate_limit_hits)
+        metrics.gauge("cleanup_pending", "Messages waiting to be deleted", lambda: self.cleanup.pending)
+        metrics.gauge("sounds", "Sounds in the index", self.sounds.sound_count)
+        metrics.gauge("voice_connections", "Open voice connections", lambda: len(self.voice_clients))
+        metrics.gauge("guilds", "Guilds this process serves", lambda: len(self.guilds))
+        metrics.gauge(
+            "gateway_latency_seconds", "Gateway heartbeat latency per shard",
+            lambda: dict(self.latencies) if SHARDED else {self.shard_id or 0: self.latency},
+            label="shard",
+        )
+        metrics.gauge(
+            "log_records_dropped", "Log records dropped by sampling or a full logging queue",
+            logs.pipeline.stats, label="reason",
+        )
+        metrics.gauge(
+            "decoders", "FFmpeg decoders running, waiting for a slot and kept warm",
+            lambda: {state: value for state, value in self.decoders.stats().items() if state in ("active", "waiting", "warm")},
+            label="state",
+        )
+        metrics.gauge("decoder_utilization", "Share of the FFmpeg process budget in use", lambda: self.decoders.stats()["utilization"])
+        metrics.gauge("decoder_starts", "Decodes started on a warm or a freshly spawned decoder", lambda: dict(self.decoders.starts), label="start")
+        metrics.gauge(
+            "decoder_rejections", "Decodes turned away by a full admission queue or a wait timeout",
+            lambda: {"rejected": self.decoders.admission.rejected, "timeout": self.decoders.admission.timeouts},
+            label="reason",
+        )
+        metrics.gauge("usage_pending", "Plays waiting to be written to the usage store", lambda: self.usage.pending)
+        metrics.gauge("frame_cache_bytes", "Bytes of in-memory frames", lambda: self.frame_cache.size)
+        metrics.gauge(
+            "dedup_reclaimed_bytes", "Bytes of cached artifacts byte-identical sounds share instead of duplicating",
+            lambda: self.dedup["reclaimed_artifact_bytes"] if self.dedup else 0,
+        )
+        metrics.gauge(
+            "cache_hit_ratio", "Share of playback lookups served from a cache",
+            lambda: {
+                "frames": self.frame_cache.stats()["hit_ratio"],
+                "transcodes": self.transcodes.hits / max(1, self.transcodes.hits + self.transcodes.misses),
+            },
+            label="cache",
+        )
+
+    def apply_config(self: BotBase, old: settings.Config, new: settings.Config) -> None:
+        """
+        Applies reloaded settings without a restart, so voice sessions stay up
+        """
+        self.config = new
+        logs.pipeline.configure(new)
+        self.frame_cache.resize(new.frame_cache_mb * 1024 * 1024, new.frame_cache_seconds)
+        self.decoders.admission.resize(new.decoder_limit, new.decoder_queue, new.decoder_timeout)
+        self.decoders.resize(new.decoder_warm)
+        self.voice_pool.idle_timeout = new.idle_timeout
+        self.voice_pool.timeout = new.connect_timeout
+        self.voice_pool.autojoin = set(new.autojoin_channels)
+        if new.data_dir != old.data_dir:
+            self.loop.create_task(self.move_library(new.data_dir))
+        if new.packs_dir != old.packs_dir:
+            self.loop.create_task(self.packs.move(new.packs_dir))
+
+    async def move_library(self: BotBase, data_dir: str) -> None:
+        """
+        Re-indexes the sound library from a new directory
+        """
+        self.sound_watcher.stop()
+        self.data_dir = data_dir
+        await self.sounds.rebind(data_dir)
+        self.sound_watcher.start(self.loop)
+
+    async def fingerprint_sounds(self: BotBase, rels: set = None) -> None:
+        """
+        Hashes new or changed sounds of the given dirs (or the whole library) off the loop, then queues their transcodes
+        """
+        try:
+            digests = await self.loop.run_in_executor(None, self.sounds.fingerprint, rels)
+            if rels is None:
+                self.dedup = await self.loop.run_in_executor(None, lambda: dedup_report(digests, artifact_sizes(CACHE_DIR)))
+                self.logger.info(f"Sound fingerprints: {format_report(self.dedup)}")
+            await self.loop.run_in_executor(None, self.fingerprints.save)
+        except OSError as e:
+            self.logger.error(f"Failed to fingerprint sounds: {e}")
+        self.transcodes.enqueue_all(self.sounds.paths(rels))
+
+    async def preload_popular(self: BotBase) -> None:
+        """
+        Loads the most played sounds into the frame cache
+        """
+        top = await self.usage.top(self.config.preload_sounds)
+
+        def describe():
+            # Hashing a few sounds here beats waiting for the full fingerprint pass
+            sounds = []
+            for path, _ in top:
+                try:
+                    digest = self.fingerprints.hash_of(path)
+                except OSError:
+                    # Removed since it was played
+                    continue
+                sounds.append((digest, path, self.transcodes.cached(path), *self.loudness.profile(digest)))
+            return sounds
+        await self.frame_cache.preload(await self.loop.run_in_executor(None, describe))
+
+    def build_index(self: BotBase) -> None:
+        """
+        Mounts the sound packs, scans the sound library and indexes its names (blocking)
+        """
+        self.packs.mount_all()
+        self.sounds.build()
+        self.search.build()
+
+    async def load_cog(self: BotBase, cog: str) -> None:
+        """
+        Loads one cog extension and logs how long it took
+        """
+        started = perf_counter()
+        await self.load_extension(f"lib.cogs.{cog}")
+        # Log cog loading
+        self.logger.info(f"{cog} cog loaded in {(perf_counter() - started) * 1000:.0f} ms")
 
-    async def setup(self: BotBase) -> None:
+    async def setup_hook(self: BotBase) -> None:
         """
-        Initiates cogs before bot is ready
+        Initiates cogs before bot is ready, runs once before the first gateway connection
         """
+        # Log setup start
+        self.logger.info("Running setup...")
+        self.phases["login"] = perf_counter()
+        # The mention prefixes are known once logged in
+        self.ingress.bind(self.user.id)
         # remove default help cog
         self.remove_command("help")
-        # Init cogs
-        for cog in COGS:
-            # Load cog
-            await self.load_extension(f"lib.cogs.{cog}")
-            # Log cog loading
-            self.logger.info(f"{cog} cog loaded")
+        # Sample event loop lag and serve metrics
+        self.metrics.start(self.loop)
+        if self.metrics_port:
+            try:
+                await self.metrics.serve(self.metrics_host, self.metrics_port)
+            except OSError as e:
+                self.logger.error(f"Failed to serve metrics: {e}")
+        # Start the message cleanup wheel
+        self.cleanup.start(self.loop)
+        # Pick up config changes while running
+        self.settings.watch(self.loop)
+        # Index the library in a thread while the cogs load
+        await asyncio.gather(
+            self.loop.run_in_executor(None, self.build_index),
+            *(self.load_cog(cog) for cog in COGS),
+        )
+        # Watch the sound library for changes and packs as they come and go
+        self.sound_watcher.start(self.loop)
+        self.packs.start(self.loop)
+        # Spawn the warm decoders before the first cache miss
+        self.decoders.refill()
+        # Fingerprint and transcode the library in the background
+        self.transcodes.start(self.loop)
+        self.loop.create_task(self.fingerprint_sounds())
+        # Record plays, and have the most played sounds in memory before the first command
+        self.usage.start(self.loop)
+        if self.config.preload_sounds:
+            preload = self.loop.create_task(self.preload_popular())
+            _, pending = await asyncio.wait({preload}, timeout=PRELOAD_TIMEOUT)
+            if pending:
+                self.logger.warning(f"Preloading takes over {PRELOAD_TIMEOUT:.0f}s, finishing in the background")
+        self.phases["setup"] = perf_counter()
         # Log setup completion
         self.logger.info("Setup complete")
 
+    def log_phases(self: BotBase) -> None:
+        """
+        Logs how long each startup phase took
+        """
+        names = list(self.phases)
+        steps = ", ".join(
+            f"{name} {(self.phases[name] - self.phases[previous]) * 1000:.0f} ms"
+            for previous, name in zip(names, names[1:])
+        )
+        total = (self.phases[names[-1]] - self.phases["start"]) * 1000
+        self.logger.info(f"Startup took {total:.0f} ms ({steps})")
+
     """ ------------------------------------------ Events ------------------------------------------------ """
     async def on_connect(self: BotBase) -> None:
         """
         Actions to perform on connect
         """
-        # Log setup start
-        self.logger.info("Running setup...")
-        # Attempt setup
-        await self.setup()
+        self.phases.setdefault("connect", perf_counter())
         # Log connection
         self.logger.info("Bot connected")
 
@@ -102,6 +389,8 @@ class Bot(BotBase):
         """
         Actions to perform on disconnect
         """
+        if self.disconnected_at is None:
+            self.disconnected_at = perf_counter()
         # Log disconnection
         self.logger.info("Bot disconnected")
 
@@ -122,16 +411,34 @@ class Bot(BotBase):
         Actions to perform once the bot is ready
         """
         if not self.ready:
-            # Confirm all cogs are ready
-            while not self.cogs_ready.all_ready():
-                await sleep(0.5)
+            # Cogs ready up from their own on_ready listeners
+            await self.cogs_ready.wait()
 
             self.ready = True
+            self.phases["ready"] = perf_counter()
             # Log readiness
             self.logger.info("Bot ready")
+            self.log_phases()
         else:
-            # Log reconnection
+            self.log_reconnect()
+
+    async def on_resumed(self: BotBase) -> None:
+        """
+        Actions to perform when a gateway session is resumed
+        """
+        self.log_reconnect()
+
+    def log_reconnect(self: BotBase) -> None:
+        """
+        Logs how long the bot was disconnected
+        """
+        if self.disconnected_at is None:
             self.logger.info("Bot reconnected")
+            return
+        downtime = (perf_counter() - self.disconnected_at) * 1000
+        self.disconnected_at = None
+        # Log reconnection
+        self.logger.info(f"Bot reconnected after {downtime:.0f} ms")
 
     """ ------------------------------------------ Other Functions ------------------------------------------------ """
     def run(self: BotBase, version: str) -> None:
@@ -143,19 +450,41 @@ class Bot(BotBase):
         # Log bot startup
         self.logger.info("Running bot...")
         # Run bot
-        super().run(self.TOKEN, reconnect=True)
+        # discord.py logs through the bot's logging queue, not a handler of its own
+        super().run(self.TOKEN, reconnect=True, log_handler=None)
+
+    async def close(self: BotBase) -> None:
+        """
+        Deletes pending messages before shutting down
+        """
+        await self.cleanup.drain()
+        self.settings.stop()
+        self.packs.stop()
+        self.voice_pool.close()
+        self.decoders.close()
+        await self.usage.close()
+        await self.metrics.stop()
+        await super().close()
 
     async def process_commands(self: BotBase, message: Message) -> None:
         """
         Actions to perform when a message doesn't have a proper channel
         """
+        # Most messages are chatter, ignore them without parsing
+        if not self.ingress.accepts(message):
+            return
         ctx = await self.get_context(message, cls=Context)
 
         if ctx.command is not None and ctx.guild is not None:
             if not self.ready:
-                await ctx.send("I'm not ready to receive commands. Please wait a few seconds.")
+                await self.outbox.send(ctx.channel, "I'm not ready to receive commands. Please wait a few seconds.", coalesce=True)
             else:
+                started = perf_counter()
                 await self.invoke(ctx)
+                # Command errors are handled inside invoke, so this also times failures
+                name = ctx.command.qualified_name
+                self.metrics.observe("command_seconds", perf_counter() - started, command=name)
+                self.metrics.inc("commands_total", command=name, outcome="error" if ctx.command_failed else "ok")
 
 # Bot instance
 bot = Bot()
\ No newline at end of file
@@ -36,9 +36,19 @@ class Help(Cog):
                 help_message = f"📜 **{command.name}**\n\n**Description:** {command.help}\n"
                 # Append usage details for specific commands if necessary.
                 if command.name.lower() == "play":
-                    help_message += "    *Usage*: @AudioBot play <directory> <track_number> or @AudioBot play <track_name>\n"
+                    help_message += "    *Usage*: @AudioBot play <directory> <track_number> or @AudioBot play <track_name>, `all` after a directory plays every track, add @m:ss to start part way through\n"
                 elif command.name.lower() == "list":
                     help_message += "    *Usage*: @AudioBot list <expand>\n"
+                elif command.name.lower() == "search":
+                    help_message += "    *Usage*: @AudioBot search <query>\n"
+                elif command.name.lower() == "policy":
+                    help_message += "    *Usage*: @AudioBot policy <queue|interrupt|drop|mix>\n"
+                elif command.name.lower() == "playlist":
+                    help_message += "    *Usage*: @AudioBot playlist [list|save|play|delete] <name> <sounds...>\n"
+                elif command.name.lower() == "stats":
+                    help_message += "    *Usage*: @AudioBot stats <all>\n"
+                elif command.name.lower() == "seek":
+                    help_message += "    *Usage*: @AudioBot seek <m:ss>\n"
                 await send_basic_message(self.bot.logger, ctx, help_message, wait=30)
 
             
@@ -5,6 +5,42 @@ from discord.ext.commands import Bot as BotBase
 from discord.ext.commands import Cog, command
 
 from utils.funcs import *
+from utils.list_render import TreeRenderer
+from utils.search import DIRECTORY
+
+# Seconds a paginated listing stays up
+LIST_WAIT = 120
+
+
+def format_page(pages: list, page: int) -> str:
+    """
+    Wraps a page body in the listing header and a code block
+    """
+    header = "Available sound files:" if len(pages) == 1 else f"Available sound files ({page + 1}/{len(pages)}):"
+    return f"{header}\n```\n{pages[page]}\n```"
+
+
+class TreePages(discord.ui.View):
+    """
+    Previous/next buttons for a paginated listing
+    """
+    def __init__(self, pages: list, timeout: float) -> None:
+        super().__init__(timeout=timeout)
+        self.pages = pages
+        self.page = 0
+
+    async def show(self, interaction: discord.Interaction, page: int) -> None:
+        # Wrap around at both ends
+        self.page = page % len(self.pages)
+        await interaction.response.edit_message(content=format_page(self.pages, self.page), view=self)
+
+    @discord.ui.button(label="◀", style=discord.ButtonStyle.secondary)
+    async def previous(self, interaction: discord.Interaction, button: discord.ui.Button) -> None:
+        await self.show(interaction, self.page - 1)
+
+    @discord.ui.button(label="▶", style=discord.ButtonStyle.secondary)
+    async def next(self, interaction: discord.Interaction, button: discord.ui.Button) -> None:
+        await self.show(interaction, self.page + 1)
 
 
 class List(Cog):
@@ -13,55 +49,41 @@ class List(Cog):
 	"""
     def __init__(self, bot: BotBase) -> None:
         self.bot = bot
+        # Cached, paginated sound tree
+        self.tree = TreeRenderer(bot.sounds)
 
     @command(name='list', help='Lists all available sound files.')
     async def list_sounds(self, ctx, expand: str = None):
         try:
-            # Function to generate a tree-like structure of the directory
-            def generate_tree(directory, expand_all=False):
-                tree = []
-                seen_dirs = {}  # Store lowercase directory names for case-insensitive matching
-                for root, dirs, files in os.walk(directory):
-                    # Normalize directory paths to lowercase
-                    normalized_root = root.lower()
-                    # Store actual directory names for proper output
-                    real_dirname = os.path.basename(root)
-                    # Track directories in lowercase for case-insensitive matching
-                    seen_dirs[normalized_root] = real_dirname
-                    # Calculate the level of indentation
-                    level = normalized_root.replace(directory.lower(), '').count(os.sep)
-                    # Skip the root directory line
-                    if root == directory:
-                        level = -1  # Top-level files and directories should not be indented
-                    indent = ' ' * 4 * (level) if level > 1 else ''
-                    # Add the directory name (if not the root)
-                    if root != directory:
-                        tree.append(f"{indent}{real_dirname}/")
-                    # Add files (only if expand_all is True or we're at the top level)
-                    sub_indent = ' ' * 4 * (level) if level >= 0 else '' 
-                    if expand_all or level == -1:
-                        for file in files:
-                            if file.endswith('.mp3'):
-                                tree.append(f"{sub_indent}{file.replace('.mp3', '')}")
-                
-                return tree
-
-            # Generate the tree structure for the DATA_DIR
+            # Rendered once per library version and cached
             expand_all = expand and expand.lower() == "expand"  # Check case-insensitively
-            tree_structure = generate_tree(self.bot.data_dir, expand_all)
+            pages = self.tree.pages(bool(expand_all))
 
-            if not tree_structure:
+            if not pages:
                 await send_basic_message(self.bot.logger, ctx, "No sound files found in the `data/audio/sounds` directory.")
                 return
-            # Format the tree structure as a string
-            tree_output = "\n".join(tree_structure)
-            await send_basic_message(self.bot.logger, ctx, f"Available sound files:\n```\n{tree_output}\n```")
+            if len(pages) == 1:
+                await send_basic_message(self.bot.logger, ctx, format_page(pages, 0))
+                return
+            # Page through long listings with buttons
+            view = TreePages(pages, timeout=LIST_WAIT)
+            await send_basic_message(self.bot.logger, ctx, format_page(pages, 0), wait=LIST_WAIT, view=view)
 
         except Exception as e:
             await send_basic_message(self.bot.logger, ctx, f"An error occurred while listing sound files: {e}")
             self.bot.logger.error(f"An error occurred while listing sound files: {e}")
-            
-            
+
+    @command(name='search', help='Searches sound files by name.')
+    async def search(self, ctx, *, query: str):
+        # Exact, prefix and fuzzy matches from the search index
+        results = self.bot.search.search(query, limit=10)
+        if not results:
+            await send_basic_message(self.bot.logger, ctx, f"No sound files match `{query}`.")
+            return
+        lines = [f"{entry.name}/" if entry.kind == DIRECTORY else entry.name for entry in results]
+        results_output = "\n".join(lines)
+        await send_basic_message(self.bot.logger, ctx, f"Sound files matching `{query}`:\n```\n{results_output}\n```")
+
     @Cog.listener()
     async def on_ready(self: Cog) -> None:
         # if bot is ready 
@@ -0,0 +1,51 @@
+import os
+
+from discord.ext.commands import Bot as BotBase
+from discord.ext.commands import Cog, command
+
+from utils.funcs import *
+
+# Sounds shown in the stats ranking
+TOP_SOUNDS = 10
+
+
+class Stats(Cog):
+    """
+	Cog that manages the stats command
+	"""
+    def __init__(self, bot: BotBase) -> None:
+        self.bot = bot
+
+    @command(name='stats', help='Shows the most played sounds of this server.')
+    async def stats(self, ctx, scope: str = None):
+        # `stats all` ranks plays across every server
+        guild_id = None if scope and scope.lower() == "all" else ctx.guild.id
+        summary = await self.bot.usage.summary(guild_id)
+        if not summary["plays"]:
+            await send_basic_message(self.bot.logger, ctx, "No sounds played yet.")
+            return
+        top = await self.bot.usage.top(TOP_SOUNDS, guild_id)
+        latency = f"{summary['latency'] * 1000:.0f} ms" if summary["latency"] is not None else "n/a"
+        lines = [
+            f"**{'All servers' if guild_id is None else ctx.guild.name}**: {summary['plays']} plays of {summary['sounds']} sounds",
+            f"Time to first packet {latency} on average, {summary['hit_ratio']:.0%} served from cache",
+        ]
+        lines.extend(
+            f"{position}. {os.path.basename(sound).replace('.mp3', '')} ({plays})"
+            for position, (sound, plays) in enumerate(top, start=1)
+        )
+        await send_basic_message(self.bot.logger, ctx, "\n".join(lines), wait=30)
+
+    @Cog.listener()
+    async def on_ready(self: Cog) -> None:
+        # if bot is ready 
+        if not self.bot.ready:
+            # ready up cog
+            self.bot.cogs_ready.ready_up(__name__.split(".")[-1])
+
+
+async def setup(bot: BotBase) -> None:
+	"""
+	Adds cog to bot
+	"""
+	await bot.add_cog(Stats(bot))
@@ -1,11 +1,20 @@
+import asyncio
 import os
+import time
+import typing
 
 import discord
 from discord import FFmpegPCMAudio
 from discord.ext.commands import Bot as BotBase
 from discord.ext.commands import Cog, command
 
+from utils import packs
 from utils.funcs import *
+from utils.playback import DROPPED, FULL, MIX, POLICIES, QUEUE, QUEUED, GuildPlayer, Track
+from utils.playlists import MAX_ITEMS
+from utils.search import DIRECTORY
+from utils.seek import format_timestamp, parse_timestamp
+from utils.transcode import OggOpusSource
 
 
 class Voice(Cog):
@@ -14,6 +23,146 @@ class Voice(Cog):
 	"""
     def __init__(self, bot: BotBase) -> None:
         self.bot = bot
+        # Guild id -> playback scheduler
+        self.players = {}
+        bot.metrics.gauge("queue_depth", "Tracks waiting in guild queues", lambda: sum(len(player.queue) for player in self.players.values()))
+        bot.metrics.gauge("players_busy", "Guilds playing or queueing sounds", lambda: sum(player.busy for player in self.players.values()))
+
+    def cog_unload(self) -> None:
+        # Stop every guild scheduler
+        for player in self.players.values():
+            player.close()
+        self.players.clear()
+
+    def player(self, guild) -> GuildPlayer:
+        """
+        Gets the playback scheduler of a guild, creating it on first use
+        """
+        player = self.players.get(guild.id)
+        if player is None:
+            player = GuildPlayer(
+                guild, self.bot.logger, self.make_source,
+                on_start=self.on_track_start, on_finish=self.on_track_finish, on_error=self.on_track_error,
+                on_first_packet=self.on_first_packet, policy=QUEUE, maxsize=10, executor=self.bot.decoders.executor,
+            )
+            self.players[guild.id] = player
+        return player
+
+    async def on_track_start(self, track: Track) -> None:
+        """
+        Announces a track once it starts playing
+        """
+        self.bot.logger.info(f"Playing: {track.path}")
+        # Dropped by the outbox if the track already ended
+        title = track.title
+        if track.items is not None:
+            if track.index:
+                # The first item is recorded with its time to first packet
+                self.bot.usage.record(track.ctx.guild.id, track.items[track.index], None, track.cached)
+            # Each item of a sequence is announced as it starts
+            name = os.path.basename(track.items[track.index]).replace('.mp3', '')
+            title = f"{name} ({track.index + 1}/{len(track.items)})"
+        elif track.position:
+            title = f"{track.title} from {format_timestamp(track.position)}"
+        previous = track.message
+        track.message = await self.bot.outbox.send(
+            track.ctx.channel, f"Playing: {title}", coalesce=True, relevant=lambda: not track.done
+        )
+        if previous is not None:
+            self.bot.cleanup.schedule(previous, wait=1)
+        if track.done:
+            # Finished while the message was waiting to be sent
+            self.bot.cleanup.schedule(track.message, wait=1)
+
+    async def on_first_packet(self, track: Track) -> None:
+        """
+        Reports the time from the play command to the first audio packet
+        """
+        self.bot.logger.info(f"Time to first packet for {track.title}: {track.ttfp * 1000:.0f} ms")
+        self.bot.metrics.observe("first_packet_seconds", track.ttfp)
+        self.bot.usage.record(track.ctx.guild.id, track.path, track.ttfp, track.cached)
+
+    async def on_track_finish(self, track: Track) -> None:
+        """
+        Cleans up the command and status messages of a finished track
+        """
+        self.bot.cleanup.schedule(track.ctx.message, track.message, wait=1)
+        # The idle timer counts from the end of the last sound
+        self.bot.voice_pool.touch(track.ctx.guild)
+
+    async def on_track_error(self, track: Track, e: Exception) -> None:
+        """
+        Reports a track that failed to start
+        """
+        self.bot.logger.error(f"Error during playback: {e}")
+        await send_basic_message(self.bot.logger, track.ctx, f"An error occurred: {e}")
+
+    def make_source(self, audio_file_name: str, pcm: bool = False, seek: tuple = None,
+                    opus: bool = False) -> discord.AudioSource:
+        """
+        Builds the audio source for a sound, preferring in-memory frames, then the pre-transcoded Opus cache
+
+        Set pcm when the source will be mixed, since Opus passthrough can't be mixed, and opus when only Opus
+        passthrough will do. A seek of (byte offset, seconds to drop) decodes from the middle of the file,
+        which no cache covers.
+        """
+        # Byte-identical sounds share one content hash and so one set of cached artifacts
+        digest = self.bot.sounds.digest(audio_file_name)
+        if seek is not None:
+            offset, skip = seek
+            gain_db, _ = self.bot.loudness.profile(digest)
+            return self.decode(audio_file_name, gain_db, skip, offset)
+        # Fixed loudness gain and leading silence from offline analysis, none until the sound was measured
+        gain_db, start = self.bot.loudness.profile(digest)
+        source = self.bot.frame_cache.get(digest, gain_db, start)
+        if source is not None and not (pcm and source.is_opus()) and not (opus and not source.is_opus()):
+            # Served from memory, no subprocess
+            return source
+        cached = self.bot.transcodes.lookup(audio_file_name)
+        # Keep short clips in memory for the next play
+        self.bot.loop.create_task(self.bot.frame_cache.load(digest, audio_file_name, cached, gain_db, start))
+        if cached is not None and not pcm:
+            # Opus passthrough with the gain and trim baked in, no FFmpeg and no re-encode
+            return OggOpusSource(cached)
+        if opus:
+            raise FileNotFoundError(f"`{audio_file_name}` has no Opus transcode")
+        if cached is None:
+            # Cache miss: transcode in the background and decode with FFmpeg for now
+            self.bot.transcodes.enqueue(audio_file_name)
+        return self.decode(audio_file_name, gain_db, start)
+
+    def decode(self, audio_file_name: str, gain_db: float, start: float, offset: int = 0) -> discord.AudioSource:
+        """
+        Builds a pooled FFmpeg decoder source under the shared process budget, fed the file or pack member on stdin
+        """
+        source = self.bot.decoders.source(audio_file_name, start, offset)
+        if gain_db:
+            # Cheap per-frame multiply instead of a live loudnorm filter
+            source = discord.PCMVolumeTransformer(source, volume=10 ** (gain_db / 20))
+        return source
+
+    def sequence(self, ctx, title: str, items: list, requested: float) -> Track:
+        """
+        Builds a track that plays several sounds back to back without gaps
+
+        Without a transcode for every item the sequence decodes to PCM, one pooled FFmpeg per item.
+        """
+        items = tuple(items[:MAX_ITEMS])
+        # Opus passthrough needs no decoder at all, but only if every item has a transcode
+        opus = all(self.bot.transcodes.cached(path) is not None for path in items)
+        return Track(items[0], title, ctx, requested=requested, items=items, opus=opus)
+
+    def needs_decoder(self, audio_file_name: str, pcm: bool, seek: tuple = None) -> bool:
+        """
+        Whether playing a sound would start an FFmpeg decoder
+        """
+        if seek is not None:
+            return True
+        digest = self.bot.sounds.digest(audio_file_name)
+        clip = self.bot.frame_cache.peek(digest, *self.bot.loudness.profile(digest))
+        if clip is not None and not (pcm and clip.opus):
+            return False
+        return pcm or self.bot.transcodes.cached(audio_file_name) is None
 
     @command(name='join', help='Joins the voice channel')
     async def join(self, ctx):
@@ -22,76 +171,325 @@ class Voice(Cog):
             return
         
         channel = ctx.message.author.voice.channel
-        await channel.connect()
+        # Reuses or moves the guild's connection when there is one
+        await self.bot.voice_pool.connect(channel)
 
     @command(name='leave', help='Leaves the voice channel')
     async def leave(self, ctx):
-        if ctx.voice_client:
-            await ctx.guild.voice_client.disconnect()
+        # Drop anything still queued for this guild
+        player = self.players.pop(ctx.guild.id, None)
+        if player is not None:
+            player.close()
+        await self.bot.voice_pool.disconnect(ctx.guild)
         # Delete the command message after 15 seconds
-        await delete_messages(self.bot.logger, ctx.message, wait=15)
+        self.bot.cleanup.schedule(ctx.message, wait=15)
 
     @command(name='stop', help='Stops the current sound')
     async def stop(self, ctx):
         if ctx.voice_client:
+            # Stop means stop everything, not just the current track
+            player = self.players.get(ctx.guild.id)
+            if player is not None:
+                player.clear()
             ctx.voice_client.stop()
-            await send_basic_message(self.bot.logger, ctx, "Stopped playback.")
+            await send_basic_message(self.bot.logger, ctx, "Stopped playback.", coalesce=True)
+
+    async def locate(self, ctx, audio_file_name: str, position: float) -> tuple:
+        """
+        Finds where to start decoding a sound for a timestamp, or tells the user why it can't start there
+        """
+        digest = self.bot.sounds.digest(audio_file_name)
+        try:
+            # The frame index is read or built once per sound, off the loop
+            return await self.bot.loop.run_in_executor(
+                None, lambda: self.bot.frame_indexes.locate(
+                    digest or self.bot.fingerprints.hash_of(audio_file_name), audio_file_name, position
+                ),
+            )
+        except (ValueError, OSError) as e:
+            name = os.path.basename(audio_file_name).replace('.mp3', '')
+            await send_basic_message(self.bot.logger, ctx, f"Can't start `{name}` at {format_timestamp(position)}: {e}")
+            return None
 
-    @command(name='play', help='Plays a sound file from a directory.')
-    async def play(self, ctx, directory: str, track_number: int = 1):
+    @command(name='play', help='Plays a sound file from a directory, optionally from a time (@1:23).')
+    async def play(self, ctx, directory: str, track_number: typing.Optional[int] = 1, position: str = None):
+        requested = time.perf_counter()
         if not ctx.message.author.voice:
-            await send_basic_message(ctx, f"{ctx.message.author.name} is not connected to a voice channel")
+            await send_basic_message(self.bot.logger, ctx, f"{ctx.message.author.name} is not connected to a voice channel")
             return
+        if position is not None and position.lower() == "all":
+            position = "all"
+        elif position is not None:
+            try:
+                position = parse_timestamp(position)
+            except ValueError as e:
+                await send_basic_message(self.bot.logger, ctx, str(e))
+                return
+
+        await self.connected(ctx, lambda connecting: self.play_sound(ctx, directory, track_number, requested, connecting, position))
+
+    async def connected(self, ctx, play) -> None:
+        """
+        Runs play(connecting) while the voice connection comes up in the background
+        """
+        # Connect in the background while the sound is looked up and decoded, moving an idle connection
+        # to the caller's channel but never one that is playing
+        connecting = None
+        if not ctx.voice_client or not self.player(ctx.guild).busy:
+            connecting = asyncio.create_task(self.bot.voice_pool.connect(ctx.message.author.voice.channel))
+        try:
+            await play(connecting)
+        finally:
+            if connecting is not None and not connecting.done():
+                await connecting
 
-        if not ctx.voice_client:
-            await ctx.message.author.voice.channel.connect()
+    async def play_sound(self, ctx, directory: str, track_number: int, requested: float, connecting,
+                         position=None) -> None:
+        """
+        Resolves a sound and submits it to the guild scheduler once connected
+        """
+        # `all` plays every track of a directory
+        everything = position == "all"
+        if everything:
+            position = None
+        # Look up tracks of a directory, then top-level files (case-insensitive)
+        sound_files = self.bot.sounds.tracks(directory)
+        audio_file_name = self.bot.sounds.top_level(directory) if sound_files is None else None
 
-        # Convert input to lowercase
-        directory = directory.lower()
-        dir_path = os.path.join(self.bot.data_dir, directory)
+        if sound_files is None and audio_file_name is None:
+            # Fall back to the closest matching name
+            match = self.bot.search.best(directory)
+            if match is None:
+                self.bot.logger.error(f"Sound file `{directory}` not found")
+                # Too vague to guess, let the user pick
+                suggestions = self.bot.search.search(directory, limit=5)
+                if suggestions:
+                    names = ", ".join(f"`{entry.name}/`" if entry.kind == DIRECTORY else f"`{entry.name}`" for entry in suggestions)
+                    await send_basic_message(self.bot.logger, ctx, f"Sound file `{directory}` not found. Did you mean {names}?")
+                else:
+                    await send_basic_message(self.bot.logger, ctx, f"Sound file `{directory}` not found")
+                return
+            if match.kind == DIRECTORY:
+                sound_files = self.bot.sounds.tracks(match.path)
+            else:
+                audio_file_name = match.path
+            directory = match.name
 
-        if os.path.isdir(dir_path):
-            sound_files = [f for f in os.listdir(dir_path) if f.lower().startswith(directory) and f.endswith('.mp3')]
+        if sound_files is not None:
             if not sound_files:
                 await send_basic_message(self.bot.logger, ctx, f"No sound files found in the directory '{directory}'.")
                 return
 
-            sound_files.sort(key=lambda x: int(x.split('_')[-1].replace('.mp3', '')))
+            if everything:
+                # The whole directory in track order, as one gapless stream
+                track = self.sequence(ctx, f"{directory} ({min(len(sound_files), MAX_ITEMS)} tracks)", sound_files, requested)
+                await self.submit(ctx, track, connecting)
+                return
 
             if track_number < 1 or track_number > len(sound_files):
                 await send_basic_message(self.bot.logger, ctx, f"Invalid track number. Please choose a number between 1 and {len(sound_files)}.")
                 return
 
-            selected_track = sound_files[track_number - 1]
-            audio_file_name = os.path.join(dir_path, selected_track)
-            
+            audio_file_name = sound_files[track_number - 1]
+
+        seek = None
+        if position:
+            seek = await self.locate(ctx, audio_file_name, position)
+            if seek is None:
+                return
+
+        selected_track = os.path.basename(audio_file_name)
+        track = Track(audio_file_name, selected_track.replace('.mp3', ''), ctx, requested=requested, position=position, seek=seek)
+        await self.submit(ctx, track, connecting)
+
+    async def submit(self, ctx, track: Track, connecting) -> None:
+        """
+        Hands a track to the guild scheduler once connected and reports what happened to it
+        """
+        player = self.player(ctx.guild)
+        mixing = player.policy == MIX
+        if track.items is None:
+            decoding = self.needs_decoder(track.path, mixing, track.seek)
         else:
-            # Handle top-level files case-insensitively
-            all_files = {f.lower(): f for f in os.listdir(self.bot.data_dir) if f.endswith('.mp3')}
-            if directory + ".mp3" not in all_files:
-                await send_basic_message(self.bot.logger, ctx, f"Sound file `{directory}` not found")
-                self.bot.logger.error(f"Sound file `{directory}` not found")
+            decoding = (mixing or not track.opus) and any(self.needs_decoder(path, True) for path in track.items)
+        track.cached = not decoding
+        # Turn the sound away now rather than let it wait in a full decoder queue
+        if decoding and not self.bot.decoders.admission.check():
+            await send_basic_message(self.bot.logger, ctx, "Too many sounds are playing right now, try again in a moment.", coalesce=True)
+            return
+        if connecting is not None:
+            # Decode the first frames while the voice connection comes up
+            try:
+                await asyncio.gather(connecting, player.prewarm(track))
+            except Exception:
+                track.discard()
+                raise
+
+        # Hand the track to the guild scheduler
+        status = player.submit(track)
+        if status == QUEUED:
+            await send_basic_message(self.bot.logger, ctx, f"Queued: {track.title} (position {len(player.queue)})", coalesce=True)
+        elif status == DROPPED:
+            await send_basic_message(self.bot.logger, ctx, f"Already playing, `{track.title}` was skipped.", coalesce=True)
+        elif status == FULL:
+            await send_basic_message(self.bot.logger, ctx, f"The queue is full ({player.maxsize} tracks). Try again later.", coalesce=True)
+
+    @command(name='seek', help='Restarts the current sound at a time, e.g. seek 1:23')
+    async def seek(self, ctx, position: str):
+        requested = time.perf_counter()
+        player = self.players.get(ctx.guild.id)
+        if player is None or player.current is None:
+            await send_basic_message(self.bot.logger, ctx, "Nothing is playing.")
+            return
+        try:
+            position = parse_timestamp(position)
+        except ValueError as e:
+            await send_basic_message(self.bot.logger, ctx, str(e))
+            return
+        current = player.current
+        # In a sequence, seek within the playing item and keep the ones after it
+        path = current.items[current.index] if current.items is not None else current.path
+        seek = await self.locate(ctx, path, position)
+        if seek is None:
+            return
+        if not self.bot.decoders.admission.check():
+            await send_basic_message(self.bot.logger, ctx, "Too many sounds are playing right now, try again in a moment.", coalesce=True)
+            return
+        items = current.items[current.index:] if current.items is not None else None
+        track = Track(path, current.title, ctx, requested=requested, position=position, seek=seek, items=items)
+        if not player.replace(track):
+            # Ended while the index was read
+            track.discard()
+            await send_basic_message(self.bot.logger, ctx, "Nothing is playing.")
+
+    def resolve_sounds(self, names: tuple) -> tuple:
+        """
+        Resolves sound and directory names to sound paths, a directory standing for all of its tracks
+
+        Returns (paths, names that matched nothing).
+        """
+        paths, missing = [], []
+        for name in names:
+            tracks = self.bot.sounds.tracks(name)
+            path = self.bot.sounds.top_level(name) if tracks is None else None
+            if tracks is None and path is None:
+                match = self.bot.search.best(name)
+                if match is None:
+                    missing.append(name)
+                    continue
+                if match.kind == DIRECTORY:
+                    tracks = self.bot.sounds.tracks(match.path)
+                else:
+                    path = match.path
+            paths.extend(tracks if tracks is not None else [path])
+        return paths, missing
+
+    @command(name='playlist', help='Saves, shows, plays and deletes playlists of sounds')
+    async def playlist(self, ctx, action: str = None, name: str = None, *sounds: str):
+        requested = time.perf_counter()
+        playlists = self.bot.playlists
+        action = (action or "list").lower()
+        await playlists.load(ctx.guild.id)
+        if action == "list" and name is None:
+            names = playlists.names(ctx.guild.id)
+            await send_basic_message(self.bot.logger, ctx, f"Playlists: {', '.join(names)}" if names else "No playlists saved yet.")
+            return
+        if name is None or action not in ("list", "save", "play", "delete"):
+            await send_basic_message(self.bot.logger, ctx, "Usage: playlist [list|save|play|delete] <name> <sounds...>")
+            return
+
+        if action == "save":
+            paths, missing = self.resolve_sounds(sounds)
+            if missing or not paths:
+                await send_basic_message(self.bot.logger, ctx, f"Sounds not found: {', '.join(missing) or 'none given'}")
                 return
+            # Stored relative to the library so a DataDir change doesn't break the playlist
+            playlists.put(ctx.guild.id, name, [self.bot.sounds.relpath(path) or path for path in paths])
+            await playlists.save(ctx.guild.id)
+            await send_basic_message(self.bot.logger, ctx, f"Saved playlist `{name}` ({min(len(paths), MAX_ITEMS)} sounds).")
+            return
+        if action == "delete":
+            if playlists.delete(ctx.guild.id, name):
+                await playlists.save(ctx.guild.id)
+                await send_basic_message(self.bot.logger, ctx, f"Deleted playlist `{name}`.")
+            else:
+                await send_basic_message(self.bot.logger, ctx, f"Playlist `{name}` not found")
+            return
 
-            selected_track = all_files[directory + ".mp3"]
-            audio_file_name = os.path.join(self.bot.data_dir, selected_track)
+        paths = playlists.get(ctx.guild.id, name)
+        if paths is None:
+            await send_basic_message(self.bot.logger, ctx, f"Playlist `{name}` not found")
+            return
+        if action == "list":
+            lines = [f"{position}. {os.path.basename(path).replace('.mp3', '')}" for position, path in enumerate(paths, start=1)]
+            await send_basic_message(self.bot.logger, ctx, f"**{name}**\n" + "\n".join(lines))
+            return
 
-        self.bot.logger.info(f"Playing: {audio_file_name}")
+        if not ctx.message.author.voice:
+            await send_basic_message(self.bot.logger, ctx, f"{ctx.message.author.name} is not connected to a voice channel")
+            return
+        paths = [self.bot.sounds.sound_path(path) for path in paths]
+        # Sounds removed since the playlist was saved are left out
+        paths = await self.bot.loop.run_in_executor(None, lambda: [path for path in paths if self.exists(path)])
+        if not paths:
+            await send_basic_message(self.bot.logger, ctx, f"None of the sounds of `{name}` exist anymore.")
+            return
+        track = self.sequence(ctx, f"{name} ({len(paths)} tracks)", paths, requested)
+        await self.connected(ctx, lambda connecting: self.submit(ctx, track, connecting))
 
+    @staticmethod
+    def exists(path: str) -> bool:
         try:
-            source = discord.FFmpegPCMAudio(audio_file_name)
-            playing_message = await ctx.send(f"Playing: {selected_track.replace('.mp3', '')}")
-            ctx.voice_client.play(source, after=lambda e: asyncio.run_coroutine_threadsafe(delete_messages(self.bot.logger, ctx.message, playing_message, wait=1), self.bot.loop))
-            
-        except Exception as e:
-            await send_basic_message(self.bot.logger, ctx, f"An error occurred: {e}")
-            try:
-                await delete_messages(self.bot.logger, playing_message, wait=1)
-            except Exception as e:
-                self.bot.logger.error(f"Error with playing message deletion: {e}")
-                
-            self.bot.logger.error(f"Error during playback: {e}")
-            
+            packs.stat(path)
+        except OSError:
+            return False
+        return True
+
+    @command(name='queue', help='Shows the tracks waiting to play')
+    async def show_queue(self, ctx):
+        player = self.players.get(ctx.guild.id)
+        if player is None or not player.busy:
+            await send_basic_message(self.bot.logger, ctx, "Nothing is playing.")
+            return
+        lines = []
+        if player.current is not None:
+            lines.append(f"Playing: {player.current.title}")
+        for position, track in enumerate(player.queue, start=1):
+            lines.append(f"{position}. {track.title}")
+        await send_basic_message(self.bot.logger, ctx, "\n".join(lines))
+
+    @command(name='skip', help='Skips the current sound')
+    async def skip(self, ctx):
+        player = self.players.get(ctx.guild.id)
+        if player is not None and player.skip():
+            await send_basic_message(self.bot.logger, ctx, "Skipped.", coalesce=True)
+        else:
+            await send_basic_message(self.bot.logger, ctx, "Nothing is playing.")
+
+    @command(name='clear', help='Clears the queue')
+    async def clear(self, ctx):
+        player = self.players.get(ctx.guild.id)
+        count = player.clear() if player is not None else 0
+        await send_basic_message(self.bot.logger, ctx, f"Cleared {count} queued tracks.")
+
+    @command(name='policy', help='Sets what play does while a sound is playing')
+    async def policy(self, ctx, policy: str = None):
+        player = self.player(ctx.guild)
+        if policy is None:
+            await send_basic_message(self.bot.logger, ctx, f"Current policy: `{player.policy}`. Options: {', '.join(POLICIES)}")
+            return
+        policy = policy.lower()
+        if policy not in POLICIES:
+            await send_basic_message(self.bot.logger, ctx, f"Unknown policy `{policy}`. Options: {', '.join(POLICIES)}")
+            return
+        player.policy = policy
+        await send_basic_message(self.bot.logger, ctx, f"Policy set to `{policy}`.")
+
+    @Cog.listener()
+    async def on_voice_state_update(self, member, before, after) -> None:
+        # Pre-connect to autojoin channels and reconnect after drops
+        self.bot.voice_pool.on_voice_state_update(self.bot.user, member, before, after)
+
     @Cog.listener()
     async def on_ready(self: Cog) -> None:
         # if bot is ready 
@@ -0,0 +1,124 @@
+import asyncio
+import datetime
+from collections import defaultdict
+
+import discord
+
+from utils.funcs import delete_messages
+
+# Discord only bulk deletes messages younger than 14 days, 100 at a time
+BULK_MAX_AGE = datetime.timedelta(days=14) - datetime.timedelta(minutes=1)
+BULK_MAX_COUNT = 100
+
+
+class CleanupScheduler(object):
+    """
+    Timer wheel of pending message deletions, flushed per channel in bulk
+    """
+    def __init__(self, logger, slots: int = 64, tick: float = 1.0) -> None:
+        # Bot logger
+        self.logger = logger
+        # Seconds per wheel slot
+        self.tick = tick
+        # Each slot holds (due tick, message) pairs; later rounds wait in the same slot
+        self._wheel = [[] for _ in range(slots)]
+        # Ticks elapsed since start
+        self._now = 0
+        # Ids of scheduled messages, so shared messages are deleted once
+        self._pending = set()
+        self._task = None
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def start(self, loop: asyncio.AbstractEventLoop) -> None:
+        """
+        Starts turning the wheel
+        """
+        if self._task is None:
+            self._task = loop.create_task(self._run())
+
+    def schedule(self, *messages, wait: float = 15) -> None:
+        """
+        Deletes messages after wait seconds without blocking the caller
+        """
+        due = self._now + max(1, round(wait / self.tick))
+        slot = self._wheel[due % len(self._wheel)]
+        for message in messages:
+            if message is None or message.id in self._pending:
+                continue
+            self._pending.add(message.id)
+            slot.append((due, message))
+
+    async def _run(self) -> None:
+        """
+        Advances one slot per tick and deletes what is due
+        """
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time()
+        while True:
+            next_tick += self.tick
+            await asyncio.sleep(max(0, next_tick - loop.time()))
+            self._now += 1
+            slot = self._wheel[self._now % len(self._wheel)]
+            due = [message for tick, message in slot if tick <= self._now]
+            if not due:
+                continue
+            # Entries for later rounds stay in the slot
+            slot[:] = [(tick, message) for tick, message in slot if tick > self._now]
+            loop.create_task(self._delete(due))
+
+    async def drain(self) -> None:
+        """
+        Deletes every pending message right away, used on shutdown
+        """
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        due = [message for slot in self._wheel for _, message in slot]
+        for slot in self._wheel:
+            slot.clear()
+        if due:
+            self.logger.info(f"Deleting {len(due)} pending messages...")
+            await self._delete(due)
+
+    async def _delete(self, messages: list) -> None:
+        """
+        Deletes due messages, bulk per channel where Discord allows it
+        """
+        by_channel = defaultdict(list)
+        for message in messages:
+            self._pending.discard(message.id)
+            by_channel[message.channel.id].append(message)
+        await asyncio.gather(*(self._delete_channel(batch) for batch in by_channel.values()))
+
+    async def _delete_channel(self, messages: list) -> None:
+        """
+        Deletes the due messages of one channel
+        """
+        # Deleting the command messages of other users needs "Manage Messages"
+        if not messages[0].guild.me.guild_permissions.manage_messages:
+            self.logger.error("Bot does not have permission to delete messages.")
+            return
+        cutoff = discord.utils.utcnow() - BULK_MAX_AGE
+        bulk = [message for message in messages if message.created_at > cutoff]
+        single = [message for message in messages if message.created_at <= cutoff]
+        if len(bulk) < 2:
+            single += bulk
+            bulk = []
+        channel = messages[0].channel
+        for start in range(0, len(bulk), BULK_MAX_COUNT):
+            chunk = bulk[start:start + BULK_MAX_COUNT]
+            try:
+                await channel.delete_messages(chunk)
+            except discord.NotFound:
+                # Bulk delete fails as a whole when one message is gone
+                single += chunk
+            except discord.Forbidden:
+                self.logger.error("Bot does not have permission to delete the message.")
+            except discord.HTTPException as e:
+                self.logger.error(f"Error bulk deleting messages: {e}")
+                single += chunk
+        if single:
+            await delete_messages(self.logger, *single, wait=0)
@@ -0,0 +1,230 @@
+import argparse
+import asyncio
+import logging
+import os
+import re
+import signal
+import sys
+import time
+
+import aiohttp
+
+from utils.funcs import load_token
+
+# Discord endpoint with the recommended shard count
+GATEWAY_BOT_URL = "https://discord.com/api/v10/gateway/bot"
+# Metrics port of the first cluster, the others count up from it
+METRICS_BASE_PORT = 9108
+# Restart delay of a crashed cluster, doubled per crash up to the cap
+RESTART_BACKOFF = 1.0
+RESTART_BACKOFF_MAX = 60.0
+# A cluster up this long counts as healthy again and its backoff resets
+STABLE_AFTER = 300.0
+
+# One sample line of the Prometheus text format
+SAMPLE = re.compile(r"^(\w+)(?:\{([^}]*)\})? (\S+)$")
+LABEL = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+
+def shard_ranges(shards: int, clusters: int) -> list:
+    """
+    Splits shard ids into contiguous, nearly equal ranges, one per cluster
+    """
+    per, extra = divmod(shards, clusters)
+    ranges, start = [], 0
+    for cluster in range(clusters):
+        size = per + (1 if cluster < extra else 0)
+        ranges.append(list(range(start, start + size)))
+        start += size
+    return [shard_ids for shard_ids in ranges if shard_ids]
+
+
+def parse_metrics(text: str) -> dict:
+    """
+    Parses Prometheus text into {metric name: [(labels dict, value)]}
+    """
+    samples = {}
+    for line in text.splitlines():
+        match = SAMPLE.match(line)
+        if match is None:
+            continue
+        name, labels, value = match.groups()
+        labels = dict(LABEL.findall(labels or ""))
+        samples.setdefault(name, []).append((labels, float(value)))
+    return samples
+
+
+def histogram_quantile(samples: dict, name: str, q: float) -> float:
+    """
+    Gets the bucket upper bound holding the q quantile of a histogram, 0 if it is empty
+    """
+    buckets = sorted((float(labels["le"]), value) for labels, value in samples.get(f"{name}_bucket", ()))
+    if not buckets or not buckets[-1][1]:
+        return 0.0
+    rank = q * buckets[-1][1]
+    return next(bound for bound, count in buckets if count >= rank)
+
+
+async def recommended_shards(token: str) -> int:
+    """
+    Asks Discord how many shards the bot should run
+    """
+    headers = {"Authorization": f"Bot {token}"}
+    async with aiohttp.ClientSession() as session:
+        async with session.get(GATEWAY_BOT_URL, headers=headers) as response:
+            response.raise_for_status()
+            return (await response.json())["shards"]
+
+
+class Cluster(object):
+    """
+    One bot process running a range of shards
+    """
+    def __init__(self, cluster_id: int, shard_ids: list, shard_count: int, metrics_port: int) -> None:
+        self.cluster_id = cluster_id
+        self.shard_ids = shard_ids
+        self.shard_count = shard_count
+        self.metrics_port = metrics_port
+        # Running process, None between restarts
+        self.process = None
+        self.started = 0.0
+        self.restarts = 0
+        self.backoff = RESTART_BACKOFF
+
+    def env(self) -> dict:
+        """
+        Gets the environment that tells the bot which shards it owns
+        """
+        env = dict(os.environ)
+        env.update({
+            "SHARD_COUNT": str(self.shard_count),
+            "SHARD_IDS": ",".join(map(str, self.shard_ids)),
+            "CLUSTER_ID": str(self.cluster_id),
+            "METRICS_PORT": str(self.metrics_port),
+            "METRICS_HOST": "127.0.0.1",
+        })
+        return env
+
+    @property
+    def name(self) -> str:
+        return f"cluster {self.cluster_id} (shards {self.shard_ids[0]}-{self.shard_ids[-1]})"
+
+
+class ClusterLauncher(object):
+    """
+    Runs one bot process per cluster, restarts crashed ones and reports their health
+    """
+    def __init__(self, clusters: list, logger, report_interval: float = 30.0) -> None:
+        self.clusters = clusters
+        self.logger = logger
+        self.report_interval = report_interval
+        self._stopping = False
+
+    async def run(self) -> None:
+        """
+        Supervises every cluster until stopped
+        """
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, self.stop)
+        supervisors = [loop.create_task(self._supervise(cluster)) for cluster in self.clusters]
+        reporter = loop.create_task(self._report())
+        await asyncio.gather(*supervisors)
+        reporter.cancel()
+
+    def stop(self) -> None:
+        """
+        Stops every cluster without restarting it
+        """
+        if self._stopping:
+            return
+        self._stopping = True
+        self.logger.info("Stopping clusters...")
+        for cluster in self.clusters:
+            if cluster.process is not None and cluster.process.returncode is None:
+                cluster.process.terminate()
+
+    async def _supervise(self, cluster: Cluster) -> None:
+        """
+        Keeps one cluster running, restarting it with backoff after crashes
+        """
+        while not self._stopping:
+            cluster.process = await asyncio.create_subprocess_exec(sys.executable, "main.py", env=cluster.env())
+            cluster.started = time.monotonic()
+            self.logger.info(f"Started {cluster.name} as pid {cluster.process.pid}")
+            code = await cluster.process.wait()
+            if self._stopping:
+                break
+            if time.monotonic() - cluster.started > STABLE_AFTER:
+                cluster.backoff = RESTART_BACKOFF
+            cluster.restarts += 1
+            self.logger.error(f"{cluster.name} exited with code {code}, restarting in {cluster.backoff:.0f}s")
+            await asyncio.sleep(cluster.backoff)
+            cluster.backoff = min(cluster.backoff * 2, RESTART_BACKOFF_MAX)
+
+    async def _report(self) -> None:
+        """
+        Logs a health and lag summary of every cluster at each interval
+        """
+        timeout = aiohttp.ClientTimeout(total=5)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            while True:
+                await asyncio.sleep(self.report_interval)
+                summaries = await asyncio.gather(*(self._health(session, cluster) for cluster in self.clusters))
+                for summary in summaries:
+                    self.logger.info(summary)
+
+    async def _health(self, session: aiohttp.ClientSession, cluster: Cluster) -> str:
+        """
+        Summarizes one cluster from its metrics endpoint
+        """
+        process = cluster.process
+        if process is None or process.returncode is not None:
+            return f"{cluster.name}: DOWN, {cluster.restarts} restarts"
+        uptime = time.monotonic() - cluster.started
+        try:
+            async with session.get(f"http://127.0.0.1:{cluster.metrics_port}/metrics") as response:
+                samples = parse_metrics(await response.text())
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return f"{cluster.name}: pid {process.pid}, up {uptime:.0f}s, metrics unreachable (starting or stalled)"
+        value = lambda name: sum(sample for _, sample in samples.get(f"audiobot_{name}", ()))
+        latencies = [sample for _, sample in samples.get("audiobot_gateway_latency_seconds", ()) if sample == sample]
+        lag_count = value("loop_lag_seconds_count")
+        lag_mean = value("loop_lag_seconds_sum") / lag_count if lag_count else 0.0
+        lag_p99 = histogram_quantile(samples, "audiobot_loop_lag_seconds", 0.99)
+        gateway = f"{max(latencies) * 1000:.0f} ms" if latencies else "n/a"
+        return (
+            f"{cluster.name}: pid {process.pid}, up {uptime:.0f}s, {cluster.restarts} restarts, "
+            f"{value('guilds'):.0f} guilds, {value('voice_connections'):.0f} voice, "
+            f"gateway max {gateway}, loop lag mean {lag_mean * 1000:.1f} ms p99 <= {lag_p99 * 1000:.0f} ms"
+        )
+
+
+def main() -> None:
+    """
+    Runs the bot as several processes, each owning a range of shards
+    """
+    parser = argparse.ArgumentParser(description="Run the bot as a cluster of sharded processes.")
+    parser.add_argument("--clusters", type=int, default=os.cpu_count() or 1, help="bot processes to run")
+    parser.add_argument("--shards", type=int, default=None, help="total shards (default: Discord's recommendation)")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_BASE_PORT, help="metrics port of the first cluster")
+    parser.add_argument("--report-interval", type=float, default=30.0, help="seconds between health reports")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)-8s %(name)s  %(message)s")
+    logger = logging.getLogger("AudioBot.cluster")
+    shards = args.shards
+    if shards is None:
+        shards = asyncio.run(recommended_shards(load_token(logger)))
+        logger.info(f"Discord recommends {shards} shards")
+    ranges = shard_ranges(shards, max(1, args.clusters))
+    clusters = [
+        Cluster(cluster_id, shard_ids, shards, args.metrics_port + cluster_id)
+        for cluster_id, shard_ids in enumerate(ranges)
+    ]
+    logger.info(f"Running {shards} shards in {len(clusters)} clusters")
+    asyncio.run(ClusterLauncher(clusters, logger, args.report_interval).run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,354 @@
+import mmap
+import os
+import subprocess
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import discord
+
+from utils import packs
+from utils.metrics import Histogram
+from utils.transcode import FFMPEG
+
+# Bytes of 16-bit 48 kHz stereo PCM in one 20 ms frame
+PCM_FRAME_SIZE = discord.opus.Encoder.FRAME_SIZE
+# 20 ms frames per second
+FRAMES_PER_SECOND = 50
+# Decoder started ahead of time: it waits for a sound on stdin and writes 48 kHz stereo PCM to stdout
+DECODER_ARGS = [
+    FFMPEG, "-hide_banner", "-loglevel", "error",
+    "-i", "pipe:0", "-vn", "-f", "s16le", "-ar", "48000", "-ac", "2", "pipe:1",
+]
+# Threads that wait for decoder slots and decode first frames, so neither happens on an audio thread
+PRIME_WORKERS = 32
+
+
+class AdmissionRejected(Exception):
+    """
+    Raised when every decoder slot is busy and the admission queue is full
+    """
+
+
+class Admission(object):
+    """
+    FFmpeg process budget shared by every guild: at most `limit` processes run, at most `max_waiting` decoders
+    wait for a slot
+
+    Waiting happens on audio and worker threads, never on the event loop.
+    """
+    def __init__(self, limit: int, max_waiting: int = 16, timeout: float = 10.0) -> None:
+        # Decoders allowed to run at once
+        self.limit = limit
+        # Decoders allowed to wait for a slot
+        self.max_waiting = max_waiting
+        # Seconds a decoder waits for a slot before giving up
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0
+        self._cond = threading.Condition()
+        # Seconds spent waiting for a slot
+        self.wait_latency = Histogram()
+        self.rejected = 0
+        self.timeouts = 0
+
+    @property
+    def saturated(self) -> bool:
+        """
+        Whether a new decoder would be rejected right now
+        """
+        return self.active >= self.limit and self.waiting >= self.max_waiting
+
+    def check(self) -> bool:
+        """
+        Turns away a new decode while saturated, so play can answer right away instead of failing later
+        """
+        if self.saturated:
+            self.rejected += 1
+            return False
+        return True
+
+    def try_acquire(self) -> bool:
+        """
+        Takes a slot if one is free, without waiting
+        """
+        with self._cond:
+            if self.active < self.limit and not self.waiting:
+                self.active += 1
+                self.wait_latency.observe(0.0)
+                return True
+            return False
+
+    def acquire(self) -> None:
+        """
+        Takes a slot, waiting in line for up to timeout seconds (blocking)
+        """
+        started = time.perf_counter()
+        with self._cond:
+            if self.active >= self.limit or self.waiting:
+                if self.waiting >= self.max_waiting:
+                    self.rejected += 1
+                    raise AdmissionRejected("too many sounds are decoding")
+                self.waiting += 1
+                try:
+                    admitted = self._cond.wait_for(lambda: self.active < self.limit, self.timeout)
+                finally:
+                    self.waiting -= 1
+                if not admitted:
+                    self.timeouts += 1
+                    raise AdmissionRejected(f"no decoder free after {self.timeout:.0f}s")
+            self.active += 1
+            self.wait_latency.observe(time.perf_counter() - started)
+
+    def acquire_background(self) -> None:
+        """
+        Takes a slot for background work (transcodes, loudness analysis) once playback leaves one spare
+        (blocking, no timeout)
+
+        Background work never queues ahead of playback and keeps one slot free for it when the budget allows.
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: not self.waiting and self.active < max(1, self.limit - 1))
+            self.active += 1
+
+    def release(self) -> None:
+        with self._cond:
+            self.active -= 1
+            # Background waiters only take a slot playback leaves, so wake them all
+            self._cond.notify_all()
+
+    def resize(self, limit: int, max_waiting: int, timeout: float) -> None:
+        with self._cond:
+            self.limit, self.max_waiting, self.timeout = limit, max_waiting, timeout
+            self._cond.notify_all()
+
+    def stats(self) -> dict:
+        return {
+            "active": self.active,
+            "waiting": self.waiting,
+            "limit": self.limit,
+            "utilization": self.active / self.limit if self.limit else 0.0,
+            "rejected": self.rejected,
+            "timeouts": self.timeouts,
+        }
+
+
+def input_view(path: str) -> memoryview:
+    """
+    Gets the bytes of a sound file or pack member as a memory-mapped view
+    """
+    view = packs.view(path)
+    if view is not None:
+        return view
+    with open(path, "rb") as f:
+        if not os.fstat(f.fileno()).st_size:
+            return memoryview(b"")
+        # The map stays open as long as the view does
+        return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+class DecoderPool(object):
+    """
+    Keeps a few FFmpeg decoders spawned and waiting on stdin so cache misses skip fork/exec
+    """
+    def __init__(self, admission: Admission, logger, warm: int = 2) -> None:
+        # Process budget each decode takes a slot of
+        self.admission = admission
+        # Bot logger
+        self.logger = logger
+        # Idle decoders kept ready, on top of the budget
+        self.warm = warm
+        self._idle = deque()
+        self._lock = threading.Lock()
+        self._refilling = False
+        self.closed = False
+        # Seconds to spawn a decoder
+        self.spawn_latency = Histogram()
+        # Decodes served by a warm or a freshly spawned decoder
+        self.starts = {"warm": 0, "cold": 0}
+        # Where sources wait for their slot and decode their first frames before playback reads them
+        self.executor = ThreadPoolExecutor(max_workers=PRIME_WORKERS, thread_name_prefix="decoder-prime")
+
+    def _spawn(self) -> subprocess.Popen:
+        started = time.perf_counter()
+        process = subprocess.Popen(DECODER_ARGS, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        with self._lock:
+            self.spawn_latency.observe(time.perf_counter() - started)
+        return process
+
+    def take(self) -> subprocess.Popen:
+        """
+        Gets a decoder waiting for input, spawning one if none is warm (blocking)
+        """
+        process = None
+        with self._lock:
+            while self._idle and process is None:
+                candidate = self._idle.popleft()
+                # Skip decoders that died while idle
+                if candidate.poll() is None:
+                    process = candidate
+            self.starts["warm" if process is not None else "cold"] += 1
+        self.refill()
+        return process if process is not None else self._spawn()
+
+    def refill(self) -> None:
+        """
+        Tops the warm decoders up in a background thread
+        """
+        with self._lock:
+            if self._refilling or self.closed or len(self._idle) >= self.warm:
+                return
+            self._refilling = True
+        threading.Thread(target=self._refill, daemon=True, name="decoder-pool-refill").start()
+
+    def _refill(self) -> None:
+        try:
+            while True:
+                with self._lock:
+                    if self.closed or len(self._idle) >= self.warm:
+                        return
+                try:
+                    process = self._spawn()
+                except OSError as e:
+                    self.logger.error(f"Failed to start warm decoder: {e}")
+                    return
+                with self._lock:
+                    self._idle.append(process)
+        finally:
+            with self._lock:
+                self._refilling = False
+
+    def resize(self, warm: int) -> None:
+        """
+        Changes how many decoders are kept warm
+        """
+        self.warm = warm
+        with self._lock:
+            extra = [self._idle.pop() for _ in range(max(0, len(self._idle) - warm))]
+        for process in extra:
+            process.kill()
+        self.refill()
+
+    def source(self, path: str, start: float = 0.0, offset: int = 0) -> "DecoderSource":
+        """
+        Builds a PCM source for a sound from a byte offset on; it takes its decoder once admitted
+        """
+        return DecoderSource(self, path, start, offset)
+
+    def stats(self) -> dict:
+        stats = self.admission.stats()
+        stats["warm"] = len(self._idle)
+        return stats
+
+    def close(self) -> None:
+        """
+        Kills the idle decoders
+        """
+        with self._lock:
+            self.closed = True
+            idle, self._idle = list(self._idle), deque()
+        for process in idle:
+            process.kill()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class DecoderSource(discord.AudioSource):
+    """
+    PCM from a pooled FFmpeg decoder, fed the sound on stdin; the leading silence is skipped in the output
+
+    The decoder starts in admit, which waits for a slot of the shared process budget and so must run in an
+    executor. A read before that only starts it if a slot is free right away, the audio thread never waits.
+    """
+    def __init__(self, pool: DecoderPool, path: str, start: float = 0.0, offset: int = 0) -> None:
+        self.pool = pool
+        self.path = path
+        # Byte offset of the first frame fed to the decoder, for seeking
+        self.offset = offset
+        # Whole frames of leading silence to drop
+        self._skip = int(start * FRAMES_PER_SECOND)
+        self._process = None
+        self._admitted = False
+        # Set once the decoder can't or mustn't start (again)
+        self._done = False
+        self._lock = threading.Lock()
+
+    def try_admit(self) -> bool:
+        """
+        Starts the decoder if a slot is free right away
+        """
+        with self._lock:
+            if self._process is not None:
+                return True
+            if self._done or not self.pool.admission.try_acquire():
+                return False
+            self._admitted = True
+            return self._start()
+
+    def admit(self) -> bool:
+        """
+        Waits for a slot and starts the decoder (blocking, never on the audio thread)
+        """
+        with self._lock:
+            if self._process is not None or self._done:
+                return not self._done
+            try:
+                self.pool.admission.acquire()
+            except AdmissionRejected as e:
+                self.pool.logger.warning(f"Not decoding `{self.path}`: {e}")
+                self._done = True
+                return False
+            self._admitted = True
+            return self._start()
+
+    def _start(self) -> bool:
+        try:
+            data = input_view(self.path)
+            if self.offset:
+                with data:
+                    data = data[self.offset:]
+            self._process = self.pool.take()
+        except OSError as e:
+            self.pool.logger.error(f"Failed to start decoder for `{self.path}`: {e}")
+            self._done = True
+            self._release()
+            return False
+        packs.feed(self._process, data)
+        return True
+
+    def read(self) -> bytes:
+        if self._process is None and not self.try_admit():
+            # Not admitted ahead of time and no slot free now
+            if not self._done:
+                self._done = True
+                self.pool.admission.rejected += 1
+                self.pool.logger.warning(f"Not decoding `{self.path}`: no decoder free")
+            return b""
+        stdout = self._process.stdout
+        while self._skip:
+            self._skip -= 1
+            if len(stdout.read(PCM_FRAME_SIZE)) != PCM_FRAME_SIZE:
+                return b""
+        data = stdout.read(PCM_FRAME_SIZE)
+        if len(data) != PCM_FRAME_SIZE:
+            return b""
+        return data
+
+    def is_opus(self) -> bool:
+        return False
+
+    def _release(self) -> None:
+        if self._admitted:
+            self._admitted = False
+            self.pool.admission.release()
+
+    def cleanup(self) -> None:
+        with self._lock:
+            self._done = True
+            process, self._process = self._process, None
+            if process is not None:
+                process.kill()
+                process.stdout.close()
+                # Reap in the background, the audio thread must not wait
+                threading.Thread(target=process.wait, daemon=True).start()
+            self._release()
@@ -0,0 +1,282 @@
+import argparse
+import hashlib
+import json
+import logging
+import mmap
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import packs
+
+# Sidecar store of content hashes
+FINGERPRINT_FILE = "data/audio/cache/fingerprints.json"
+# Bytes fed to the hash per update; blake2b releases the GIL on large updates so threads hash in parallel
+HASH_CHUNK = 4 * 1024 * 1024
+# Threads hashing at once
+HASH_WORKERS = min(8, os.cpu_count() or 1)
+
+
+def content_hash(path: str) -> str:
+    """
+    Hashes the contents of a file or pack member through a read-only memory map
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    member = packs.view(path)
+    if member is not None:
+        # Pack members are already mapped
+        with member:
+            for offset in range(0, len(member), HASH_CHUNK):
+                digest.update(member[offset:offset + HASH_CHUNK])
+        return digest.hexdigest()
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        # Empty files can't be mapped
+        if size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                with memoryview(mapped) as view:
+                    for offset in range(0, size, HASH_CHUNK):
+                        digest.update(view[offset:offset + HASH_CHUNK])
+    return digest.hexdigest()
+
+
+def file_size(path: str) -> int:
+    try:
+        return packs.stat(path).st_size
+    except OSError:
+        return 0
+
+
+class Fingerprints(object):
+    """
+    Content hashes of sound files keyed by path, rehashed only when a file's size or mtime changes
+    """
+    def __init__(self, path: str, logger, workers: int = HASH_WORKERS, readonly: bool = False) -> None:
+        # Sidecar file
+        self.path = path
+        # Bot logger
+        self.logger = logger
+        # Threads used by hash_all
+        self.workers = workers
+        # Read-only stores never hash and pick up what the writing process saves
+        self.readonly = readonly
+        # Sound path -> (size, mtime_ns, content hash)
+        self._entries = {}
+        # Hashes are added from executor threads while forget walks the entries
+        self._lock = threading.Lock()
+        # Sidecar mtime when last loaded
+        self._mtime = None
+        self._load()
+
+    """ ------------------------------------------ Storage ------------------------------------------------ """
+    def _load(self) -> None:
+        """
+        Reads stored hashes so restarts don't rehash the library
+        """
+        try:
+            self._mtime = os.stat(self.path).st_mtime_ns
+            with open(self.path) as f:
+                self._entries = {path: tuple(entry) for path, entry in json.load(f).items()}
+        except FileNotFoundError:
+            self._entries = {}
+        except (ValueError, OSError) as e:
+            self.logger.error(f"Failed to read fingerprints: {e}")
+            self._entries = {}
+
+    def reload(self) -> bool:
+        """
+        Re-reads hashes if another process saved new ones, returns whether it did
+        """
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            return False
+        if mtime == self._mtime:
+            return False
+        self._load()
+        return True
+
+    def save(self) -> None:
+        """
+        Writes hashes to disk
+        """
+        if self.readonly:
+            return
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        temp = self.path + ".tmp"
+        with open(temp, "w") as f:
+            with self._lock:
+                entries = self._entries.copy()
+            json.dump(entries, f)
+        os.replace(temp, self.path)
+        self._mtime = os.stat(self.path).st_mtime_ns
+
+    """ ------------------------------------------ Hashing ------------------------------------------------ """
+    def _current(self, path: str, stat) -> str:
+        entry = self._entries.get(path)
+        if entry is None or entry[0] != stat.st_size or entry[1] != stat.st_mtime_ns:
+            return None
+        return entry[2]
+
+    def cached(self, path: str) -> str:
+        """
+        Gets the content hash of a sound if it is known and current, without reading the file
+        """
+        try:
+            return self._current(path, packs.stat(path))
+        except OSError:
+            return None
+
+    def hash_of(self, path: str) -> str:
+        """
+        Gets the content hash of a sound, hashing it only if its size or mtime changed (blocking)
+        """
+        stat = packs.stat(path)
+        digest = self._current(path, stat)
+        if digest is None:
+            digest = content_hash(path)
+            with self._lock:
+                self._entries[path] = (stat.st_size, stat.st_mtime_ns, digest)
+        return digest
+
+    def hash_all(self, paths) -> dict:
+        """
+        Hashes every new or changed sound in parallel and returns {path: content hash} (blocking)
+        """
+        digests, stale = {}, []
+        for path in paths:
+            try:
+                stat = packs.stat(path)
+            except OSError:
+                continue
+            digest = self._current(path, stat)
+            if digest is not None:
+                digests[path] = digest
+            elif not self.readonly:
+                stale.append((path, stat))
+        if not stale:
+            return digests
+
+        def run(item):
+            path, stat = item
+            try:
+                return path, stat, content_hash(path)
+            except OSError as e:
+                self.logger.error(f"Failed to hash `{path}`: {e}")
+                return path, stat, None
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for path, stat, digest in pool.map(run, stale):
+                if digest is None:
+                    continue
+                with self._lock:
+                    self._entries[path] = (stat.st_size, stat.st_mtime_ns, digest)
+                digests[path] = digest
+        self.logger.info(f"Hashed {len(stale)} new or changed sounds")
+        return digests
+
+    def forget(self, keep) -> int:
+        """
+        Drops the hashes of every path not in keep, returns how many were dropped
+        """
+        keep = set(keep)
+        with self._lock:
+            gone = [path for path in self._entries if path not in keep]
+            for path in gone:
+                del self._entries[path]
+        return len(gone)
+
+    """ ------------------------------------------ Deduplication ------------------------------------------------ """
+    @staticmethod
+    def groups(digests: dict) -> dict:
+        """
+        Groups paths by content hash, keeping only hashes shared by several paths
+        """
+        groups = {}
+        for path, digest in digests.items():
+            groups.setdefault(digest, []).append(path)
+        return {digest: sorted(paths) for digest, paths in groups.items() if len(paths) > 1}
+
+
+def artifact_sizes(cache_dir: str) -> dict:
+    """
+    Gets the bytes of cached artifacts per content hash, from files named <hash>[.variant].ext
+    """
+    sizes = {}
+    try:
+        entries = os.scandir(cache_dir)
+    except OSError:
+        return sizes
+    with entries:
+        for entry in entries:
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                digest = entry.name.split(".", 1)[0]
+                sizes[digest] = sizes.get(digest, 0) + entry.stat().st_size
+    return sizes
+
+
+def dedup_report(digests: dict, artifacts: dict = None) -> dict:
+    """
+    Summarizes how much storage sharing one copy per content hash saves
+    """
+    groups = Fingerprints.groups(digests)
+    artifacts = artifacts or {}
+    # Every copy past the first would have been cached again under its own path
+    extra = {digest: len(paths) - 1 for digest, paths in groups.items()}
+    return {
+        "sounds": len(digests),
+        "distinct": len(set(digests.values())),
+        "duplicate_groups": len(groups),
+        "duplicate_files": sum(extra.values()),
+        "duplicate_source_bytes": sum(file_size(groups[digest][0]) * count for digest, count in extra.items()),
+        "reclaimed_artifact_bytes": sum(artifacts.get(digest, 0) * count for digest, count in extra.items()),
+        "groups": groups,
+    }
+
+
+def format_report(report: dict) -> str:
+    """
+    Formats the one-line summary of a dedup report
+    """
+    mib = 1024 * 1024
+    return (
+        f"{report['sounds']} sounds, {report['distinct']} distinct; {report['duplicate_files']} duplicates in "
+        f"{report['duplicate_groups']} groups ({report['duplicate_source_bytes'] / mib:.1f} MiB of source), "
+        f"{report['reclaimed_artifact_bytes'] / mib:.1f} MiB of cached artifacts shared"
+    )
+
+
+def main() -> None:
+    """
+    Fingerprints the library and reports duplicate sounds and the space sharing their artifacts reclaims
+    """
+    parser = argparse.ArgumentParser(description="Find byte-identical sounds and report the space deduplication saves.")
+    parser.add_argument("--sounds", default="data/audio/sounds", help="sound library directory")
+    parser.add_argument("--packs", default=packs.PACKS_DIR, help="sound pack directory")
+    parser.add_argument("--store", default=FINGERPRINT_FILE, help="fingerprint sidecar file")
+    parser.add_argument("--cache", default="data/audio/cache/opus", help="transcode cache directory")
+    parser.add_argument("--jobs", type=int, default=HASH_WORKERS, help="parallel hashing threads")
+    parser.add_argument("--verbose", action="store_true", help="list every duplicate group")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)-8s %(message)s")
+    logger = logging.getLogger("AudioBot")
+    # Imported here, the transcode module builds on this one
+    from utils.transcode import sound_paths
+    store = Fingerprints(args.store, logger, workers=args.jobs)
+    paths = [*sound_paths(args.sounds), *packs.pack_sound_paths(args.packs)]
+    digests = store.hash_all(paths)
+    store.forget(paths)
+    store.save()
+
+    report = dedup_report(digests, artifact_sizes(args.cache))
+    logger.info(format_report(report))
+    if args.verbose:
+        for digest, group in report["groups"].items():
+            print(f"{digest}:")
+            for path in group:
+                print(f"    {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,267 @@
+import asyncio
+import subprocess
+from array import array
+from collections import OrderedDict
+
+import discord
+from discord.oggparse import OggStream
+
+from utils import packs
+from utils.transcode import FFMPEG, OPUS_HEADERS, profile_args
+
+# Bytes of 16-bit 48 kHz stereo PCM in one 20 ms frame
+PCM_FRAME_SIZE = discord.opus.Encoder.FRAME_SIZE
+# 20 ms frames per second
+FRAMES_PER_SECOND = 50
+
+
+class Clip(object):
+    """
+    A whole clip held in one contiguous buffer of Opus packets or PCM frames
+    """
+    __slots__ = ("data", "offsets", "opus")
+
+    def __init__(self, data: bytes, offsets: array = None) -> None:
+        # Contiguous audio data
+        self.data = data
+        # Packet start offsets (plus the end offset) for Opus, None for PCM
+        self.offsets = offsets
+        # Whether data holds Opus packets
+        self.opus = offsets is not None
+
+    @property
+    def frames(self) -> int:
+        return len(self.offsets) - 1 if self.opus else len(self.data) // PCM_FRAME_SIZE
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.data) + (self.offsets.itemsize * len(self.offsets) if self.opus else 0)
+
+
+class ClipSource(discord.AudioSource):
+    """
+    Serves 20 ms frames of a cached clip without a subprocess
+
+    Opus packets are zero-copy memoryview slices. PCM frames are copied to bytes
+    because discord.py's Opus encoder only accepts bytes.
+    """
+    def __init__(self, clip: Clip) -> None:
+        self.clip = clip
+        self._view = memoryview(clip.data)
+        self._frame = 0
+
+    def read(self) -> bytes:
+        frame = self._frame
+        if frame >= self.clip.frames:
+            return b""
+        self._frame += 1
+        if self.clip.opus:
+            offsets = self.clip.offsets
+            return self._view[offsets[frame]:offsets[frame + 1]]
+        start = frame * PCM_FRAME_SIZE
+        return self._view[start:start + PCM_FRAME_SIZE].tobytes()
+
+    def is_opus(self) -> bool:
+        return self.clip.opus
+
+
+def read_opus_clip(path: str, max_frames: int) -> Clip:
+    """
+    Reads the packets of a transcoded Ogg/Opus file into one buffer, or None if it is too long
+    """
+    data = bytearray()
+    offsets = array("I", [0])
+    with open(path, "rb") as f:
+        for packet in OggStream(f).iter_packets():
+            if packet[:8] in OPUS_HEADERS:
+                continue
+            if len(offsets) > max_frames:
+                return None
+            data += packet
+            offsets.append(len(data))
+    return Clip(bytes(data), offsets)
+
+
+def read_pcm_clip(path: str, max_frames: int, gain_db: float = 0.0, start: float = 0.0) -> Clip:
+    """
+    Decodes a sound to PCM in one buffer padded to whole frames, or None if it is too long
+    """
+    limit = max_frames * PCM_FRAME_SIZE
+    # Bake the loudness gain and silence trim into the decoded frames
+    seek, gain = profile_args(gain_db, start)
+    source, member = packs.ffmpeg_input(path)
+    args = [
+        FFMPEG, "-nostdin", "-hide_banner", "-loglevel", "error",
+        *seek, "-i", source, "-vn", *gain, "-f", "s16le", "-ar", "48000", "-ac", "2", "pipe:1",
+    ]
+    stdin = subprocess.PIPE if member is not None else subprocess.DEVNULL
+    with subprocess.Popen(args, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL) as process:
+        if member is not None:
+            # Pack members are fed from the mapped archive while the output is read
+            packs.feed(process, member)
+        # Read one byte past the limit to detect long clips without decoding them fully
+        data = process.stdout.read(limit + 1)
+        process.kill()
+    if not data or len(data) > limit:
+        return None
+    remainder = len(data) % PCM_FRAME_SIZE
+    if remainder:
+        data += bytes(PCM_FRAME_SIZE - remainder)
+    return Clip(data)
+
+
+class FrameCache(object):
+    """
+    Byte-budgeted LRU cache of short clips keyed by content hash, so byte-identical sounds share one clip
+
+    The loudness gain and silence trim baked into a clip are part of its key, so a clip cached before its
+    sound was measured is replaced once the measurement exists.
+    """
+    def __init__(self, logger, budget: int = 64 * 1024 * 1024, max_seconds: float = 5.0, admission=None) -> None:
+        # Bot logger
+        self.logger = logger
+        # Shared FFmpeg process budget, PCM decodes only run when a slot is free
+        self.admission = admission
+        # Total bytes the cache may hold
+        self.budget = budget
+        # Longest clip that is worth caching
+        self.max_frames = int(max_seconds * FRAMES_PER_SECOND)
+        # (content hash, gain dB, start offset) -> Clip, least recently used first
+        self._clips = OrderedDict()
+        # Keys of clips known to be too long
+        self._rejected = set()
+        # Keys being loaded in the background
+        self._loading = set()
+        # Bytes currently held
+        self.size = 0
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def peek(self, digest: str, gain_db: float = 0.0, start: float = 0.0) -> Clip:
+        """
+        Gets the cached clip of a content hash and loudness profile without counting a lookup, or None
+        """
+        return self._clips.get((digest, gain_db, start)) if digest is not None else None
+
+    def get(self, digest: str, gain_db: float = 0.0, start: float = 0.0) -> ClipSource:
+        """
+        Gets a frame source for the cached clip of a content hash and loudness profile, or None on a miss
+        """
+        key = (digest, gain_db, start)
+        clip = self._clips.get(key) if digest is not None else None
+        if clip is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._clips.move_to_end(key)
+        return ClipSource(clip)
+
+    def put(self, key: tuple, clip: Clip) -> None:
+        """
+        Stores a clip under (content hash, gain dB, start offset), dropping clips of the same sound made with
+        another profile, and evicts the least recently used ones over budget
+        """
+        if clip.nbytes > self.budget:
+            return
+        for stale in [other for other in self._clips if other[0] == key[0]]:
+            self.size -= self._clips.pop(stale).nbytes
+        self._clips[key] = clip
+        self.size += clip.nbytes
+        self._evict()
+
+    def resize(self, budget: int, max_seconds: float) -> None:
+        """
+        Changes the byte budget and longest cached clip, evicting what no longer fits
+        """
+        max_frames = int(max_seconds * FRAMES_PER_SECOND)
+        if max_frames > self.max_frames:
+            # Clips rejected as too long may fit now
+            self._rejected.clear()
+        self.max_frames = max_frames
+        self.budget = budget
+        for key in [key for key, clip in self._clips.items() if clip.frames > max_frames]:
+            self.size -= self._clips.pop(key).nbytes
+        self._evict()
+
+    def _evict(self) -> None:
+        """
+        Evicts least recently used clips until the cache fits its budget
+        """
+        while self.size > self.budget:
+            _, evicted = self._clips.popitem(last=False)
+            self.size -= evicted.nbytes
+            self.evictions += 1
+
+    @staticmethod
+    def read(path: str, opus_path: str, max_frames: int, gain_db: float, start: float) -> Clip:
+        """
+        Reads a clip from its Opus transcode if there is one, otherwise decodes it to PCM (blocking)
+        """
+        if opus_path is not None:
+            # Transcodes already have the gain and trim baked in
+            return read_opus_clip(opus_path, max_frames)
+        return read_pcm_clip(path, max_frames, gain_db, start)
+
+    async def load(self, digest: str, path: str, opus_path: str = None, gain_db: float = 0.0, start: float = 0.0) -> bool:
+        """
+        Loads the short clip of a content hash, with a loudness gain and start offset, into the cache off the event loop
+        """
+        if digest is None:
+            # Not fingerprinted yet
+            return False
+        key = (digest, gain_db, start)
+        if key in self._clips:
+            return True
+        if key in self._rejected or key in self._loading:
+            return False
+        # Decoding to PCM needs FFmpeg, skip it while playback uses every slot; the next play retries
+        decoding = opus_path is None and self.admission is not None
+        if decoding and not self.admission.try_acquire():
+            return False
+        self._loading.add(key)
+        try:
+            loop = asyncio.get_running_loop()
+            clip = await loop.run_in_executor(None, self.read, path, opus_path, self.max_frames, gain_db, start)
+        except (OSError, ValueError) as e:
+            self.logger.error(f"Failed to cache `{path}`: {e}")
+            return False
+        finally:
+            self._loading.discard(key)
+            if decoding:
+                self.admission.release()
+        if clip is None:
+            # Too long to be worth caching
+            self._rejected.add(key)
+            return False
+        self.put(key, clip)
+        return True
+
+    async def preload(self, sounds: list) -> int:
+        """
+        Loads a list of (content hash, path, opus path, gain dB, start offset) tuples, most important first,
+        until the budget is full
+        """
+        loaded = 0
+        for digest, path, opus_path, gain_db, start in sounds:
+            if self.size >= self.budget:
+                break
+            loaded += await self.load(digest, path, opus_path, gain_db, start)
+        self.logger.info(f"Preloaded {loaded} clips into frame cache ({self.size // 1024} KiB)")
+        return loaded
+
+    def stats(self) -> dict:
+        """
+        Gets cache counters
+        """
+        lookups = self.hits + self.misses
+        return {
+            "clips": len(self._clips),
+            "bytes": self.size,
+            "budget": self.budget,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
@@ -3,7 +3,6 @@ import logging
 import os
 import platform
 
-import coloredlogs
 import discord
 from discord.ext.commands import Bot as BotBase
 
@@ -48,72 +47,46 @@ async def delete_messages(logger, *messages, wait: int = 1):
         except Exception as e:
             logger.error(f"Error deleting message: {e}")
             
-async def send_basic_message(logger, ctx, message_content, wait: int = 15):
+async def send_basic_message(logger, ctx, message_content, wait: int = 15, coalesce: bool = False, view=None):
     """
-    Sends a message and deletes the command and sent message after a specified delay.
+    Sends a message and schedules the command and sent message for deletion after a specified delay.
+    Status lines sent with coalesce may be merged with other pending lines for the same channel.
     """
-    # Send the message
-    sent_message = await ctx.send(message_content)
-    # Delete the command and sent message after 15 seconds
-    await delete_messages(logger, ctx.message, sent_message, wait=wait)
+    # Send the message through the rate limited outbox
+    sent_message = await ctx.bot.outbox.send(ctx.channel, message_content, coalesce=coalesce, view=view)
+    # Let the bot's cleanup scheduler delete both messages later
+    ctx.bot.cleanup.schedule(ctx.message, sent_message, wait=wait)
+    return sent_message
     
 
 """ ------------------------------------------ Other Funcs ------------------------------------------------ """
 def load_logger():
 	"""
-	Load logger with coloredlogs
+	Load logger, records are formatted and written by a background thread
 	"""
-	# Create logger
-	logger = logging.getLogger("AudioBot")
-
-	# Define custom styles for log levels
-	level_styles = {
-		'debug': {'color': 'blue'},
-		'info': {'color': 'white'},
-		'warning': {'color': 'yellow'},
-		'error': {'color': 'red'},
-		'critical': {'color': 'red', 'bold': True},
-	}
-
-	# Define custom styles for fields (like the timestamp and logger name)
-	field_styles = {
-		'asctime': {'color': 'white'},
-		'name': {'color': 'magenta', 'bold': False},
-		'levelname': {'color': 'cyan', 'bold': False},
-	}
-
-	# Install coloredlogs with custom styles
-	coloredlogs.install(
-		level='DEBUG',
-		logger=logger,
-		fmt="%(asctime)s %(levelname)-8s %(name)s  %(message)s",
-		level_styles=level_styles,
-		field_styles=field_styles
-	)
-
-	# Remove duplicate handlers from discord logger
-	discord_logger = logging.getLogger("discord")
-	discord_logger.handlers.clear()
-	discord_logger.propagate = False
-
-	return logger
+	from utils import logs
+
+	# Route the bot and discord loggers through the logging queue
+	return logs.pipeline.install()
 
 
 def load_token(logger):
 	"""
 	Load discord bot token from environment variable or .toml file
 	"""
-	# Load bot token
-	DISCORD_TOKEN = os.getenv('DISCORD_BOT_TOKEN', None)
+	from utils import settings
+
+	# DISCORD_BOT_TOKEN overrides the [General] DiscordBotToken setting
+	try:
+		DISCORD_TOKEN = settings.load().discord_bot_token
+	except settings.ConfigError:
+		logger.error("Failed to load bot token. Check your environment variable or .toml file.", exc_info=True)
+		raise
 
 	if DISCORD_TOKEN is None:
-		from utils import settings
-		try:
-			logger.info("Checking TOML configuration...")
-			DISCORD_TOKEN = settings.config["General"]["DiscordBotToken"]
-			logger.info(f"Bot token loaded: {DISCORD_TOKEN[:5]}...{DISCORD_TOKEN[-5:]}")
-		except (TypeError, AttributeError) as e:
-			logger.error("Failed to load bot token. Check your environment variable or .toml file.", exc_info=True)
-			raise
-
-	return DISCORD_TOKEN
\ No newline at end of file
+		logger.error("No bot token found. Set DISCORD_BOT_TOKEN or DiscordBotToken in config.toml.")
+		raise settings.ConfigError("missing bot token")
+	if os.getenv('DISCORD_BOT_TOKEN') is None:
+		logger.info(f"Bot token loaded: {DISCORD_TOKEN[:5]}...{DISCORD_TOKEN[-5:]}")
+
+	return DISCORD_TOKEN
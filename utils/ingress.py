@@ -0,0 +1,54 @@
+import discord
+
+# Text prefix accepted next to mentions
+PREFIX = "<AudioBot> "
+
+
+def intents(message_content: bool = True) -> discord.Intents:
+    """
+    Gets the gateway intents voice commands need, and nothing else
+    """
+    flags = discord.Intents.none()
+    # Guild, channel and role state
+    flags.guilds = True
+    # Who is in which voice channel
+    flags.voice_states = True
+    # Commands arrive as guild messages; DMs are never commands
+    flags.guild_messages = True
+    # Messages mentioning the bot carry their content anyway, the text prefix needs the privileged intent
+    flags.message_content = message_content
+    return flags
+
+
+def member_cache_flags() -> discord.MemberCacheFlags:
+    """
+    Caches only members in voice channels, never the whole member list
+    """
+    flags = discord.MemberCacheFlags.none()
+    flags.voice = True
+    return flags
+
+
+class CommandFilter(object):
+    """
+    Precompiled check that throws away messages which can't be commands before any context is built
+    """
+    def __init__(self, prefix: str = PREFIX) -> None:
+        # Text prefix
+        self.prefix = prefix
+        # Mention and text prefixes as get_prefix returns them, set once the bot user is known
+        self.prefixes = None
+        self._starts = None
+
+    def bind(self, user_id: int) -> None:
+        """
+        Builds the prefixes for the logged in bot user, the same ones when_mentioned_or gives
+        """
+        self.prefixes = [f"<@{user_id}> ", f"<@!{user_id}> ", self.prefix]
+        self._starts = tuple(self.prefixes)
+
+    def accepts(self, message) -> bool:
+        """
+        Whether a message could be a command; a single startswith over every prefix
+        """
+        return self._starts is not None and message.content.startswith(self._starts) and not message.author.bot
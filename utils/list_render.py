@@ -0,0 +1,96 @@
+import os
+
+from utils.outbound import MAX_MESSAGE_LENGTH
+from utils.sound_index import SOUND_EXT
+
+# Room kept for the page header and code fence
+PAGE_OVERHEAD = 64
+
+
+def render_lines(index, top: str, expand_all: bool) -> list:
+    """
+    Renders the tree lines of the root files (top == "") or of one top-level directory
+    """
+    lines = []
+    if top == "":
+        listing = index.listing("")
+        # Top-level files are always shown, without indentation
+        return [file[:-len(SOUND_EXT)] for file in listing[1]] if listing else []
+    for rel, _, files in index.walk(top):
+        # Calculate the level of indentation
+        level = rel.count(os.sep) + 1
+        indent = ' ' * 4 * (level) if level > 1 else ''
+        lines.append(f"{indent}{os.path.basename(rel)}/")
+        # Add files only when expanded
+        if expand_all:
+            sub_indent = ' ' * 4 * (level)
+            lines.extend(f"{sub_indent}{file[:-len(SOUND_EXT)]}" for file in files)
+    return lines
+
+
+def paginate(lines: list, limit: int) -> list:
+    """
+    Packs lines into page bodies no longer than limit
+    """
+    pages, page, length = [], [], 0
+    for line in lines:
+        # A single line never spans pages
+        line = line[:limit]
+        if page and length + 1 + len(line) > limit:
+            pages.append("\n".join(page))
+            page, length = [], 0
+        length += len(line) + (1 if page else 0)
+        page.append(line)
+    if page:
+        pages.append("\n".join(page))
+    return pages
+
+
+class TreeRenderer(object):
+    """
+    Caches the rendered sound tree per top-level entry and splits it into message-sized pages
+    """
+    def __init__(self, index, limit: int = MAX_MESSAGE_LENGTH) -> None:
+        # Sound index the tree comes from
+        self.index = index
+        # Longest page body
+        self.limit = limit - PAGE_OVERHEAD
+        # (top-level dir, expand) -> rendered lines
+        self._blocks = {}
+        # expand -> page bodies
+        self._pages = {}
+        index.add_listener(self.invalidate)
+
+    def invalidate(self, rels) -> None:
+        """
+        Drops the cached blocks of changed directories
+        """
+        for rel in rels:
+            top = rel.split(os.sep, 1)[0]
+            self._blocks.pop((top, True), None)
+            self._blocks.pop((top, False), None)
+        # Pages are cheap to rebuild from the cached blocks
+        self._pages.clear()
+
+    def _block(self, top: str, expand_all: bool) -> list:
+        """
+        Gets the rendered lines of one top-level entry
+        """
+        key = (top, expand_all)
+        lines = self._blocks.get(key)
+        if lines is None:
+            lines = self._blocks[key] = render_lines(self.index, top, expand_all)
+        return lines
+
+    def pages(self, expand_all: bool) -> list:
+        """
+        Gets the page bodies of the whole tree
+        """
+        pages = self._pages.get(expand_all)
+        if pages is None:
+            listing = self.index.listing("")
+            lines = list(self._block("", expand_all))
+            for name in (listing[0] if listing else ()):
+                lines.extend(self._block(name, expand_all))
+            pages = self._pages[expand_all] = paginate(lines, self.limit)
+        return pages
@@ -0,0 +1,222 @@
+import atexit
+import json
+import logging
+import queue
+import sys
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+import coloredlogs
+
+# Loggers routed through the pipeline
+LOGGERS = ("AudioBot", "discord")
+# Log line layout of the text format
+LOG_FORMAT = "%(asctime)s %(levelname)-8s %(name)s  %(message)s"
+# Level names accepted in the config
+LEVELS = ("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL")
+# Output formats
+FORMATS = ("text", "json")
+# Records waiting for the writer thread; past this they are dropped instead of blocking the event loop
+QUEUE_SIZE = 10000
+# Distinct messages the sampler tracks before forgetting expired ones
+SAMPLER_KEYS = 1024
+
+# Custom styles for log levels
+LEVEL_STYLES = {
+    'debug': {'color': 'blue'},
+    'info': {'color': 'white'},
+    'warning': {'color': 'yellow'},
+    'error': {'color': 'red'},
+    'critical': {'color': 'red', 'bold': True},
+}
+# Custom styles for fields (like the timestamp and logger name)
+FIELD_STYLES = {
+    'asctime': {'color': 'white'},
+    'name': {'color': 'magenta', 'bold': False},
+    'levelname': {'color': 'cyan', 'bold': False},
+}
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats each record as one JSON object per line for log shippers
+    """
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        suppressed = getattr(record, "suppressed", 0)
+        if suppressed:
+            entry["suppressed"] = suppressed
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Lets the first `burst` copies of a message through per window and drops the rest,
+    reporting how many were dropped on the next copy that passes
+    """
+    def __init__(self, burst: int = 5, window: float = 60.0) -> None:
+        super().__init__()
+        # Copies of one message let through per window, 0 turns sampling off
+        self.burst = burst
+        # Window length in seconds
+        self.window = window
+        # (logger, level, message) -> [window start, copies seen, copies dropped]
+        self._seen = {}
+        # Records come from executor threads too
+        self._lock = threading.Lock()
+        # Records dropped since startup
+        self.dropped = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.burst <= 0:
+            return True
+        key = (record.name, record.levelno, str(record.msg))
+        now = record.created
+        with self._lock:
+            state = self._seen.get(key)
+            if state is not None and now - state[0] < self.window:
+                state[1] += 1
+                if state[1] > self.burst:
+                    state[2] += 1
+                    self.dropped += 1
+                    return False
+                return True
+            suppressed = state[2] if state is not None else 0
+            self._seen[key] = [now, 1, 0]
+            if len(self._seen) > SAMPLER_KEYS:
+                self._expire(now)
+        if suppressed:
+            record.suppressed = suppressed
+            record.msg = f"{record.msg} ({suppressed} similar messages suppressed in the last {self.window:g}s)"
+        return True
+
+    def _expire(self, now: float) -> None:
+        """
+        Forgets messages whose window ended
+        """
+        for key in [key for key, state in self._seen.items() if now - state[0] >= self.window]:
+            del self._seen[key]
+
+
+class LoopQueueHandler(QueueHandler):
+    """
+    Hands records to the writer thread untouched, so formatting happens there instead of on the event loop
+    """
+    def __init__(self, records: queue.Queue) -> None:
+        super().__init__(records)
+        # Records dropped because the writer fell behind
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Same process, so args and exc_info don't need flattening for pickling
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LogPipeline(object):
+    """
+    Logging that only enqueues on the calling thread; a listener thread formats and writes to stdout
+    """
+    def __init__(self, stream=None) -> None:
+        # Output stream, stdout unless given
+        self.stream = stream or sys.stdout
+        self._queue = queue.Queue(QUEUE_SIZE)
+        self.sampler = SamplingFilter()
+        self.handler = LoopQueueHandler(self._queue)
+        self.handler.addFilter(self.sampler)
+        self.output = logging.StreamHandler(self.stream)
+        self.format = None
+        self.set_format("text")
+        self._listener = None
+
+    def install(self, level: str = "DEBUG") -> logging.Logger:
+        """
+        Routes the bot and discord.py loggers through the queue and starts the writer thread
+        """
+        for name in LOGGERS:
+            logger = logging.getLogger(name)
+            logger.handlers.clear()
+            logger.addHandler(self.handler)
+            # Handled here, not again by the root logger
+            logger.propagate = False
+        self.set_level("AudioBot", level)
+        if self._listener is None:
+            self._listener = QueueListener(self._queue, self.output)
+            self._listener.start()
+            # Write out what is still queued on exit
+            atexit.register(self.stop)
+        return logging.getLogger("AudioBot")
+
+    def configure(self, config) -> None:
+        """
+        Applies the [Logging] settings, safe to call again while running
+        """
+        self.set_level("AudioBot", config.log_level)
+        self.set_level("discord", config.discord_log_level)
+        self.set_format(config.log_format)
+        self.sampler.burst = config.log_sample_burst
+        self.sampler.window = config.log_sample_window
+
+    def set_level(self, name: str, level: str) -> None:
+        """
+        Changes the level of one logger at runtime
+        """
+        logging.getLogger(name).setLevel(level)
+
+    def set_format(self, output: str) -> None:
+        """
+        Switches between colored text and JSON lines
+        """
+        if output == self.format:
+            return
+        if output == "json":
+            formatter = JsonFormatter()
+        elif self.stream.isatty():
+            formatter = coloredlogs.ColoredFormatter(
+                LOG_FORMAT, datefmt=coloredlogs.DEFAULT_DATE_FORMAT, level_styles=LEVEL_STYLES, field_styles=FIELD_STYLES
+            )
+        else:
+            # No color codes in files and pipes
+            formatter = logging.Formatter(LOG_FORMAT, datefmt=coloredlogs.DEFAULT_DATE_FORMAT)
+        # The writer thread formats under the handler lock
+        self.output.acquire()
+        try:
+            self.output.setFormatter(formatter)
+        finally:
+            self.output.release()
+        self.format = output
+
+    def stats(self) -> dict:
+        """
+        Gets records dropped by sampling and by a full queue
+        """
+        return {"sampled": self.sampler.dropped, "queue_full": self.handler.dropped}
+
+    def stop(self) -> None:
+        """
+        Writes out queued records and stops the writer thread
+        """
+        if self._listener is not None:
+            try:
+                self._listener.stop()
+            except queue.Full:
+                # No room for the stop sentinel, the daemon thread dies with the process
+                pass
+            self._listener = None
+
+
+# Shared pipeline of the bot process
+pipeline = LogPipeline()
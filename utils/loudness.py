@@ -0,0 +1,220 @@
+import argparse
+import json
+import logging
+import os
+import re
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+
+from utils import packs
+from utils.fingerprint import FINGERPRINT_FILE, Fingerprints
+from utils.transcode import FFMPEG, sound_paths
+
+# Sidecar store of loudness measurements
+LOUDNESS_FILE = "data/audio/cache/loudness.json"
+# Integrated loudness playback is normalized to (LUFS)
+TARGET_LOUDNESS = -16.0
+# Highest true peak allowed after gain (dBTP)
+PEAK_CEILING = -1.0
+# Gains are rounded to this step (dB) so cached transcodes are reused
+GAIN_STEP = 0.5
+# Level and shortest duration counted as leading silence
+SILENCE_LEVEL = "-50dB"
+SILENCE_DURATION = 0.02
+# Leading silence offsets are rounded down to this step (seconds)
+START_STEP = 0.01
+
+# ebur128 summary lines
+INTEGRATED = re.compile(r"I:\s+(-?[\d.]+|-inf) LUFS")
+TRUE_PEAK = re.compile(r"Peak:\s+(-?[\d.]+|-inf) dBFS")
+# silencedetect lines
+SILENCE_START = re.compile(r"silence_start: (-?[\d.]+)")
+SILENCE_END = re.compile(r"silence_end: ([\d.]+)")
+
+
+def analyze(path: str) -> dict:
+    """
+    Measures EBU R128 integrated loudness, true peak and leading silence of a sound in one FFmpeg pass
+    """
+    filters = f"silencedetect=noise={SILENCE_LEVEL}:duration={SILENCE_DURATION},ebur128=peak=true"
+    # Pack members are piped straight from the mapped archive
+    source, data = packs.ffmpeg_input(path)
+    args = [
+        FFMPEG, "-nostdin", "-hide_banner", "-nostats",
+        "-i", source, "-vn", "-af", filters, "-f", "null", "-",
+    ]
+    try:
+        result = subprocess.run(args, input=data, capture_output=True, check=True)
+    finally:
+        if data is not None:
+            data.release()
+    stderr = result.stderr.decode(errors="replace")
+    # The summary is printed last
+    integrated = INTEGRATED.findall(stderr)
+    peak = TRUE_PEAK.findall(stderr)
+    if not integrated or not peak:
+        raise ValueError("no ebur128 summary in FFmpeg output")
+    # Leading silence is a silence that starts at the very beginning
+    start = 0.0
+    silence_start = SILENCE_START.search(stderr)
+    silence_end = SILENCE_END.search(stderr)
+    if silence_start and silence_end and float(silence_start.group(1)) <= 0.0:
+        start = float(silence_end.group(1))
+    return {"integrated": float(integrated[-1]), "true_peak": float(peak[-1]), "start": start}
+
+
+def analyze_file(path: str) -> tuple:
+    """
+    Process pool entry point returning (path, result or error message)
+    """
+    try:
+        return path, analyze(path)
+    except (OSError, ValueError, subprocess.CalledProcessError) as e:
+        return path, str(e)
+
+
+class LoudnessStore(object):
+    """
+    Loudness and leading silence measurements keyed by content hash, stored in a JSON sidecar
+    """
+    def __init__(self, path: str, logger, target: float = TARGET_LOUDNESS, ceiling: float = PEAK_CEILING) -> None:
+        # Sidecar file
+        self.path = path
+        # Bot logger
+        self.logger = logger
+        # Normalization target and true peak ceiling
+        self.target = target
+        self.ceiling = ceiling
+        # Content hash -> {"integrated": LUFS, "true_peak": dBTP, "start": seconds}
+        self._results = {}
+        # Sidecar mtime when last loaded
+        self._mtime = None
+        self._load()
+
+    def _load(self) -> None:
+        """
+        Reads stored measurements
+        """
+        try:
+            self._mtime = os.stat(self.path).st_mtime_ns
+            with open(self.path) as f:
+                self._results = json.load(f)
+        except FileNotFoundError:
+            self._results = {}
+        except (ValueError, OSError) as e:
+            self.logger.error(f"Failed to read loudness store: {e}")
+            self._results = {}
+
+    def reload(self) -> None:
+        """
+        Re-reads measurements if another process saved new ones
+        """
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            return
+        if mtime != self._mtime:
+            self._load()
+
+    def save(self) -> None:
+        """
+        Writes measurements to disk
+        """
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        temp = self.path + ".tmp"
+        with open(temp, "w") as f:
+            json.dump(self._results.copy(), f)
+        os.replace(temp, self.path)
+
+    def __contains__(self, digest: str) -> bool:
+        # Measurements from before silence detection are redone
+        result = self._results.get(digest)
+        return result is not None and "start" in result
+
+    def get(self, digest: str) -> dict:
+        return self._results.get(digest)
+
+    def put(self, digest: str, result: dict) -> None:
+        self._results[digest] = result
+
+    def measure(self, digest: str, path: str) -> dict:
+        """
+        Gets the stored measurement of a sound, analyzing it first if needed (blocking)
+        """
+        if digest not in self:
+            self._results[digest] = analyze(path)
+        return self._results[digest]
+
+    def gain_db(self, digest: str) -> float:
+        """
+        Gets the fixed gain (dB) that brings a sound to the target without clipping, 0 if unknown
+        """
+        result = self._results.get(digest) if digest is not None else None
+        if result is None or result["integrated"] == float("-inf"):
+            return 0.0
+        gain = min(self.target - result["integrated"], self.ceiling - result["true_peak"])
+        return round(gain / GAIN_STEP) * GAIN_STEP
+
+    def gain(self, digest: str) -> float:
+        """
+        Gets the fixed gain as a linear factor
+        """
+        return 10 ** (self.gain_db(digest) / 20)
+
+    def start(self, digest: str) -> float:
+        """
+        Gets the offset (seconds) of the first non-silent audio, 0 if unknown
+        """
+        result = self._results.get(digest) if digest is not None else None
+        if result is None:
+            return 0.0
+        # Round down so no audible audio is cut
+        return int(result.get("start", 0.0) / START_STEP) * START_STEP
+
+    def profile(self, digest: str) -> tuple:
+        """
+        Gets (gain dB, start offset) to play a sound with
+        """
+        return self.gain_db(digest), self.start(digest)
+
+
+def main() -> None:
+    """
+    Measures the loudness of the whole library in parallel
+    """
+    parser = argparse.ArgumentParser(description="Measure EBU R128 loudness of the sound library.")
+    parser.add_argument("--sounds", default="data/audio/sounds", help="sound library directory")
+    parser.add_argument("--packs", default=packs.PACKS_DIR, help="sound pack directory")
+    parser.add_argument("--fingerprints", default=FINGERPRINT_FILE, help="content hash sidecar file")
+    parser.add_argument("--store", default=LOUDNESS_FILE, help="loudness sidecar file")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="parallel analyzer processes")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)-8s %(message)s")
+    logger = logging.getLogger("AudioBot")
+    hashes = Fingerprints(args.fingerprints, logger)
+    store = LoudnessStore(args.store, logger)
+
+    # Only analyze content that was never measured, once per distinct hash
+    pending = {}
+    paths = [*sound_paths(args.sounds), *packs.pack_sound_paths(args.packs)]
+    for path, digest in hashes.hash_all(paths).items():
+        if digest not in store and digest not in pending:
+            pending[digest] = path
+    logger.info(f"Analyzing {len(pending)} sounds with {args.jobs} processes...")
+
+    digests = {path: digest for digest, path in pending.items()}
+    # Workers open the packs themselves so members resolve under any start method
+    with ProcessPoolExecutor(max_workers=args.jobs, initializer=packs.pack_sound_paths, initargs=(args.packs,)) as pool:
+        for path, result in pool.map(analyze_file, pending.values(), chunksize=4):
+            if isinstance(result, str):
+                logger.error(f"Failed to analyze `{path}`: {result}")
+                continue
+            store.put(digests[path], result)
+    store.save()
+    hashes.save()
+    logger.info("Loudness analysis complete")
+
+
+if __name__ == "__main__":
+    main()
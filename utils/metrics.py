@@ -0,0 +1,220 @@
+import asyncio
+from bisect import bisect_left
+
+from aiohttp import web
+
+# Upper bounds (seconds) of latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram(object):
+    """
+    Bucketed latency histogram, cumulative the way Prometheus reports it
+    """
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS) -> None:
+        # Bucket upper bounds, the last bucket is +Inf
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        # Number and sum of observations
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self) -> list:
+        """
+        Gets (upper bound, observations at or below it) pairs, ending with +Inf
+        """
+        pairs, total = [], 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            pairs.append((bound, total))
+        return pairs
+
+    def quantile(self, q: float) -> float:
+        """
+        Gets the upper bound of the bucket holding the q quantile, 0 if empty
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        for bound, total in self.cumulative():
+            if total >= rank:
+                return bound
+        return float("inf")
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "mean": self.sum / self.count if self.count else 0.0,
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+        }
+
+
+def format_labels(labels: tuple) -> str:
+    """
+    Formats (name, value) label pairs the way Prometheus expects them
+    """
+    if not labels:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n"))
+        for name, value in labels
+    )
+    return "{" + ",".join(f"{name}=\"{value}\"" for name, value in escaped) + "}"
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metrics(object):
+    """
+    Registry of histograms, counters and scrape-time gauges served as Prometheus text
+    """
+    def __init__(self, logger, prefix: str = "audiobot") -> None:
+        # Bot logger
+        self.logger = logger
+        # Prefix of every metric name
+        self.prefix = prefix
+        # Metric name -> (type, help text)
+        self._meta = {}
+        # Metric name -> {label pairs: Histogram}
+        self._histograms = {}
+        # Metric name -> {label pairs: value}
+        self._counters = {}
+        # Metric name -> callable returning a value, or a {label value: value} dict with its label name
+        self._gauges = {}
+        self._lag_task = None
+        self._runner = None
+
+    """ ------------------------------------------ Recording ------------------------------------------------ """
+    def describe(self, name: str, kind: str, help_text: str) -> None:
+        self._meta[name] = (kind, help_text)
+
+    def register(self, name: str, help_text: str, histogram: Histogram) -> None:
+        """
+        Exposes a histogram owned by another component
+        """
+        self.describe(name, "histogram", help_text)
+        self._histograms.setdefault(name, {})[()] = histogram
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        """
+        Adds an observation to a histogram, creating it on first use
+        """
+        series = self._histograms.get(name)
+        if series is None:
+            series = self._histograms[name] = {}
+        key = tuple(sorted(labels.items()))
+        histogram = series.get(key)
+        if histogram is None:
+            histogram = series[key] = Histogram()
+        histogram.observe(value)
+
+    def inc(self, name: str, amount: float = 1, **labels) -> None:
+        """
+        Increments a counter, creating it on first use
+        """
+        series = self._counters.get(name)
+        if series is None:
+            series = self._counters[name] = {}
+        key = tuple(sorted(labels.items()))
+        series[key] = series.get(key, 0) + amount
+
+    def gauge(self, name: str, help_text: str, read, label: str = None) -> None:
+        """
+        Registers a gauge read at scrape time; with a label, read returns {label value: value}
+        """
+        self.describe(name, "gauge", help_text)
+        self._gauges[name] = (read, label)
+
+    """ ------------------------------------------ Event Loop Lag ------------------------------------------------ """
+    def start(self, loop, interval: float = 1.0) -> None:
+        """
+        Starts sampling event loop lag
+        """
+        if self._lag_task is None:
+            self.describe("loop_lag_seconds", "histogram", "How late the event loop ran a timer")
+            self._lag_task = loop.create_task(self._sample_lag(interval))
+
+    async def _sample_lag(self, interval: float) -> None:
+        """
+        Measures how much later than scheduled a sleep wakes up
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + interval
+            await asyncio.sleep(interval)
+            self.observe("loop_lag_seconds", max(0.0, loop.time() - expected))
+
+    """ ------------------------------------------ Exposition ------------------------------------------------ """
+    def render(self) -> str:
+        """
+        Renders every metric in the Prometheus text format
+        """
+        lines = []
+        for name, series in self._counters.items():
+            self._header(lines, name, "counter")
+            for labels, value in series.items():
+                lines.append(f"{self.prefix}_{name}{format_labels(labels)} {format_value(value)}")
+        for name, series in self._histograms.items():
+            self._header(lines, name, "histogram")
+            full = f"{self.prefix}_{name}"
+            for labels, histogram in series.items():
+                for bound, total in histogram.cumulative():
+                    lines.append(f"{full}_bucket{format_labels(labels + (('le', format_value(bound)),))} {total}")
+                lines.append(f"{full}_sum{format_labels(labels)} {format_value(histogram.sum)}")
+                lines.append(f"{full}_count{format_labels(labels)} {histogram.count}")
+        for name, (read, label) in self._gauges.items():
+            try:
+                value = read()
+            except Exception as e:
+                self.logger.error(f"Failed to read gauge {name}: {e}")
+                continue
+            self._header(lines, name, "gauge")
+            if label is None:
+                lines.append(f"{self.prefix}_{name} {format_value(value)}")
+                continue
+            for label_value, item in value.items():
+                lines.append(f"{self.prefix}_{name}{format_labels(((label, label_value),))} {format_value(item)}")
+        return "\n".join(lines) + "\n"
+
+    def _header(self, lines: list, name: str, kind: str) -> None:
+        kind, help_text = self._meta.get(name, (kind, name.replace("_", " ")))
+        lines.append(f"# HELP {self.prefix}_{name} {help_text}")
+        lines.append(f"# TYPE {self.prefix}_{name} {kind}")
+
+    async def serve(self, host: str, port: int) -> None:
+        """
+        Serves /metrics over HTTP
+        """
+        if self._runner is not None:
+            return
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        self.logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        # Version 0.0.4 is the Prometheus text format
+        return web.Response(body=self.render().encode(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    async def stop(self) -> None:
+        """
+        Stops the lag sampler and the HTTP server
+        """
+        if self._lag_task is not None:
+            self._lag_task.cancel()
+            self._lag_task = None
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
@@ -0,0 +1,117 @@
+import threading
+
+import discord
+import numpy as np
+
+# Bytes of 16-bit 48 kHz stereo PCM in one 20 ms frame
+PCM_FRAME_SIZE = discord.opus.Encoder.FRAME_SIZE
+# Interleaved int16 samples in one frame
+FRAME_SAMPLES = PCM_FRAME_SIZE // 2
+# Fixed-point precision of stream gains
+GAIN_SHIFT = 12
+UNITY_GAIN = 1 << GAIN_SHIFT
+
+
+class MixerStream(object):
+    """
+    One PCM source playing through a mixer
+    """
+    __slots__ = ("source", "gain", "after", "ready")
+
+    def __init__(self, source: discord.AudioSource, gain: float, after) -> None:
+        # PCM source
+        self.source = source
+        # Fixed-point gain
+        self.gain = int(round(gain * UNITY_GAIN))
+        # Called from the audio thread once the stream ends
+        self.after = after
+        # Tells whether the source can hand out a frame without blocking, sources without it always can
+        self.ready = getattr(source, "ready", None)
+
+
+class MixerSource(discord.AudioSource):
+    """
+    Sums any number of PCM sources into one 20 ms frame at a time
+
+    A stream whose source isn't ready yet (still waiting for a decoder or decoding its first frames) is silent
+    for that frame, so one slow start never holds up the others.
+    """
+    def __init__(self) -> None:
+        # Active streams, changed from the event loop and read from the audio thread
+        self._streams = []
+        self._lock = threading.Lock()
+        # Set once the mixer ran dry and the voice client stopped reading
+        self.closed = False
+        # Preallocated frame buffers
+        self._acc = np.zeros(FRAME_SAMPLES, dtype=np.int32)
+        self._scaled = np.zeros(FRAME_SAMPLES, dtype=np.int32)
+        self._out = np.zeros(FRAME_SAMPLES, dtype=np.int16)
+
+    def __len__(self) -> int:
+        return len(self._streams)
+
+    def add(self, source: discord.AudioSource, gain: float = 1.0, after=None) -> bool:
+        """
+        Starts mixing a PCM source in, returns False if the mixer already finished
+        """
+        if source.is_opus():
+            raise ValueError("Mixer streams must be PCM")
+        with self._lock:
+            if self.closed:
+                return False
+            self._streams.append(MixerStream(source, gain, after))
+        return True
+
+    def read(self) -> bytes:
+        with self._lock:
+            streams = list(self._streams)
+            if not streams:
+                # Nothing left to mix, the voice client stops here
+                self.closed = True
+                return b""
+        acc, scaled = self._acc, self._scaled
+        acc.fill(0)
+        finished = []
+        for stream in streams:
+            if stream.ready is not None and not stream.ready():
+                continue
+            data = stream.source.read()
+            if len(data) != PCM_FRAME_SIZE:
+                finished.append(stream)
+                continue
+            samples = np.frombuffer(data, dtype=np.int16)
+            if stream.gain == UNITY_GAIN:
+                acc += samples
+            else:
+                np.multiply(samples, stream.gain, out=scaled, dtype=np.int32)
+                np.right_shift(scaled, GAIN_SHIFT, out=scaled)
+                acc += scaled
+        if finished:
+            self._finish(finished)
+        # Saturate instead of wrapping around
+        np.clip(acc, -32768, 32767, out=acc)
+        np.copyto(self._out, acc, casting="unsafe")
+        return self._out.tobytes()
+
+    def _finish(self, finished: list) -> None:
+        """
+        Removes ended streams and runs their callbacks
+        """
+        with self._lock:
+            self._streams = [stream for stream in self._streams if stream not in finished]
+        for stream in finished:
+            stream.source.cleanup()
+            if stream.after is not None:
+                stream.after()
+
+    def is_opus(self) -> bool:
+        return False
+
+    def cleanup(self) -> None:
+        with self._lock:
+            self.closed = True
+            streams, self._streams = self._streams, []
+        for stream in streams:
+            stream.source.cleanup()
+            if stream.after is not None:
+                stream.after()
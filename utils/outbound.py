@@ -0,0 +1,207 @@
+import asyncio
+import time
+from collections import deque
+
+import aiohttp
+
+# Longest message Discord accepts
+MAX_MESSAGE_LENGTH = 2000
+
+
+class Outgoing(object):
+    """
+    A message waiting to be sent to a channel
+    """
+    __slots__ = ("content", "coalesce", "relevant", "future", "view")
+
+    def __init__(self, content: str, coalesce: bool, relevant, future: asyncio.Future, view=None) -> None:
+        # Message text
+        self.content = content
+        # Components attached to the message
+        self.view = view
+        # Whether it may be merged with neighbouring status lines
+        self.coalesce = coalesce and view is None
+        # Callable telling whether the message is still worth sending
+        self.relevant = relevant
+        # Resolved with the sent message, or None if it was dropped
+        self.future = future
+
+    def stale(self) -> bool:
+        return self.relevant is not None and not self.relevant()
+
+
+class TokenBucket(object):
+    """
+    Allows `rate` sends per `per` seconds with bursts of up to `burst`
+    """
+    def __init__(self, rate: float, per: float, burst: int) -> None:
+        self.capacity = burst
+        self.fill_rate = rate / per
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def delay(self) -> float:
+        """
+        Takes a token if one is available, otherwise returns seconds until one is
+        """
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.fill_rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.fill_rate
+
+
+class RateLimitCounter(object):
+    """
+    Counts the 429 responses discord.py retries internally
+
+    Hooked into the HTTP session rather than discord.http's warnings, so the count doesn't depend on the
+    [Logging] DiscordLevel.
+    """
+    def __init__(self) -> None:
+        self.hits = 0
+        # Passed to the client as http_trace
+        self.trace = aiohttp.TraceConfig()
+        self.trace.on_request_end.append(self._request_end)
+
+    async def _request_end(self, session, context, params: aiohttp.TraceRequestEndParams) -> None:
+        if params.response.status == 429:
+            self.hits += 1
+
+
+class Outbox(object):
+    """
+    Per-channel outbound message pipeline with token buckets and coalescing
+    """
+    def __init__(self, logger, rate: float = 5, per: float = 5.0, burst: int = 5) -> None:
+        # Bot logger
+        self.logger = logger
+        # Token bucket settings, Discord allows about 5 messages per 5 seconds per channel
+        self.rate, self.per, self.burst = rate, per, burst
+        # Channel id -> pending messages
+        self._queues = {}
+        # Channel id -> token bucket
+        self._buckets = {}
+        # Counters
+        self.sent = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.throttled = 0
+        # 429s from Discord, counted once the client sends its requests through rate_limits.trace
+        self.rate_limits = RateLimitCounter()
+
+    @property
+    def depth(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    @property
+    def rate_limit_hits(self) -> int:
+        return self.rate_limits.hits
+
+    async def send(self, channel, content: str, coalesce: bool = False, relevant=None, view=None):
+        """
+        Queues a message and returns it once sent, or None if it was dropped
+        """
+        future = asyncio.get_running_loop().create_future()
+        queue = self._queues.get(channel.id)
+        if queue is None:
+            # First message for this channel starts its worker
+            queue = self._queues[channel.id] = deque()
+            asyncio.get_running_loop().create_task(self._drain(channel))
+        queue.append(Outgoing(content, coalesce, relevant, future, view))
+        return await future
+
+    async def _drain(self, channel) -> None:
+        """
+        Sends the queued messages of one channel as the bucket allows
+        """
+        queue = self._queues[channel.id]
+        bucket = self._buckets.get(channel.id)
+        if bucket is None:
+            bucket = self._buckets[channel.id] = TokenBucket(self.rate, self.per, self.burst)
+        error = None
+        try:
+            while queue:
+                delay = bucket.delay()
+                if delay:
+                    self.throttled += 1
+                    await asyncio.sleep(delay)
+                    continue
+                batch = self._next_batch(queue)
+                if not batch:
+                    # Everything left was stale, give the token back
+                    bucket.tokens += 1
+                    continue
+                await self._send_batch(channel, batch)
+        except Exception as e:
+            error = e
+            self.logger.error(f"Outbox of channel {channel.id} stopped: {e}")
+        finally:
+            del self._queues[channel.id]
+            # Nothing sends what is left, so its senders mustn't wait forever
+            for item in queue:
+                if item.future.done():
+                    continue
+                if error is None:
+                    item.future.cancel()
+                else:
+                    item.future.set_exception(error)
+
+    def _next_batch(self, queue: deque) -> list:
+        """
+        Pops the next message, merged with following status lines when possible
+        """
+        batch, length = [], 0
+        while queue:
+            item = queue[0]
+            if item.stale():
+                # No longer useful, e.g. a "Playing" notice for a finished sound
+                queue.popleft()
+                self.dropped += 1
+                if not item.future.done():
+                    item.future.set_result(None)
+                continue
+            if batch and not (batch[0].coalesce and item.coalesce):
+                break
+            if batch and length + 1 + len(item.content) > MAX_MESSAGE_LENGTH:
+                break
+            batch.append(queue.popleft())
+            length += len(item.content) + (1 if len(batch) > 1 else 0)
+        return batch
+
+    async def _send_batch(self, channel, batch: list) -> None:
+        """
+        Sends one message for a batch and resolves every future in it
+        """
+        content = "\n".join(item.content for item in batch)
+        try:
+            if batch[0].view is not None:
+                message = await channel.send(content, view=batch[0].view)
+            else:
+                message = await channel.send(content)
+        except Exception as e:
+            self.logger.error(f"Error sending message: {e}")
+            for item in batch:
+                if not item.future.done():
+                    item.future.set_exception(e)
+            return
+        self.sent += 1
+        self.coalesced += len(batch) - 1
+        for item in batch:
+            if not item.future.done():
+                item.future.set_result(message)
+
+    def stats(self) -> dict:
+        """
+        Gets pipeline counters
+        """
+        return {
+            "depth": self.depth,
+            "sent": self.sent,
+            "coalesced": self.coalesced,
+            "dropped": self.dropped,
+            "throttled": self.throttled,
+            "rate_limit_hits": self.rate_limit_hits,
+        }
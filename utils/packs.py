@@ -0,0 +1,388 @@
+import asyncio
+import io
+import mmap
+import os
+import re
+import struct
+import tarfile
+import threading
+import zipfile
+
+# Where sound pack archives are mounted from
+PACKS_DIR = "data/audio/packs"
+# Archive types that can be mounted
+PACK_EXTS = (".zip", ".tar")
+# Sound paths inside a pack look like data/audio/packs/Memes.zip!/Memes_1.mp3
+MEMBER_SEP = "!"
+MEMBER_PATH = re.compile(r"^(.*\.(?:zip|tar))" + re.escape(MEMBER_SEP + os.sep) + r"(.*)$", re.IGNORECASE)
+# Name and extra field lengths in a zip local file header
+ZIP_LOCAL_LENGTHS = struct.Struct("<HH")
+ZIP_LOCAL_HEADER_SIZE = 30
+
+# Mounted archive path -> Pack, so any component can resolve member paths
+_mounted = {}
+
+
+def split_member(path: str) -> tuple:
+    """
+    Splits a pack sound path into (archive path, member name), or returns None for a plain file
+    """
+    match = MEMBER_PATH.match(path)
+    return (match.group(1), match.group(2)) if match else None
+
+
+def member_path(archive: str, member: str) -> str:
+    """
+    Joins an archive path and a member name into a sound path
+    """
+    return archive + MEMBER_SEP + os.sep + member
+
+
+class MemberStat(object):
+    """
+    The stat fields fingerprints use, for a pack member
+    """
+    __slots__ = ("st_size", "st_mtime_ns")
+
+    def __init__(self, size: int, mtime_ns: int) -> None:
+        self.st_size = size
+        # Members change when their archive does
+        self.st_mtime_ns = mtime_ns
+
+
+class MemberReader(io.RawIOBase):
+    """
+    File-like reader over a member's bytes in the archive's memory map, without copying them out first
+    """
+    def __init__(self, view: memoryview) -> None:
+        self._view = view
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        count = min(len(buffer), len(self._view) - self._pos)
+        buffer[:count] = self._view[self._pos:self._pos + count]
+        self._pos += count
+        return count
+
+    def close(self) -> None:
+        if not self.closed:
+            # Let the archive unmap once the last reader is done
+            self._view.release()
+        super().close()
+
+
+class Pack(object):
+    """
+    An uncompressed zip or tar archive mapped into memory, with its member offsets read once
+    """
+    def __init__(self, path: str) -> None:
+        # Archive file
+        self.path = path
+        # Directory name the pack is mounted as
+        self.name = os.path.splitext(os.path.basename(path))[0]
+        stat = os.stat(path)
+        self.size = stat.st_size
+        self.mtime_ns = stat.st_mtime_ns
+        # Member name -> (data offset, size)
+        self.members = {}
+        # Members that can't be streamed (compressed or encrypted)
+        self.skipped = []
+        self._file = open(path, "rb")
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            if path.lower().endswith(".zip"):
+                self._read_zip()
+            else:
+                self._read_tar()
+        except (ValueError, OSError, zipfile.BadZipFile, tarfile.TarError):
+            self.close()
+            raise
+
+    def _add(self, name: str, offset: int, size: int) -> None:
+        parts = name.replace("\\", "/").strip("/").split("/")
+        # Never let a member escape the pack
+        if not parts[-1] or any(part in ("", ".", "..") for part in parts):
+            return
+        self.members[os.sep.join(parts)] = (offset, size)
+
+    def _read_zip(self) -> None:
+        """
+        Reads the central directory and resolves each stored member's data offset
+        """
+        with zipfile.ZipFile(self._file) as archive:
+            for info in archive.infolist():
+                if info.is_dir():
+                    continue
+                if info.compress_type != zipfile.ZIP_STORED or info.flag_bits & 0x1:
+                    self.skipped.append(info.filename)
+                    continue
+                # The local header repeats the name and may carry a different extra field
+                name_length, extra_length = ZIP_LOCAL_LENGTHS.unpack_from(self._map, info.header_offset + 26)
+                offset = info.header_offset + ZIP_LOCAL_HEADER_SIZE + name_length + extra_length
+                self._add(info.filename, offset, info.file_size)
+
+    def _read_tar(self) -> None:
+        """
+        Walks the member headers of an uncompressed tar once
+        """
+        self._file.seek(0)
+        with tarfile.open(fileobj=self._file, mode="r:") as archive:
+            for info in archive:
+                if not info.isfile():
+                    continue
+                if info.issparse():
+                    self.skipped.append(info.name)
+                    continue
+                self._add(info.name, info.offset_data, info.size)
+
+    def listing(self, ext: str, natural_key) -> dict:
+        """
+        Gets {relative dir: (sub directory names, sound file names)} of the pack, the pack root being ""
+        """
+        dirs = {"": (set(), [])}
+        for name in self.members:
+            if not name.endswith(ext):
+                continue
+            directory, file = os.path.split(name)
+            dirs.setdefault(directory, (set(), []))[1].append(file)
+            # Register every parent dir down to the pack root
+            while directory:
+                parent, child = os.path.split(directory)
+                dirs.setdefault(parent, (set(), []))[0].add(child)
+                directory = parent
+        return {
+            rel: (tuple(sorted(subdirs, key=natural_key)), tuple(sorted(files, key=natural_key)))
+            for rel, (subdirs, files) in dirs.items()
+        }
+
+    def view(self, member: str) -> memoryview:
+        """
+        Gets a zero-copy view of a member's bytes
+        """
+        offset, size = self.members[member]
+        with memoryview(self._map) as whole:
+            return whole[offset:offset + size]
+
+    def close(self) -> None:
+        """
+        Unmaps the archive, or leaves it to the last open reader if members are still streaming
+        """
+        try:
+            if getattr(self, "_map", None) is not None:
+                self._map.close()
+        except BufferError:
+            # Views still exported, the map is released with the last one
+            pass
+        self._file.close()
+
+
+""" ------------------------------------------ Member Access ------------------------------------------------ """
+def stat(path: str):
+    """
+    Stats a sound file or pack member, raising FileNotFoundError for members of unmounted packs
+    """
+    member = split_member(path)
+    if member is None:
+        return os.stat(path)
+    pack = _mounted.get(member[0])
+    if pack is None or member[1] not in pack.members:
+        raise FileNotFoundError(path)
+    return MemberStat(pack.members[member[1]][1], pack.mtime_ns)
+
+
+def view(path: str) -> memoryview:
+    """
+    Gets the bytes of a pack member without copying, or None for a plain file
+    """
+    member = split_member(path)
+    if member is None:
+        return None
+    pack = _mounted.get(member[0])
+    if pack is None or member[1] not in pack.members:
+        raise FileNotFoundError(path)
+    return pack.view(member[1])
+
+
+def ffmpeg_input(path: str) -> tuple:
+    """
+    Gets the FFmpeg input of a sound and the member bytes to pipe to its stdin (None for a plain file)
+    """
+    data = view(path)
+    return ("pipe:0", data) if data is not None else (path, None)
+
+
+def feed(process, data: memoryview) -> threading.Thread:
+    """
+    Writes member bytes to a process's stdin in a thread, so its stdout can be read meanwhile
+    """
+    def write():
+        try:
+            process.stdin.write(data)
+        except (BrokenPipeError, ValueError, OSError):
+            # The process quit early, e.g. the clip was long enough
+            pass
+        finally:
+            data.release()
+            try:
+                process.stdin.close()
+            except OSError:
+                pass
+    thread = threading.Thread(target=write, daemon=True, name=f"pack-feed:pid-{process.pid}")
+    thread.start()
+    return thread
+
+
+""" ------------------------------------------ Mounting ------------------------------------------------ """
+def open_pack(path: str) -> Pack:
+    """
+    Opens an archive and reads its member offsets (blocking)
+    """
+    return Pack(path)
+
+
+def pack_sound_paths(directory: str, ext: str = ".mp3") -> list:
+    """
+    Opens every archive of a directory for member access and returns the paths of their sounds (blocking)
+    """
+    paths = []
+    try:
+        names = sorted(os.listdir(directory))
+    except OSError:
+        return paths
+    for name in names:
+        if not name.lower().endswith(PACK_EXTS):
+            continue
+        pack = open_pack(os.path.join(directory, name))
+        _mounted[pack.path] = pack
+        paths.extend(member_path(pack.path, member) for member in pack.members if member.endswith(ext))
+    return paths
+
+
+class PackMounts(object):
+    """
+    Mounts every archive in the packs directory into the sound index, following archives as they come and go
+    """
+    def __init__(self, index, directory: str = PACKS_DIR, poll_interval: float = 10.0) -> None:
+        # Index the packs are mounted into
+        self.index = index
+        # Directory holding the archives
+        self.directory = directory
+        # Seconds between checks of the packs directory
+        self.poll_interval = poll_interval
+        # Archive path -> (size, mtime_ns) when it was mounted
+        self._stamps = {}
+        self._task = None
+
+    @property
+    def packs(self) -> list:
+        return [pack for pack in _mounted.values() if os.path.dirname(pack.path) == self.directory]
+
+    def _archives(self) -> dict:
+        """
+        Gets {archive path: (size, mtime_ns)} of the packs directory
+        """
+        archives = {}
+        try:
+            entries = os.scandir(self.directory)
+        except OSError:
+            return archives
+        with entries:
+            for entry in entries:
+                if entry.is_file() and entry.name.lower().endswith(PACK_EXTS):
+                    stat = entry.stat()
+                    archives[entry.path] = (stat.st_size, stat.st_mtime_ns)
+        return archives
+
+    def _diff(self) -> tuple:
+        """
+        Opens new and changed archives, returns (opened packs, archive paths to unmount) (blocking)
+        """
+        archives = self._archives()
+        gone = [path for path, stamp in self._stamps.items() if archives.get(path) != stamp]
+        opened = []
+        for path, stamp in archives.items():
+            if self._stamps.get(path) == stamp:
+                continue
+            try:
+                opened.append(open_pack(path))
+            except (ValueError, OSError, zipfile.BadZipFile, tarfile.TarError) as e:
+                self.index.logger.error(f"Failed to open sound pack `{path}`: {e}")
+            # Don't retry a broken archive until it changes
+            self._stamps[path] = stamp
+        for path in gone:
+            if path not in archives:
+                del self._stamps[path]
+        return opened, gone
+
+    def mount_all(self) -> None:
+        """
+        Mounts the packs directory before the index is built (blocking)
+        """
+        opened, _ = self._diff()
+        for pack in opened:
+            self._mount(pack, notify=False)
+
+    async def sync(self) -> None:
+        """
+        Mounts new archives and unmounts removed ones, reading them off the loop
+        """
+        opened, gone = await asyncio.get_running_loop().run_in_executor(None, self._diff)
+        for path in gone:
+            self.unmount(path)
+        for pack in opened:
+            self._mount(pack)
+
+    def _mount(self, pack: Pack, notify: bool = True) -> None:
+        # Registered first so listeners can already read its members
+        _mounted[pack.path] = pack
+        if not self.index.mount(pack, notify=notify):
+            del _mounted[pack.path]
+            pack.close()
+            return
+        if pack.skipped:
+            self.index.logger.warning(
+                f"Sound pack `{pack.name}`: skipped {len(pack.skipped)} compressed members, store packs uncompressed"
+            )
+
+    def unmount(self, path: str) -> None:
+        """
+        Removes an archive's sounds from the index; sounds already playing finish first
+        """
+        pack = _mounted.pop(path, None)
+        if pack is None:
+            return
+        self.index.unmount(pack.name)
+        pack.close()
+
+    def start(self, loop: asyncio.AbstractEventLoop) -> None:
+        """
+        Starts following the packs directory
+        """
+        if self._task is None:
+            self._task = loop.create_task(self._poll())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _poll(self) -> None:
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                await self.sync()
+            except Exception as e:
+                self.index.logger.error(f"Failed to sync sound packs: {e}")
+
+    async def move(self, directory: str) -> None:
+        """
+        Unmounts every pack and mounts the archives of another directory
+        """
+        for path in list(self._stamps):
+            self.unmount(path)
+        self._stamps.clear()
+        self.directory = directory
+        await self.sync()
@@ -0,0 +1,537 @@
+import asyncio
+import threading
+import time
+from collections import deque
+
+import discord
+
+from utils.mixer import MixerSource
+
+# What to do with a play request while something is already playing
+QUEUE = "queue"
+INTERRUPT = "interrupt"
+DROP = "drop"
+MIX = "mix"
+POLICIES = (QUEUE, INTERRUPT, DROP, MIX)
+
+# Results of GuildPlayer.submit
+PLAYING = "playing"
+QUEUED = "queued"
+DROPPED = "dropped"
+FULL = "full"
+
+# Frames decoded ahead before a track starts (20 ms each)
+PRIME_FRAMES = 5
+# Seconds the audio thread waits for the next item of a sequence if reading ahead fell behind
+READ_AHEAD_TIMEOUT = 5.0
+
+
+class PrimedSource(discord.AudioSource):
+    """
+    Wraps a source so its first frames can be read ahead of time and the first packet is timed
+    """
+    def __init__(self, source: discord.AudioSource, on_first=None) -> None:
+        # Wrapped source
+        self.source = source
+        # Called from the audio thread with the perf_counter time of the first frame
+        self.on_first = on_first
+        # Frames read ahead of playback
+        self._frames = deque()
+        # prime runs in an executor while the audio thread may already read
+        self._lock = threading.Lock()
+        self._started = False
+        # Set once prime has run, whether or not it buffered anything
+        self.primed = False
+
+    def ready(self) -> bool:
+        """
+        Whether reading won't block on starting the source, the mixer skips the source until then
+        """
+        return self.primed
+
+    def prime(self, frames: int = PRIME_FRAMES) -> int:
+        """
+        Waits for a decoder slot if the source needs one, then reads up to frames frames ahead (blocking, in an
+        executor) and returns how many are buffered
+        """
+        try:
+            # Decoders may sit behind a volume transformer
+            admit = getattr(getattr(self.source, "original", self.source), "admit", None)
+            if admit is not None and not admit():
+                return 0
+            with self._lock:
+                while not self._started and len(self._frames) < frames:
+                    data = self.source.read()
+                    self._frames.append(data)
+                    if not data:
+                        break
+                return len(self._frames)
+        finally:
+            self.primed = True
+
+    def read(self) -> bytes:
+        with self._lock:
+            data = self._frames.popleft() if self._frames else self.source.read()
+            if not self._started:
+                self._started = True
+                if data and self.on_first is not None:
+                    self.on_first(time.perf_counter())
+        return data
+
+    def is_opus(self) -> bool:
+        return self.source.is_opus()
+
+    def cleanup(self) -> None:
+        self._frames.clear()
+        self.source.cleanup()
+
+
+class SequenceSource(discord.AudioSource):
+    """
+    Plays the items of a playlist back to back as one stream, switching to the next item within the same read
+
+    Each item is built on the event loop and primed while the one before it plays. In PCM mode every item
+    that isn't a cached clip still opens its own pooled FFmpeg decoder, one after another, so a playlist
+    holds at most two decoder slots (playing and primed) but pays one process start per item; only Opus
+    passthrough needs none.
+    """
+    def __init__(self, count: int, opus: bool, prepare, on_item=None, timeout: float = READ_AHEAD_TIMEOUT) -> None:
+        # Items in the sequence
+        self.count = count
+        # Every item is Opus passthrough, or every item is PCM
+        self.opus = opus
+        # Called from any thread with an item index; the item's source must later be passed to supply
+        self.prepare = prepare
+        # Called from the audio thread with the index of each item as it starts
+        self.on_item = on_item
+        self.timeout = timeout
+        # Index of the playing item, and of the last item requested
+        self.index = -1
+        self._requested = -1
+        self._current = None
+        # Item index -> prepared source, None if it failed
+        self._ready = {}
+        self._cond = threading.Condition()
+        self.closed = False
+
+    def start(self) -> None:
+        """
+        Requests the first two items
+        """
+        self._request(0)
+        self._request(1)
+
+    def _request(self, index: int) -> None:
+        if self._requested < index < self.count:
+            self._requested = index
+            self.prepare(index)
+
+    def supply(self, index: int, source: discord.AudioSource) -> None:
+        """
+        Hands over the prepared source of an item, None if it couldn't be built
+        """
+        with self._cond:
+            if not self.closed:
+                self._ready[index] = source
+                self._cond.notify_all()
+                return
+        if source is not None:
+            source.cleanup()
+
+    def _advance(self) -> bool:
+        """
+        Switches to the next item that has a source, returns False at the end
+        """
+        while self.index + 1 < self.count:
+            self.index += 1
+            with self._cond:
+                self._cond.wait_for(lambda: self.index in self._ready or self.closed, self.timeout)
+                source = self._ready.pop(self.index, None)
+            # Read the following item ahead while this one plays
+            self._request(self.index + 1)
+            if source is not None:
+                self._current = source
+                if self.on_item is not None:
+                    self.on_item(self.index)
+                return True
+        return False
+
+    def read(self) -> bytes:
+        while not self.closed:
+            if self._current is None and not self._advance():
+                break
+            data = self._current.read()
+            if data:
+                return data
+            self._current.cleanup()
+            self._current = None
+        return b""
+
+    def is_opus(self) -> bool:
+        return self.opus
+
+    def cleanup(self) -> None:
+        with self._cond:
+            self.closed = True
+            sources, self._ready = list(self._ready.values()), {}
+            self._cond.notify_all()
+        if self._current is not None:
+            sources.append(self._current)
+            self._current = None
+        for source in sources:
+            if source is not None:
+                source.cleanup()
+
+
+class Track(object):
+    """
+    A play request waiting in a guild queue
+    """
+    __slots__ = (
+        "path", "title", "ctx", "source", "message", "gain", "done", "requested", "ttfp", "position", "seek",
+        "items", "opus", "index", "cached",
+    )
+
+    def __init__(self, path: str, title: str, ctx, gain: float = 1.0, requested: float = None,
+                 position: float = None, seek: tuple = None, items: tuple = None, opus: bool = False) -> None:
+        # Sound file path, the first item of a sequence
+        self.path = path
+        # Sound paths of a sequence played gapless, whether they all have Opus transcodes, and the playing one
+        self.items = items
+        self.opus = opus
+        self.index = 0
+        # Whether the track was served from a cache without a decoder, set when submitted
+        self.cached = False
+        # Seconds into the sound to start at, and where decoding starts for it: (byte offset, seconds to drop)
+        self.position = position
+        self.seek = seek
+        # Name shown to users
+        self.title = title
+        # Command context that requested the track
+        self.ctx = ctx
+        # Audio source, built ahead of time while the previous track plays
+        self.source = None
+        # Status message sent when the track starts
+        self.message = None
+        # Volume when mixed with other tracks
+        self.gain = gain
+        # Set once the track stopped playing
+        self.done = False
+        # perf_counter time of the play command, and seconds until its first packet
+        self.requested = time.perf_counter() if requested is None else requested
+        self.ttfp = None
+
+    def discard(self) -> None:
+        """
+        Releases a prepared source that will never play
+        """
+        if self.source is not None:
+            self.source.cleanup()
+            self.source = None
+
+
+class GuildPlayer(object):
+    """
+    Plays the tracks of one guild in order from a bounded queue
+    """
+    def __init__(self, guild, logger, make_source, on_start=None, on_finish=None, on_error=None,
+                 on_first_packet=None, policy: str = QUEUE, maxsize: int = 10, executor=None) -> None:
+        # Guild whose voice client plays the tracks
+        self.guild = guild
+        # Bot logger
+        self.logger = logger
+        # Callable building an audio source from a sound path, make_source(path, pcm=False, seek=None, opus=False)
+        self.make_source = make_source
+        # Coroutines run around each track
+        self.on_start = on_start
+        self.on_finish = on_finish
+        self.on_error = on_error
+        self.on_first_packet = on_first_packet
+        # Busy policy and queue bound
+        self.policy = policy
+        self.maxsize = maxsize
+        # Executor sources are primed in, waiting for decoder slots included (None for the loop's default)
+        self.executor = executor
+        # Waiting tracks and the one playing
+        self.queue = deque()
+        self.current = None
+        # Mixer of the current track while mixing
+        self.mixer = None
+        # Wakes the player task when tracks are queued
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    @property
+    def busy(self) -> bool:
+        return self.current is not None or bool(self.queue)
+
+    def submit(self, track: Track) -> str:
+        """
+        Adds a track according to the busy policy and returns what happened to it
+        """
+        if self.policy == MIX and self._mix(track):
+            return PLAYING
+        if not self.busy:
+            self._push(track)
+            return PLAYING
+        if self.policy == DROP:
+            return DROPPED
+        if self.policy == INTERRUPT:
+            # Play next and cut off the current track
+            self._push(track, front=True)
+            self.skip()
+            return PLAYING
+        if len(self.queue) >= self.maxsize:
+            return FULL
+        self._push(track)
+        return QUEUED
+
+    def _push(self, track: Track, front: bool = False) -> None:
+        """
+        Queues a track and wakes the player
+        """
+        if front:
+            self.queue.appendleft(track)
+        else:
+            self.queue.append(track)
+        # Build the next source early so it starts without a gap
+        if self.current is not None:
+            self._prepare_next()
+        self._wakeup.set()
+
+    def _mix(self, track: Track) -> bool:
+        """
+        Overlaps a track with what is playing, returns False if nothing is mixing
+        """
+        mixer = self.mixer
+        if mixer is None or mixer.closed:
+            return False
+        loop = asyncio.get_running_loop()
+        if track.source is not None and track.source.is_opus():
+            track.discard()
+        source = track.source or self._build(track, pcm=True)
+        track.source = None
+        after = lambda: loop.call_soon_threadsafe(self._finish, track)
+        if not mixer.add(source, track.gain, after):
+            # The mixer ran dry meanwhile, start a new one
+            source.cleanup()
+            return False
+        # The mixer keeps it silent until its first frames are decoded off the audio thread
+        if not source.primed:
+            loop.create_task(self._prime(source))
+        loop.create_task(self._callback(self.on_start, track))
+        return True
+
+    def _build(self, track: Track, pcm: bool = False) -> PrimedSource:
+        """
+        Builds the source of a track, wrapped to time its first packet
+        """
+        loop = asyncio.get_running_loop()
+        on_first = lambda now: loop.call_soon_threadsafe(self._first_packet, track, now)
+        if track.items is not None:
+            return PrimedSource(self._sequence(track, pcm), on_first)
+        return PrimedSource(self.make_source(track.path, pcm=pcm, seek=track.seek), on_first)
+
+    def _sequence(self, track: Track, pcm: bool) -> SequenceSource:
+        """
+        Builds the gapless source of a sequence, Opus passthrough if every item is transcoded and it isn't mixed
+        """
+        loop = asyncio.get_running_loop()
+        opus = track.opus and not pcm
+        prepare = lambda index: loop.call_soon_threadsafe(self._prepare_item, sequence, track, index)
+        on_item = lambda index: loop.call_soon_threadsafe(self._item_started, track, index)
+        # Every requested item is supplied, after waiting for its decoder slot if need be
+        sequence = SequenceSource(len(track.items), opus, prepare, on_item, timeout=None)
+        sequence.start()
+        return sequence
+
+    def _prepare_item(self, sequence: SequenceSource, track: Track, index: int) -> None:
+        """
+        Builds the source of a sequence item on the loop and hands it over once its first frames are decoded
+        in an executor
+        """
+        if sequence.closed:
+            return
+        path = track.items[index]
+        try:
+            # A seek applies to the first item
+            seek = track.seek if index == 0 else None
+            source = PrimedSource(self.make_source(path, pcm=not sequence.opus, seek=seek, opus=sequence.opus))
+        except Exception as e:
+            self.logger.warning(f"Skipping `{path}`: {e}")
+            sequence.supply(index, None)
+            return
+        asyncio.get_running_loop().create_task(self._supply(sequence, index, source))
+
+    async def _supply(self, sequence: SequenceSource, index: int, source: PrimedSource) -> None:
+        await self._prime(source)
+        sequence.supply(index, source)
+
+    def _item_started(self, track: Track, index: int) -> None:
+        """
+        Announces each item of a sequence after the first
+        """
+        track.index = index
+        if index:
+            asyncio.get_running_loop().create_task(self._callback(self.on_start, track))
+
+    async def prewarm(self, track: Track) -> None:
+        """
+        Builds a track's source and decodes its first frames, e.g. while the voice connection comes up
+        """
+        if self._prepare(track):
+            await self._prime(track.source)
+
+    def _prepare(self, track: Track) -> bool:
+        """
+        Builds the source of a track that has none yet, returns False if there is nothing to prime
+        """
+        if track.source is not None:
+            return False
+        try:
+            track.source = self._build(track, pcm=self.policy == MIX)
+        except Exception as e:
+            # Retried when the track comes up
+            self.logger.warning(f"Failed to prepare `{track.path}`: {e}")
+            return False
+        return True
+
+    async def _prime(self, source: PrimedSource) -> None:
+        """
+        Decodes the first frames of a source in an executor
+        """
+        try:
+            await asyncio.get_running_loop().run_in_executor(self.executor, source.prime)
+        except Exception as e:
+            # Playback reads the frames itself
+            self.logger.warning(f"Failed to prime source: {e}")
+
+    def _prepare_next(self) -> None:
+        """
+        Builds and primes the source of the next queued track ahead of time
+        """
+        if self.queue and self._prepare(self.queue[0]):
+            asyncio.get_running_loop().create_task(self._prime(self.queue[0].source))
+
+    def skip(self) -> bool:
+        """
+        Stops the current track so the next one starts
+        """
+        voice_client = self.guild.voice_client
+        if self.current is None or voice_client is None:
+            return False
+        voice_client.stop()
+        return True
+
+    def replace(self, track: Track) -> bool:
+        """
+        Plays a track in place of the current one whatever the policy, e.g. the same sound from another time
+        """
+        if self.current is None or self.guild.voice_client is None:
+            return False
+        self._push(track, front=True)
+        self.skip()
+        return True
+
+    def clear(self) -> int:
+        """
+        Drops every waiting track and returns how many were dropped
+        """
+        count = len(self.queue)
+        while self.queue:
+            self.queue.popleft().discard()
+        return count
+
+    def close(self) -> None:
+        """
+        Stops the player task and drops waiting tracks
+        """
+        self.clear()
+        self._task.cancel()
+
+    async def _run(self) -> None:
+        """
+        Plays queued tracks one after another
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self.queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            track = self.queue.popleft()
+            voice_client = self.guild.voice_client
+            if voice_client is None:
+                # Disconnected while the track was waiting
+                track.discard()
+                continue
+            done = asyncio.Event()
+            self.current = track
+            mixing = self.policy == MIX
+            try:
+                if mixing and track.source is not None and track.source.is_opus():
+                    # Opus passthrough can't be mixed
+                    track.discard()
+                if track.source is None:
+                    track.source = self._build(track, pcm=mixing)
+                if not mixing and not track.source.primed:
+                    # Wait for a decoder slot here rather than on the audio thread
+                    await self._prime(track.source)
+                    voice_client = self.guild.voice_client
+                    if voice_client is None:
+                        self.current = None
+                        track.discard()
+                        continue
+                source = track.source
+                if mixing:
+                    # Later tracks join this mixer instead of waiting
+                    after = lambda: loop.call_soon_threadsafe(self._finish, track)
+                    self.mixer = MixerSource()
+                    self.mixer.add(track.source, track.gain, after)
+                    if not track.source.primed:
+                        loop.create_task(self._prime(track.source))
+                    source = self.mixer
+                voice_client.play(source, after=lambda e: loop.call_soon_threadsafe(done.set))
+                # The voice client owns the source now
+                track.source = None
+            except Exception as e:
+                self.current = None
+                self.mixer = None
+                track.discard()
+                await self._callback(self.on_error, track, e)
+                continue
+            self._prepare_next()
+            # Announce without holding up the next track
+            loop.create_task(self._callback(self.on_start, track))
+            await done.wait()
+            self.current = None
+            if self.mixer is not None:
+                # Mixed tracks report their own end
+                self.mixer = None
+            else:
+                self._finish(track)
+
+    def _first_packet(self, track: Track, now: float) -> None:
+        """
+        Records the time from the play command to the first packet of a track
+        """
+        track.ttfp = now - track.requested
+        asyncio.get_running_loop().create_task(self._callback(self.on_first_packet, track))
+
+    def _finish(self, track: Track) -> None:
+        """
+        Marks a track as finished and runs its callback
+        """
+        track.done = True
+        asyncio.get_running_loop().create_task(self._callback(self.on_finish, track))
+
+    async def _callback(self, callback, *args) -> None:
+        """
+        Runs a track callback without letting its errors stop the player
+        """
+        if callback is None:
+            return
+        try:
+            await callback(*args)
+        except Exception as e:
+            self.logger.error(f"Error in playback callback: {e}")
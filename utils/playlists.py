@@ -0,0 +1,115 @@
+import asyncio
+import json
+import os
+
+# Saved playlists, one <guild id>.json per guild so clusters never write the same file
+PLAYLIST_DIR = "data/playlists"
+# Sounds a playlist or a directory played with `all` may hold
+MAX_ITEMS = 100
+
+
+class PlaylistStore(object):
+    """
+    Named lists of sound paths saved per guild
+
+    Paths are relative to the sound library, a pack sound as <pack name>/<member>, so playlists
+    survive a DataDir change. Files are read and written off the event loop.
+    """
+    def __init__(self, directory: str, logger) -> None:
+        # Directory of the guild files
+        self.directory = directory
+        # Bot logger
+        self.logger = logger
+        # Guild id -> playlist name -> sound paths, read on first use
+        self._guilds = {}
+        # Guild id -> read in progress
+        self._loading = {}
+        # Guild id -> lock that keeps writes of a guild in order
+        self._writing = {}
+
+    def path(self, guild_id: int) -> str:
+        return os.path.join(self.directory, f"{guild_id}.json")
+
+    def read(self, guild_id: int) -> dict:
+        """
+        Reads the playlists of a guild from disk (blocking)
+        """
+        try:
+            with open(self.path(guild_id)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (ValueError, OSError) as e:
+            self.logger.error(f"Failed to read playlists of guild {guild_id}: {e}")
+            return {}
+
+    async def load(self, guild_id: int) -> None:
+        """
+        Reads the playlists of a guild in the executor unless they are loaded, call before any other method
+        """
+        if guild_id in self._guilds:
+            return
+        loading = self._loading.get(guild_id)
+        if loading is None:
+            loading = asyncio.ensure_future(asyncio.get_running_loop().run_in_executor(None, self.read, guild_id))
+            self._loading[guild_id] = loading
+        try:
+            playlists = await asyncio.shield(loading)
+        finally:
+            if self._loading.get(guild_id) is loading and loading.done():
+                del self._loading[guild_id]
+        self._guilds.setdefault(guild_id, playlists)
+
+    def write(self, guild_id: int, playlists: dict) -> None:
+        """
+        Writes a snapshot of the playlists of a guild to disk (blocking)
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(guild_id)
+        temp = path + ".tmp"
+        with open(temp, "w") as f:
+            json.dump(playlists, f, indent=2)
+        os.replace(temp, path)
+
+    async def save(self, guild_id: int) -> None:
+        """
+        Writes the playlists of a guild in the executor, from a copy taken on the loop
+        """
+        lock = self._writing.setdefault(guild_id, asyncio.Lock())
+        async with lock:
+            # Taken once the previous write is done, so the newest state is written last
+            snapshot = {name: list(paths) for name, paths in self._playlists(guild_id).items()}
+            await asyncio.get_running_loop().run_in_executor(None, self.write, guild_id, snapshot)
+
+    def _playlists(self, guild_id: int) -> dict:
+        return self._guilds.setdefault(guild_id, {})
+
+    def names(self, guild_id: int) -> list:
+        return sorted(self._playlists(guild_id), key=str.casefold)
+
+    def _key(self, guild_id: int, name: str) -> str:
+        for key in self._playlists(guild_id):
+            if key.casefold() == name.casefold():
+                return key
+        return None
+
+    def get(self, guild_id: int, name: str) -> list:
+        """
+        Gets the sound paths of a playlist (case-insensitive), or None if there is none
+        """
+        key = self._key(guild_id, name)
+        return list(self._playlists(guild_id)[key]) if key is not None else None
+
+    def put(self, guild_id: int, name: str, paths: list) -> None:
+        """
+        Saves a playlist, replacing one with the same name
+        """
+        self.delete(guild_id, name)
+        self._playlists(guild_id)[name] = list(paths[:MAX_ITEMS])
+
+    def delete(self, guild_id: int, name: str) -> bool:
+        key = self._key(guild_id, name)
+        if key is None:
+            return False
+        del self._playlists(guild_id)[key]
+        return True
@@ -0,0 +1,229 @@
+import heapq
+import itertools
+import os
+from collections import defaultdict
+
+from utils.sound_index import SOUND_EXT
+
+# Kinds of search entries
+FILE = "file"
+DIRECTORY = "directory"
+# Lowest trigram similarity accepted as a fuzzy match
+MIN_SCORE = 0.3
+# Names scored per fuzzy lookup, taken from the postings of the query's rarest trigrams
+MAX_CANDIDATES = 1000
+# Shortest query a sound is guessed from by prefix, and lowest similarity of a guessed fuzzy match
+MIN_GUESS_LENGTH = 3
+MIN_GUESS_SCORE = 0.5
+
+
+def trigrams(text: str) -> set:
+    """
+    Gets the padded trigrams of a case-folded string
+    """
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class Entry(object):
+    """
+    A searchable sound or top-level directory
+    """
+    __slots__ = ("key", "name", "kind", "path", "rel", "grams")
+
+    def __init__(self, name: str, kind: str, path: str, rel: str) -> None:
+        # Case-folded name
+        self.key = name.casefold()
+        # Name shown to users
+        self.name = name
+        # FILE or DIRECTORY
+        self.kind = kind
+        # Sound file path, or the directory name for directories
+        self.path = path
+        # Relative dir the entry was indexed from
+        self.rel = rel
+        # Trigrams of the name
+        self.grams = trigrams(self.key)
+
+
+class SoundSearch(object):
+    """
+    Prefix trie plus trigram index over all sound and directory names
+    """
+    def __init__(self, index) -> None:
+        # Sound index the names come from
+        self.index = index
+        # Entry id -> Entry
+        self._entries = {}
+        self._next_id = 0
+        # Relative dir -> ids of entries indexed from it
+        self._by_rel = defaultdict(set)
+        # Trie of nested dicts, ids stored under the "" key of terminal nodes
+        self._trie = {}
+        # Trigram -> ids of entries containing it
+        self._grams = defaultdict(set)
+        # Case-folded name -> ids of entries with exactly that name
+        self._exact = defaultdict(set)
+
+    """ ------------------------------------------ Building ------------------------------------------------ """
+    def build(self) -> None:
+        """
+        Indexes every name in the sound index
+        """
+        self._entries.clear()
+        self._by_rel.clear()
+        self._trie.clear()
+        self._grams.clear()
+        self._exact.clear()
+        self.refresh(self.index.directories())
+
+    def refresh(self, rels) -> None:
+        """
+        Re-indexes the names of the given relative dirs
+        """
+        for rel in rels:
+            for entry_id in self._by_rel.pop(rel, ()):
+                self._remove(entry_id)
+            listing = self.index.listing(rel)
+            if listing is None:
+                continue
+            subdirs, files = listing
+            path = self.index.abspath(rel)
+            for file in files:
+                self._add(Entry(file[:-len(SOUND_EXT)], FILE, os.path.join(path, file), rel))
+            if rel == "":
+                # Top-level directories can be played by name
+                for name in subdirs:
+                    self._add(Entry(name, DIRECTORY, name, rel))
+
+    def _add(self, entry: Entry) -> None:
+        """
+        Adds an entry to the trie and the trigram index
+        """
+        entry_id = self._next_id
+        self._next_id += 1
+        self._entries[entry_id] = entry
+        self._by_rel[entry.rel].add(entry_id)
+        self._exact[entry.key].add(entry_id)
+        node = self._trie
+        for char in entry.key:
+            node = node.setdefault(char, {})
+        node.setdefault("", set()).add(entry_id)
+        for gram in entry.grams:
+            self._grams[gram].add(entry_id)
+
+    def _remove(self, entry_id: int) -> None:
+        """
+        Removes an entry from the trie and the trigram index
+        """
+        entry = self._entries.pop(entry_id)
+        exact = self._exact[entry.key]
+        exact.discard(entry_id)
+        if not exact:
+            del self._exact[entry.key]
+        # Walk down, then prune nodes that became empty on the way back up
+        path = [self._trie]
+        for char in entry.key:
+            path.append(path[-1][char])
+        path[-1][""].discard(entry_id)
+        if not path[-1][""]:
+            del path[-1][""]
+        for char, parent in zip(reversed(entry.key), reversed(path[:-1])):
+            if parent[char]:
+                break
+            del parent[char]
+        for gram in entry.grams:
+            postings = self._grams[gram]
+            postings.discard(entry_id)
+            if not postings:
+                del self._grams[gram]
+
+    """ ------------------------------------------ Lookups ------------------------------------------------ """
+    def prefix(self, query: str, limit: int = 10) -> list:
+        """
+        Gets up to limit entries whose name starts with query, shortest names first
+        """
+        node = self._trie
+        for char in query.casefold():
+            node = node.get(char)
+            if node is None:
+                return []
+        # Breadth first so shorter (closer) names come first
+        found, level = [], [node]
+        while level and len(found) < limit:
+            next_level = []
+            for current in level:
+                for key, child in sorted(current.items()):
+                    if key == "":
+                        found.extend(self._entries[entry_id] for entry_id in child)
+                    else:
+                        next_level.append(child)
+            level = next_level
+        return found[:limit]
+
+    def fuzzy(self, query: str, limit: int = 10) -> list:
+        """
+        Gets up to limit (score, entry) pairs ranked by trigram similarity
+
+        Candidates come from the query's rarest trigrams first: grams like "  d" or "dir" are shared by most of
+        the library and would make every lookup walk it, while a close match shares the rare ones too.
+        """
+        grams = trigrams(query.casefold())
+        postings = sorted((self._grams[gram] for gram in grams if gram in self._grams), key=len)
+        candidates = set()
+        for ids in postings:
+            if len(candidates) + len(ids) > MAX_CANDIDATES:
+                if not candidates:
+                    # Every gram is common, a sample of the rarest still finds names that share it
+                    candidates.update(itertools.islice(ids, MAX_CANDIDATES))
+                break
+            candidates |= ids
+        scored = []
+        for entry_id in candidates:
+            entry = self._entries[entry_id]
+            # Dice coefficient of the two trigram sets
+            scored.append((2 * len(grams & entry.grams) / (len(grams) + len(entry.grams)), entry))
+        return heapq.nsmallest(limit, scored, key=lambda pair: (-pair[0], len(pair[1].key), pair[1].key))
+
+    def search(self, query: str, limit: int = 10) -> list:
+        """
+        Gets the best matches for query: exact, then prefix, then fuzzy
+        """
+        key = query.casefold()
+        results = [self._entries[entry_id] for entry_id in self._exact.get(key, ())]
+        if len(results) >= limit:
+            return results[:limit]
+        seen = {id(entry) for entry in results}
+        for entry in self.prefix(query, limit):
+            if id(entry) not in seen:
+                seen.add(id(entry))
+                results.append(entry)
+        if len(results) < limit:
+            for score, entry in self.fuzzy(query, limit):
+                if score < MIN_SCORE or id(entry) in seen:
+                    continue
+                seen.add(id(entry))
+                results.append(entry)
+        return results[:limit]
+
+    def best(self, query: str) -> Entry:
+        """
+        Gets the match that may stand in for query, or None if no match is close enough to guess
+        """
+        key = query.casefold()
+        exact = self._exact.get(key)
+        if exact:
+            return self._entries[min(exact)]
+        # A letter or two prefixes too many sounds to pick one
+        if len(key) < MIN_GUESS_LENGTH:
+            return None
+        prefixed = self.prefix(query, 1)
+        if prefixed:
+            return prefixed[0]
+        for score, entry in self.fuzzy(query, 1):
+            if score >= MIN_GUESS_SCORE:
+                return entry
+        return None
+
+    def __len__(self) -> int:
+        return len(self._entries)
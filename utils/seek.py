@@ -0,0 +1,235 @@
+import os
+import re
+import struct
+import threading
+from array import array
+from collections import OrderedDict
+
+from utils.decoders import input_view
+
+# Frame offset indexes, one <content hash>.idx per sound next to the other cache metadata
+FRAME_INDEX_DIR = "data/audio/cache/frames"
+# Index file header: magic, sample rate, samples per frame
+INDEX_HEADER = struct.Struct("<4sII")
+INDEX_MAGIC = b"MP3I"
+# Indexes kept in memory
+INDEX_ENTRIES = 64
+# Frames decoded before the seek target so the bit reservoir is filled when it is reached
+PRIMING_FRAMES = 10
+# Timestamps look like 83, 1:23, 1:02:03 or 1:23.5, optionally with a leading @
+TIMESTAMP = re.compile(r"^@?(?:(\d+):)?(?:(\d+):)?(\d+(?:\.\d+)?)$")
+
+# Bitrates in kbit/s by (MPEG-1, layer) and (MPEG-2/2.5, layer), indexed by the header's bitrate bits
+BITRATES = {
+    (True, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (True, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (True, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (False, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (False, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (False, 3): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+# Sample rates of MPEG-1; MPEG-2 halves them and MPEG-2.5 quarters them
+SAMPLE_RATES = (44100, 48000, 32000)
+# Tags of the info frame encoders put first, which holds no audio
+INFO_TAGS = (b"Xing", b"Info", b"VBRI")
+
+
+def parse_timestamp(text: str) -> float:
+    """
+    Parses [@][h:]m:ss[.fff] or plain seconds, raising ValueError for anything else
+    """
+    match = TIMESTAMP.match(text.strip())
+    if match is None:
+        raise ValueError(f"`{text}` is not a time, use m:ss or seconds")
+    parts = [float(part) for part in match.groups() if part is not None]
+    seconds = 0.0
+    for part in parts:
+        seconds = seconds * 60 + part
+    return seconds
+
+
+def format_timestamp(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
+
+
+def frame_header(data, pos: int) -> tuple:
+    """
+    Parses the MPEG audio frame header at pos into (frame length, sample rate, samples per frame, version key),
+    or returns None if there is none
+    """
+    if pos + 4 > len(data) or data[pos] != 0xFF or data[pos + 1] & 0xE0 != 0xE0:
+        return None
+    b1, b2 = data[pos + 1], data[pos + 2]
+    version = (b1 >> 3) & 0x3
+    layer = 4 - ((b1 >> 1) & 0x3)
+    bitrate_bits, rate_bits = b2 >> 4, (b2 >> 2) & 0x3
+    # Reserved version and layer, free format and invalid bitrates, reserved sample rate
+    if version == 1 or layer == 4 or bitrate_bits in (0, 15) or rate_bits == 3:
+        return None
+    mpeg1 = version == 3
+    bitrate = BITRATES[mpeg1, layer][bitrate_bits] * 1000
+    sample_rate = SAMPLE_RATES[rate_bits] >> (0 if mpeg1 else 1 if version == 2 else 2)
+    padding = (b2 >> 1) & 0x1
+    if layer == 1:
+        return (12 * bitrate // sample_rate + padding) * 4, sample_rate, 384, b1 & 0xFE
+    samples = 576 if layer == 3 and not mpeg1 else 1152
+    return samples // 8 * bitrate // sample_rate + padding, sample_rate, samples, b1 & 0xFE
+
+
+def id3_size(data) -> int:
+    """
+    Gets the length of a leading ID3v2 tag, 0 if there is none
+    """
+    if len(data) < 10 or bytes(data[:3]) != b"ID3":
+        return 0
+    size = 0
+    for byte in data[6:10]:
+        size = (size << 7) | (byte & 0x7F)
+    # Footer flag
+    return 10 + size + (10 if data[5] & 0x10 else 0)
+
+
+class FrameIndex(object):
+    """
+    Byte offsets of every audio frame of an MP3, so a timestamp maps to a byte offset in one lookup
+    """
+    __slots__ = ("sample_rate", "samples_per_frame", "offsets")
+
+    def __init__(self, sample_rate: int, samples_per_frame: int, offsets: array) -> None:
+        self.sample_rate = sample_rate
+        self.samples_per_frame = samples_per_frame
+        # Frame number -> byte offset of its header
+        self.offsets = offsets
+
+    @classmethod
+    def scan(cls, data) -> "FrameIndex":
+        """
+        Walks the frame headers of an MP3 once, resyncing past junk between frames
+        """
+        offsets = array("I")
+        pos, end = id3_size(data), len(data)
+        first = None
+        while pos + 4 <= end:
+            header = frame_header(data, pos)
+            # Lock on to the first frame whose successor is a frame too, later frames must match it
+            if header is not None and first is None:
+                following = frame_header(data, pos + header[0])
+                if following is None or following[3] != header[3]:
+                    header = None
+                else:
+                    first = header
+            if header is None or header[1:] != first[1:]:
+                if bytes(data[pos:pos + 3]) == b"TAG":
+                    # ID3v1 tag at the end
+                    break
+                pos += 1
+                continue
+            offsets.append(pos)
+            pos += header[0]
+        if first is None:
+            raise ValueError("no MPEG audio frames found")
+        if any(tag in bytes(data[offsets[0] + 4:offsets[0] + 40]) for tag in INFO_TAGS):
+            # The info frame isn't audio
+            del offsets[0]
+        return cls(first[1], first[2], offsets)
+
+    @property
+    def frame_seconds(self) -> float:
+        return self.samples_per_frame / self.sample_rate
+
+    @property
+    def duration(self) -> float:
+        return len(self.offsets) * self.frame_seconds
+
+    def locate(self, seconds: float) -> tuple:
+        """
+        Gets (byte offset to start decoding at, seconds of decoded audio to drop) for a timestamp
+        """
+        frame = int(seconds / self.frame_seconds)
+        if frame >= len(self.offsets):
+            raise ValueError(f"past the end ({format_timestamp(self.duration)})")
+        start = max(0, frame - PRIMING_FRAMES)
+        return self.offsets[start], seconds - start * self.frame_seconds
+
+    def save(self, path: str) -> None:
+        temp = path + ".tmp"
+        with open(temp, "wb") as f:
+            f.write(INDEX_HEADER.pack(INDEX_MAGIC, self.sample_rate, self.samples_per_frame))
+            self.offsets.tofile(f)
+        os.replace(temp, path)
+
+    @classmethod
+    def load(cls, path: str) -> "FrameIndex":
+        with open(path, "rb") as f:
+            magic, sample_rate, samples_per_frame = INDEX_HEADER.unpack(f.read(INDEX_HEADER.size))
+            if magic != INDEX_MAGIC:
+                raise ValueError("not a frame index")
+            offsets = array("I")
+            count = (os.fstat(f.fileno()).st_size - INDEX_HEADER.size) // offsets.itemsize
+            offsets.fromfile(f, count)
+        return cls(sample_rate, samples_per_frame, offsets)
+
+
+class FrameIndexStore(object):
+    """
+    Frame indexes keyed by content hash, built on the first seek into a sound and kept on disk
+    """
+    def __init__(self, directory: str, logger, entries: int = INDEX_ENTRIES) -> None:
+        # Directory of <content hash>.idx files
+        self.directory = directory
+        # Bot logger
+        self.logger = logger
+        # Indexes kept in memory
+        self.entries = entries
+        # Content hash -> FrameIndex, least recently used first
+        self._indexes = OrderedDict()
+        # Lookups run in executor threads
+        self._lock = threading.Lock()
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.directory, f"{digest}.idx")
+
+    def get(self, digest: str, path: str) -> FrameIndex:
+        """
+        Gets the frame index of a sound, loading or building it on first use (blocking)
+        """
+        with self._lock:
+            index = self._indexes.get(digest)
+            if index is not None:
+                self._indexes.move_to_end(digest)
+                return index
+        try:
+            index = FrameIndex.load(self.path(digest))
+        except FileNotFoundError:
+            index = self.build(digest, path)
+        except (ValueError, OSError, struct.error) as e:
+            self.logger.warning(f"Rebuilding frame index of `{path}`: {e}")
+            index = self.build(digest, path)
+        with self._lock:
+            self._indexes[digest] = index
+            while len(self._indexes) > self.entries:
+                self._indexes.popitem(last=False)
+        return index
+
+    def build(self, digest: str, path: str) -> FrameIndex:
+        """
+        Scans a sound's frames and stores the index (blocking)
+        """
+        with input_view(path) as data:
+            index = FrameIndex.scan(data)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            index.save(self.path(digest))
+        except OSError as e:
+            # Still usable from memory
+            self.logger.error(f"Failed to store frame index of `{path}`: {e}")
+        self.logger.debug(f"Indexed {len(index.offsets)} frames of `{path}`")
+        return index
+
+    def locate(self, digest: str, path: str, seconds: float) -> tuple:
+        """
+        Gets (byte offset, seconds to drop) to start a sound at a timestamp (blocking)
+        """
+        return self.get(digest, path).locate(seconds)
@@ -1,255 +1,263 @@
-import re
-from pathlib import Path
-from typing import Dict, Tuple
+import asyncio
+import dataclasses
+import os
+import signal
+import typing
 
-import toml
+try:
+    import tomllib
+except ModuleNotFoundError:
+    # Python 3.10 (the Docker image) has no tomllib
+    import tomli as tomllib
 
-config = dict  # autocomplete
+from utils.logs import FORMATS, LEVELS
 
+# Config file read from the working directory
+CONFIG_FILE = "config.toml"
 
-def crawl(obj: dict, func=lambda x, y: print(x, y, end="\n"), path=None):
-    if path is None:  # path Default argument value is mutable
-        path = []
-    for key in obj.keys():
-        if type(obj[key]) is dict:
-            crawl(obj[key], func, path + [key])
-            continue
-        func(path + [key], obj[key])
 
+class ConfigError(ValueError):
+    """
+    Raised when the config file can't be parsed or a value is invalid
+    """
 
-def check(value, checks, name):
 
-    def get_check_value(key, default_result):
-        return checks[key] if key in checks else default_result
+def option(section: str, key: str, default, env: str = None, minimum: float = None, choices: tuple = None,
+           restart: bool = False):
+    """
+    Declares a config value read from [section] key, overridden by the env variable if it is set
+    """
+    metadata = {"section": section, "key": key, "env": env, "minimum": minimum, "choices": choices, "restart": restart}
+    if isinstance(default, list):
+        return dataclasses.field(default_factory=lambda: list(default), metadata=metadata)
+    return dataclasses.field(default=default, metadata=metadata)
 
-    incorrect = False
-    if value == {}:
-        incorrect = True
-    if not incorrect and "type" in checks:
-        try:
-            value = eval(checks["type"])(value)
-        except:
-            incorrect = True
-    # FAILSTATE Value is not one of the options
-    if not incorrect and "options" in checks and value not in checks["options"]:
-        incorrect = True
-    # FAILSTATE Value doesn't match regex, or has regex but is not a string.
-    if (
-        not incorrect
-        and "regex" in checks
-        and (
-            (isinstance(value, str) and re.match(checks["regex"], value) is None)
-            or not isinstance(value, str)
-        )
-    ):
-        incorrect = True
-
-    if (
-        not incorrect
-        and not hasattr(value, "__iter__")
-        and (
-            ("nmin" in checks and checks["nmin"] is not None and value < checks["nmin"])
-            or (
-                "nmax" in checks
-                and checks["nmax"] is not None
-                and value > checks["nmax"]
-            )
-        )
-    ):
-        incorrect = True
-    if (
-        not incorrect
-        and hasattr(value, "__iter__")
-        and (
-            (
-                "nmin" in checks
-                and checks["nmin"] is not None
-                and len(value) < checks["nmin"]
-            )
-            or (
-                "nmax" in checks
-                and checks["nmax"] is not None
-                and len(value) > checks["nmax"]
-            )
-        )
-    ):
-        incorrect = True
-
-    if incorrect:
-        value = handle_input(
-            message=(
-                (
-                    ("\nExample: " + str(checks["example"]) + "\n")
-                    if "example" in checks
-                    else ""
-                )
-                + ("Non-optional ", "Optional ")[
-                    "optional" in checks and checks["optional"] is True
-                ]
-            )
-            + str(name),
-            extra_info=get_check_value("explanation", ""),
-            check_type=eval(get_check_value("type", "False")),
-            default=get_check_value("default", NotImplemented),
-            match=get_check_value("regex", ""),
-            err_message=get_check_value("input_error", "Incorrect input"),
-            nmin=get_check_value("nmin", None),
-            nmax=get_check_value("nmax", None),
-            oob_error=get_check_value(
-                "oob_error", "Input out of bounds(Value too high/low/long/short)"
-            ),
-            options=get_check_value("options", None),
-            optional=get_check_value("optional", False),
-        )
-    return value
-
-
-def handle_input(
-    message: str = "",
-    check_type=False,
-    match: str = "",
-    err_message: str = "",
-    nmin=None,
-    nmax=None,
-    oob_error="",
-    extra_info="",
-    options: list = None,
-    default=NotImplemented,
-    optional=False,
-):
-    if optional:
-        print(message + "\nThis is an optional value. Do you want to skip it? (y/n)")
-        if input().casefold().startswith("y"):
-            return default if default is not NotImplemented else ""
-    if default is not NotImplemented:
-        print(
-            message
-            + '\nThe default value is "'
-            + str(default)
-            + '"\nDo you want to use it?(y/n)'
-        )
-        if input().casefold().startswith("y"):
-            return default
-    if options is None:
-        match = re.compile(match)
-        print(extra_info)
-        while True:
-            print(message + "=", end="")
-            user_input = input("").strip()
-            if check_type is not False:
-                try:
-                    user_input = check_type(user_input)
-                    if (nmin is not None and user_input < nmin) or (
-                        nmax is not None and user_input > nmax
-                    ):
-                        # FAILSTATE Input out of bounds
-                        print(oob_error)
-                        continue
-                    break  # Successful type conversion and number in bounds
-                except ValueError:
-                    # Type conversion failed
-                    print(err_message)
-                    continue
-            elif match != "" and re.match(match, user_input) is None:
-                print(+err_message + "\nAre you absolutely sure it's correct?(y/n)")
-                if input().casefold().startswith("y"):
-                    break
-                continue
-            else:
-                # FAILSTATE Input STRING out of bounds
-                if (nmin is not None and len(user_input) < nmin) or (
-                    nmax is not None and len(user_input) > nmax
-                ):
-                    print(oob_error)
+
+@dataclasses.dataclass(frozen=True)
+class Config(object):
+    """
+    Typed bot settings; options marked restart only apply on the next start
+    """
+    discord_bot_token: typing.Optional[str] = option("General", "DiscordBotToken", None, env="DISCORD_BOT_TOKEN", restart=True)
+    message_content: bool = option("General", "MessageContent", True, restart=True)
+    message_cache: int = option("General", "MessageCache", 100, minimum=0, restart=True)
+    data_dir: str = option("Sounds", "DataDir", "data/audio/sounds")
+    packs_dir: str = option("Sounds", "PacksDir", "data/audio/packs")
+    frame_cache_mb: int = option("Cache", "FrameCacheMB", 64, minimum=0)
+    frame_cache_seconds: float = option("Cache", "FrameCacheSeconds", 5.0, minimum=0)
+    preload_sounds: int = option("Cache", "PreloadSounds", 32, minimum=0)
+    decoder_limit: int = option("Decoders", "MaxProcesses", 8, minimum=1)
+    decoder_queue: int = option("Decoders", "MaxWaiting", 16, minimum=0)
+    decoder_timeout: float = option("Decoders", "WaitTimeout", 10.0, minimum=0)
+    decoder_warm: int = option("Decoders", "WarmProcesses", 2, minimum=0)
+    idle_timeout: float = option("Voice", "IdleTimeout", 300.0, minimum=0)
+    connect_timeout: float = option("Voice", "ConnectTimeout", 15.0, minimum=1)
+    autojoin_channels: typing.List[int] = option("Voice", "AutojoinChannels", [], env="AUTOJOIN_CHANNELS")
+    log_level: str = option("Logging", "Level", "DEBUG", env="LOG_LEVEL", choices=LEVELS)
+    discord_log_level: str = option("Logging", "DiscordLevel", "WARNING", choices=LEVELS)
+    log_format: str = option("Logging", "Format", "text", env="LOG_FORMAT", choices=FORMATS)
+    log_sample_burst: int = option("Logging", "SampleBurst", 5, minimum=0)
+    log_sample_window: float = option("Logging", "SampleWindow", 60.0, minimum=0)
+    metrics_host: str = option("Metrics", "Host", "127.0.0.1", env="METRICS_HOST", restart=True)
+    metrics_port: int = option("Metrics", "Port", 9108, env="METRICS_PORT", minimum=0, restart=True)
+
+
+def _converter(kind):
+    """
+    Builds the check for one annotated type; convert(value, text) returns the value or raises ValueError,
+    text is set for strings from the environment
+    """
+    if typing.get_origin(kind) is typing.Union:
+        # Optional[X]
+        inner = _converter(typing.get_args(kind)[0])
+        return lambda value, text: None if value is None else inner(value, text)
+    if typing.get_origin(kind) is list:
+        item = _converter(typing.get_args(kind)[0])
+
+        def convert_list(value, text):
+            if text:
+                # Comma-separated
+                value = [part.strip() for part in value.split(",") if part.strip()]
+            if not isinstance(value, list):
+                raise ValueError("expected a list")
+            return [item(part, text) for part in value]
+        return convert_list
+    if kind is bool:
+        def convert_bool(value, text):
+            if text and value.lower() in ("1", "true", "yes", "0", "false", "no"):
+                return value.lower() in ("1", "true", "yes")
+            if not isinstance(value, bool):
+                raise ValueError("expected true or false")
+            return value
+        return convert_bool
+    if kind in (int, float):
+        def convert_number(value, text):
+            if text:
+                return kind(value)
+            # bool is an int subclass but never a valid number here
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                raise ValueError("expected a number")
+            if kind is int and isinstance(value, float):
+                raise ValueError("expected a whole number")
+            return kind(value)
+        return convert_number
+
+    def convert_str(value, text):
+        if not isinstance(value, str):
+            raise ValueError("expected a string")
+        return value
+    return convert_str
+
+
+def compile_validator(cls=Config):
+    """
+    Builds the validator of a config dataclass once, so loads only run plain checks
+    """
+    hints = typing.get_type_hints(cls)
+    checks = []
+    for field in dataclasses.fields(cls):
+        meta = field.metadata
+        checks.append((
+            field.name, meta["section"], meta["key"], meta["env"], meta["minimum"], meta["choices"],
+            _converter(hints[field.name]),
+        ))
+
+    def validate(raw: dict) -> Config:
+        values, errors = {}, []
+        for name, section, key, env, minimum, choices, convert in checks:
+            value = os.environ.get(env) if env else None
+            source, text = env, value is not None
+            if value is None:
+                table = raw.get(section, {})
+                if key not in table:
+                    # Field default
                     continue
-                break  # SUCCESS Input STRING in bounds
-        return user_input
-    print(extra_info)
-    while True:
-        print(message, end="")
-        user_input = input("").strip()
-        if check_type is not False:
+                value, source = table[key], f"[{section}] {key}"
             try:
-                isinstance(eval(user_input), check_type)
-                return check_type(user_input)
-            except:
-                print(
-                    err_message
-                    + "\nValid options are: "
-                    + ", ".join(map(str, options))
-                    + "."
-                )
+                value = convert(value, text)
+            except (TypeError, ValueError) as e:
+                errors.append(f"{source}: {e}")
                 continue
-        if user_input in options:
-            return user_input
-        print(
-            err_message + "\nValid options are: " + ", ".join(map(str, options)) + "."
-        )
-
-
-def crawl_and_check(obj: dict, path: list, checks: dict = {}, name=""):
-    if len(path) == 0:
-        return check(obj, checks, name)
-    if path[0] not in obj.keys():
-        obj[path[0]] = {}
-    obj[path[0]] = crawl_and_check(obj[path[0]], path[1:], checks, path[0])
-    return obj
-
-
-def check_vars(path, checks):
-    global config
-    crawl_and_check(config, path, checks)
-
-
-def check_toml(template_file, config_file) -> Tuple[bool, Dict]:
-    global config, check_vars
-    config = None
-
-    # attempt to load template file
-    try:
-        template = toml.load(template_file)
-    except Exception as error:
-        print(f"Encountered error when trying to to load {template_file}: {error}")
-        print(error)
-        return False
-
-    # attempt to config template file
-    try:
-        config = toml.load(config_file)
-    # if file can't be read
-    except toml.TomlDecodeError:
-        print(f"""Couldn't read {config_file}.Overwrite it?(y/n)""")
-        # attempt to overwrite config file
-        if not input().startswith("y"):
-            print("Unable to read config, and not allowed to overwrite it. Giving up.")
-            return False
-        else:
+            if minimum is not None and value is not None and value < minimum:
+                errors.append(f"{source}: must be at least {minimum}")
+                continue
+            if choices is not None and value not in choices:
+                errors.append(f"{source}: must be one of {', '.join(choices)}")
+                continue
+            values[name] = value
+        if errors:
+            raise ConfigError("; ".join(errors))
+        return cls(**values)
+    return validate
+
+
+validate = compile_validator()
+
+
+class ConfigLoader(object):
+    """
+    Loads config.toml without prompting, caches the result and reloads it when the file changes or on SIGHUP
+    """
+    def __init__(self, path: str = CONFIG_FILE, logger=None) -> None:
+        # Config file
+        self.path = path
+        # Bot logger, set once the bot has one
+        self.logger = logger
+        # Parsed config and the (mtime, size) of the file it came from
+        self.config = None
+        self._stamp = None
+        # Callbacks run with (old config, new config) after a reload
+        self._listeners = []
+        self._task = None
+
+    def _file_stamp(self) -> tuple:
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def load(self) -> Config:
+        """
+        Gets the config, parsing the file only if it changed since the last load
+        """
+        stamp = self._file_stamp()
+        if self.config is not None and stamp == self._stamp:
+            return self.config
+        raw = {}
+        if stamp is not None:
             try:
-                with open(config_file, "w") as f:
-                    f.write("")
-            except:
-                print(
-                    f"Failed to overwrite {config_file}. Giving up.\nSuggestion: check {config_file} permissions for the user."
-                )
-                return False
-    # if file isn't found
-    except FileNotFoundError:
-        print(f"""Couldn't find {config_file} Creating it now.""")
+                with open(self.path, "rb") as f:
+                    raw = tomllib.load(f)
+            except tomllib.TOMLDecodeError as e:
+                raise ConfigError(f"{self.path}: {e}") from e
+        self.config = validate(raw)
+        self._stamp = stamp
+        return self.config
+
+    def add_listener(self, callback) -> None:
+        self._listeners.append(callback)
+
+    def reload(self) -> bool:
+        """
+        Re-reads the file if it changed and notifies listeners, keeping the old config if the new one is invalid
+        """
+        old = self.config
         try:
-            with open(config_file, "x") as f:
-                f.write("")
-            config = {}
-        except:
-            print(
-                f"Failed to write to {config_file}. Giving up.\nSuggestion: check the folder's permissions for the user."
-            )
+            new = self.load()
+        except (ConfigError, OSError) as e:
+            # Keep serving the old config until the file changes again
+            self._stamp = self._file_stamp()
+            self.logger.error(f"Config not reloaded: {e}")
             return False
+        if new is old or new == old:
+            return False
+        changed = [field.name for field in dataclasses.fields(Config) if getattr(old, field.name) != getattr(new, field.name)]
+        self.logger.info(f"Config reloaded: {', '.join(changed)} changed")
+        restart = [field.name for field in dataclasses.fields(Config) if field.metadata["restart"] and field.name in changed]
+        if restart:
+            self.logger.warning(f"Restart to apply: {', '.join(restart)}")
+        for listener in self._listeners:
+            try:
+                listener(old, new)
+            except Exception as e:
+                self.logger.error(f"Error applying config: {e}")
+        return True
+
+    def watch(self, loop: asyncio.AbstractEventLoop, interval: float = 2.0) -> None:
+        """
+        Reloads on SIGHUP and when the file's mtime or size changes
+        """
+        if self._task is not None:
+            return
+        try:
+            loop.add_signal_handler(signal.SIGHUP, self.reload)
+        except (NotImplementedError, AttributeError, RuntimeError):
+            # No SIGHUP on Windows, the file is still polled
+            pass
+        self._task = loop.create_task(self._poll(interval))
+
+    async def _poll(self, interval: float) -> None:
+        """
+        Checks the file stamp, a single stat per interval
+        """
+        while True:
+            await asyncio.sleep(interval)
+            if self._file_stamp() != self._stamp:
+                self.reload()
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
 
-    crawl(template, check_vars)
-    with open(config_file, "w") as f:
-        toml.dump(config, f)
-    return config
+# Shared loader, the parsed config is cached on it
+loader = ConfigLoader()
 
 
-directory = Path().absolute()
-check_toml(f"{directory}/utils/.config.template.toml", "config.toml")
+def load() -> Config:
+    """
+    Gets the cached config of config.toml
+    """
+    return loader.load()
@@ -0,0 +1,591 @@
+import asyncio
+import ctypes
+import ctypes.util
+import os
+import re
+import struct
+
+from utils import packs
+
+# Extension of playable sound files
+SOUND_EXT = ".mp3"
+
+# inotify flags (see inotify(7))
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+EVENT_HEADER = struct.Struct("iIII")
+# Splits names into text and number runs for natural ordering
+NATURAL_SPLIT = re.compile(r"(\d+)")
+
+
+def natural_key(name: str) -> list:
+    """
+    Sort key that orders Dir_2 before Dir_10
+    """
+    return [int(part) if part.isdigit() else part.casefold() for part in NATURAL_SPLIT.split(name)]
+
+
+def track_number(file_name: str) -> int:
+    """
+    Gets the track number of a Dir_N.mp3 file name, or None if it has none
+    """
+    stem = file_name[:-len(SOUND_EXT)]
+    suffix = stem.rsplit('_', 1)[-1]
+    return int(suffix) if suffix.isdigit() else None
+
+
+def scan_dir(path: str) -> tuple:
+    """
+    Lists the sub directories and sound files of a single directory
+    """
+    subdirs, files = [], []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                subdirs.append(entry.name)
+            elif entry.name.endswith(SOUND_EXT):
+                files.append(entry.name)
+    # Keep a stable, case-insensitive order for listing
+    subdirs.sort(key=natural_key)
+    files.sort(key=natural_key)
+    return tuple(subdirs), tuple(files)
+
+
+class SoundIndex(object):
+    """
+    In-memory index of the sound library, built once and refreshed per directory
+    """
+    def __init__(self, root: str, logger, fingerprints=None) -> None:
+        # Sound library root directory
+        self.root = root
+        # Bot logger
+        self.logger = logger
+        # Content hashes of the indexed sounds, optional
+        self.fingerprints = fingerprints
+        # Case-folded top-level dir name -> mounted sound pack
+        self._mounts = {}
+        # Relative dir path -> (sub directory names, sound file names)
+        self._dirs = {}
+        # Case-folded top-level sound name -> file path
+        self._top = {}
+        # Case-folded top-level directory name -> file paths ordered by track number
+        self._tracks = {}
+        # Bumped on every change so consumers can invalidate caches
+        self.version = 0
+        # Callbacks run with the set of changed relative dir paths
+        self._listeners = []
+
+    """ ------------------------------------------ Building ------------------------------------------------ """
+    def build(self) -> None:
+        """
+        Scans the whole library once
+        """
+        self._dirs.clear()
+        self._top.clear()
+        self._tracks.clear()
+        if not os.path.isdir(self.root):
+            self.logger.error(f"Sound directory `{self.root}` not found")
+            return
+        # Walk the tree with one scandir per directory
+        pending = [""]
+        while pending:
+            rel = pending.pop()
+            try:
+                subdirs, files = scan_dir(self.abspath(rel))
+            except OSError as e:
+                self.logger.error(f"Failed to scan `{rel}`: {e}")
+                continue
+            self._apply(rel, *self._with_mounts(rel, (subdirs, files)))
+            pending.extend(os.path.join(rel, name) for name in subdirs)
+        for pack in self._mounts.values():
+            self._apply_pack(pack)
+        self.version += 1
+        self.logger.info(f"Sound index built: {self.sound_count()} sounds in {len(self._dirs)} directories")
+
+    def scan(self, rels: set) -> dict:
+        """
+        Rescans the given directories without touching the index, safe to run off the event loop
+        """
+        results = {}
+        pending = list(rels)
+        while pending:
+            rel = pending.pop()
+            if rel in results or self._pack_of(rel) is not None:
+                # Packs never change while mounted
+                continue
+            try:
+                entry = scan_dir(self.abspath(rel))
+            except (FileNotFoundError, NotADirectoryError):
+                # Directory is gone
+                results[rel] = None
+                continue
+            except OSError as e:
+                self.logger.error(f"Failed to scan `{rel}`: {e}")
+                continue
+            results[rel] = entry
+            old = self._dirs.get(rel)
+            old_subdirs = set(old[0]) if old else set()
+            # New sub directories have never been scanned
+            pending.extend(os.path.join(rel, name) for name in entry[0] if name not in old_subdirs)
+        return results
+
+    def update(self, results: dict) -> set:
+        """
+        Applies scan results and returns every relative dir that changed
+        """
+        changed = set()
+        for rel, entry in results.items():
+            if entry is None:
+                # Drop the directory with everything below it
+                changed |= self._remove(rel)
+                continue
+            entry = self._with_mounts(rel, entry)
+            old = self._dirs.get(rel)
+            if old == entry:
+                continue
+            # Forget sub directories that disappeared
+            for name in (set(old[0]) - set(entry[0])) if old else ():
+                changed |= self._remove(os.path.join(rel, name))
+            self._apply(rel, *entry)
+            changed.add(rel)
+        if "" in changed and "" in self._dirs:
+            # Packs dropped along with the library root come back with it
+            for pack in self._mounts.values():
+                if pack.name not in self._dirs:
+                    changed |= self._apply_pack(pack)
+        if changed:
+            self.version += 1
+            for listener in self._listeners:
+                listener(changed)
+        return changed
+
+    def refresh(self, rels: set) -> set:
+        """
+        Rescans only the given directories and returns every relative dir that changed
+        """
+        return self.update(self.scan(rels))
+
+    async def rebind(self, root: str) -> set:
+        """
+        Points the index at another library directory, rescans it off the loop and returns every changed dir
+        """
+        self.root = root
+        removed = self._remove("")
+        # With nothing indexed every directory counts as new, so this is a full scan
+        results = await asyncio.get_running_loop().run_in_executor(None, self.scan, {""})
+        changed = self.update(results)
+        stale = removed - changed
+        if stale:
+            # Dirs of the old library that no update reported
+            self.version += 1
+            for listener in self._listeners:
+                listener(stale)
+        self.logger.info(f"Sound index moved to `{root}`: {self.sound_count()} sounds in {len(self._dirs)} directories")
+        return changed | stale
+
+    """ ------------------------------------------ Sound Packs ------------------------------------------------ """
+    def mount(self, pack, notify: bool = True) -> bool:
+        """
+        Adds a sound pack as a top-level directory, returns False if the name is taken
+        """
+        key = pack.name.casefold()
+        root = self._dirs.get("")
+        if key in self._mounts or (root is not None and key in (name.casefold() for name in root[0])):
+            self.logger.error(f"Can't mount sound pack `{pack.path}`: `{pack.name}` is already a directory")
+            return False
+        self._mounts[key] = pack
+        if root is not None:
+            if notify:
+                self.update({"": root})
+            else:
+                self._apply("", *self._with_mounts("", root))
+                self._apply_pack(pack)
+                self.version += 1
+        self.logger.info(f"Mounted sound pack `{pack.name}`: {len(pack.members)} members")
+        return True
+
+    def unmount(self, name: str) -> None:
+        """
+        Removes a mounted sound pack and everything below it
+        """
+        pack = self._mounts.pop(name.casefold(), None)
+        if pack is None:
+            return
+        root = self._dirs.get("")
+        if root is not None:
+            self.update({"": (tuple(subdir for subdir in root[0] if subdir != pack.name), root[1])})
+        self.logger.info(f"Unmounted sound pack `{pack.name}`")
+
+    def _with_mounts(self, rel: str, entry: tuple) -> tuple:
+        """
+        Adds the names of mounted packs to the sub directories of the library root
+        """
+        if rel or not self._mounts:
+            return entry
+        subdirs = set(entry[0]) | {pack.name for pack in self._mounts.values()}
+        return tuple(sorted(subdirs, key=natural_key)), entry[1]
+
+    def _apply_pack(self, pack) -> set:
+        """
+        Stores the listing of a mounted pack below its top-level dir, returns the dirs added
+        """
+        added = set()
+        for rel, entry in pack.listing(SOUND_EXT, natural_key).items():
+            rel = os.path.join(pack.name, rel) if rel else pack.name
+            self._apply(rel, *entry)
+            added.add(rel)
+        return added
+
+    def _pack_of(self, rel: str):
+        """
+        Gets the pack a relative dir lies in, or None if it is on disk
+        """
+        if not self._mounts or not rel:
+            return None
+        return self._mounts.get(rel.split(os.sep, 1)[0].casefold())
+
+    def _apply(self, rel: str, subdirs: tuple, files: tuple) -> None:
+        """
+        Stores the scan result of one directory
+        """
+        self._dirs[rel] = (subdirs, files)
+        path = self.abspath(rel)
+        if rel == "":
+            # Top-level sounds are looked up by name
+            self._top = {f[:-len(SOUND_EXT)].casefold(): os.path.join(path, f) for f in files}
+        elif os.sep not in rel:
+            # Top-level directories hold Dir_N.mp3 tracks
+            key = rel.casefold()
+            numbered = [(track_number(f), f) for f in files if f.casefold().startswith(key)]
+            numbered = sorted((n, f) for n, f in numbered if n is not None)
+            self._tracks[key] = tuple(os.path.join(path, f) for _, f in numbered)
+
+    def _remove(self, rel: str) -> set:
+        """
+        Drops a directory and all directories below it
+        """
+        removed = set()
+        if rel not in self._dirs:
+            return removed
+        pending = [rel]
+        while pending:
+            current = pending.pop()
+            entry = self._dirs.pop(current, None)
+            if entry is None:
+                continue
+            removed.add(current)
+            pending.extend(os.path.join(current, name) for name in entry[0])
+            if current == "":
+                self._top = {}
+            elif os.sep not in current:
+                self._tracks.pop(current.casefold(), None)
+        return removed
+
+    def fingerprint(self, rels=None) -> dict:
+        """
+        Hashes new or changed sounds of the given relative dirs, or of the whole library, returns {path: hash} (blocking)
+        """
+        if self.fingerprints is None:
+            return {}
+        paths = list(self.paths(rels))
+        digests = self.fingerprints.hash_all(paths)
+        if rels is None:
+            # Hashes of sounds that left the library
+            self.fingerprints.forget(paths)
+        return digests
+
+    """ ------------------------------------------ Lookups ------------------------------------------------ """
+    def digest(self, path: str) -> str:
+        """
+        Gets the current content hash of a sound, or None until it is fingerprinted
+        """
+        return self.fingerprints.cached(path) if self.fingerprints is not None else None
+
+    def abspath(self, rel: str) -> str:
+        """
+        Joins a relative dir path onto the library root, or onto the archive of a mounted pack
+        """
+        pack = self._pack_of(rel)
+        if pack is not None:
+            inner = rel.split(os.sep, 1)[1] if os.sep in rel else ""
+            root = pack.path + packs.MEMBER_SEP
+            return os.path.join(root, inner) if inner else root
+        return os.path.join(self.root, rel) if rel else self.root
+
+    def relpath(self, path: str) -> str:
+        """
+        Gets a sound path relative to the library, a pack sound as <pack name>/<member>, or None if outside both
+        """
+        member = packs.split_member(path)
+        if member is not None:
+            for pack in self._mounts.values():
+                if pack.path == member[0]:
+                    return os.path.join(pack.name, member[1])
+            return None
+        rel = os.path.relpath(path, self.root)
+        return None if rel == os.pardir or rel.startswith(os.pardir + os.sep) else rel
+
+    def sound_path(self, rel: str) -> str:
+        """
+        Gets the current path of a sound from its relative path, the reverse of relpath
+        """
+        directory, file = os.path.split(rel)
+        return os.path.join(self.abspath(directory), file)
+
+    def top_level(self, name: str) -> str:
+        """
+        Gets the path of a top-level sound by case-insensitive name
+        """
+        return self._top.get(name.casefold())
+
+    def tracks(self, directory: str) -> tuple:
+        """
+        Gets the ordered track paths of a top-level directory, or None if it doesn't exist
+        """
+        return self._tracks.get(directory.casefold())
+
+    def resolve(self, directory: str, track: int) -> str:
+        """
+        Gets the path of track number `track` (1-based) in `directory`
+        """
+        tracks = self._tracks.get(directory.casefold())
+        if not tracks or track < 1 or track > len(tracks):
+            return None
+        return tracks[track - 1]
+
+    def walk(self, top: str = ""):
+        """
+        Yields (relative dir, sub directories, files) top-down like os.walk
+        """
+        pending = [top]
+        while pending:
+            rel = pending.pop()
+            entry = self._dirs.get(rel)
+            if entry is None:
+                continue
+            yield rel, entry[0], entry[1]
+            # Reverse so the first sub directory is popped first
+            pending.extend(os.path.join(rel, name) for name in reversed(entry[0]))
+
+    def listing(self, rel: str) -> tuple:
+        """
+        Gets (sub directories, sound files) of a relative dir, or None if it isn't indexed
+        """
+        return self._dirs.get(rel)
+
+    def directories(self) -> list:
+        """
+        Gets every indexed relative dir path
+        """
+        return list(self._dirs)
+
+    def paths(self, rels=None):
+        """
+        Yields the sound file paths of the given relative dirs, or of the whole library
+        """
+        for rel in (self.directories() if rels is None else rels):
+            entry = self._dirs.get(rel)
+            if entry is None:
+                continue
+            path = self.abspath(rel)
+            for file in entry[1]:
+                yield os.path.join(path, file)
+
+    def sound_count(self) -> int:
+        """
+        Counts indexed sound files
+        """
+        return sum(len(files) for _, files in self._dirs.values())
+
+    def add_listener(self, callback) -> None:
+        """
+        Registers a callback run with the changed relative dirs after each refresh
+        """
+        self._listeners.append(callback)
+
+
+class SoundWatcher(object):
+    """
+    Keeps a SoundIndex fresh with inotify, falling back to polling directory mtimes
+    """
+    def __init__(self, index: SoundIndex, poll_interval: float = 10.0, debounce: float = 0.5) -> None:
+        # Index to refresh
+        self.index = index
+        # Seconds between polls when inotify is unavailable
+        self.poll_interval = poll_interval
+        # Seconds to gather events before refreshing
+        self.debounce = debounce
+        # Relative dirs waiting for a refresh
+        self._dirty = set()
+        self._flush_handle = None
+        # inotify state
+        self._libc = None
+        self._fd = None
+        self._watches = {}
+        # Polling state
+        self._mtimes = {}
+        self._poll_task = None
+        self.loop = None
+
+    @property
+    def running(self) -> bool:
+        return self._fd is not None or self._poll_task is not None
+
+    def start(self, loop: asyncio.AbstractEventLoop) -> None:
+        """
+        Starts watching the library
+        """
+        if self.running:
+            return
+        self.loop = loop
+        if self._start_inotify():
+            self.index.logger.info("Watching sound directory with inotify")
+        else:
+            self._mtimes = self._stat_all(self.index.directories())
+            self._poll_task = loop.create_task(self._poll())
+            self.index.logger.info(f"Polling sound directory every {self.poll_interval}s")
+
+    def stop(self) -> None:
+        """
+        Stops watching the library
+        """
+        if self._fd is not None:
+            self.loop.remove_reader(self._fd)
+            os.close(self._fd)
+            self._fd = None
+            self._watches.clear()
+        if self._poll_task is not None:
+            self._poll_task.cancel()
+            self._poll_task = None
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+    """ ------------------------------------------ inotify ------------------------------------------------ """
+    def _start_inotify(self) -> bool:
+        """
+        Sets up inotify watches on every indexed directory
+        """
+        libc_name = ctypes.util.find_library("c")
+        if not libc_name:
+            return False
+        try:
+            libc = ctypes.CDLL(libc_name, use_errno=True)
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        except (OSError, AttributeError):
+            return False
+        if fd < 0:
+            return False
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        self._libc, self._fd = libc, fd
+        self._sync_watches()
+        self.loop.add_reader(fd, self._on_readable)
+        return True
+
+    def _sync_watches(self) -> None:
+        """
+        Adds watches for new directories and drops watches of removed ones
+        """
+        known = set(self.index.directories())
+        watched = {rel: wd for wd, rel in self._watches.items()}
+        for rel in known - set(watched):
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(self.index.abspath(rel)), WATCH_MASK)
+            if wd >= 0:
+                self._watches[wd] = rel
+        for rel in set(watched) - known:
+            wd = watched[rel]
+            self._libc.inotify_rm_watch(self._fd, wd)
+            self._watches.pop(wd, None)
+
+    def _on_readable(self) -> None:
+        """
+        Reads pending inotify events and marks their directories dirty
+        """
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size + length
+            rel = self._watches.get(wd)
+            if rel is None:
+                continue
+            if mask & IN_IGNORED:
+                self._watches.pop(wd, None)
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF) and rel:
+                # The parent listing changes when a directory goes away
+                self._mark(os.path.dirname(rel))
+            self._mark(rel)
+
+    """ ------------------------------------------ Polling ------------------------------------------------ """
+    def _stat_all(self, rels: list) -> dict:
+        """
+        Gets the mtime of each relative dir
+        """
+        mtimes = {}
+        for rel in rels:
+            try:
+                mtimes[rel] = os.stat(self.index.abspath(rel)).st_mtime_ns
+            except OSError:
+                mtimes[rel] = None
+        return mtimes
+
+    async def _poll(self) -> None:
+        """
+        Refreshes directories whose mtime changed since the last poll
+        """
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            rels = self.index.directories()
+            mtimes = await self.loop.run_in_executor(None, self._stat_all, rels)
+            for rel, mtime in mtimes.items():
+                if self._mtimes.get(rel) != mtime:
+                    self._mark(rel)
+            self._mtimes = mtimes
+
+    """ ------------------------------------------ Refreshing ------------------------------------------------ """
+    def _mark(self, rel: str) -> None:
+        """
+        Queues a directory for a debounced refresh
+        """
+        self._dirty.add(rel)
+        if self._flush_handle is None:
+            self._flush_handle = self.loop.call_later(self.debounce, self._flush)
+
+    def _flush(self) -> None:
+        """
+        Refreshes every dirty directory off the event loop
+        """
+        self._flush_handle = None
+        dirty, self._dirty = self._dirty, set()
+        self.loop.create_task(self._refresh(dirty))
+
+    async def _refresh(self, dirty: set) -> None:
+        """
+        Applies a refresh and keeps watches in sync with the index
+        """
+        try:
+            # Scan in a worker thread, then apply on the event loop
+            results = await self.loop.run_in_executor(None, self.index.scan, dirty)
+            changed = self.index.update(results)
+        except Exception as e:
+            self.index.logger.error(f"Failed to refresh sound index: {e}")
+            return
+        if changed:
+            self.index.logger.info(f"Sound index refreshed: {len(changed)} directories changed")
+        if self._fd is not None:
+            self._sync_watches()
+        else:
+            self._mtimes.update(self._stat_all(list(changed)))
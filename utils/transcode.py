@@ -0,0 +1,336 @@
+import argparse
+import asyncio
+import logging
+import os
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import discord
+from discord.oggparse import OggStream
+
+from utils import packs
+from utils.fingerprint import FINGERPRINT_FILE, Fingerprints
+
+# FFmpeg executable used for transcoding
+FFMPEG = "ffmpeg"
+# Where transcoded sounds are stored
+CACHE_DIR = "data/audio/cache/opus"
+# Opus header packets that must not be sent as voice frames
+OPUS_HEADERS = (b"OpusHead", b"OpusTags")
+# Seconds between fingerprint change checks of read-only caches
+MANIFEST_CHECK_INTERVAL = 1.0
+
+
+def profile_args(gain_db: float, start: float) -> tuple:
+    """
+    Builds the FFmpeg input and filter arguments that skip leading silence and apply a gain
+    """
+    seek = ["-ss", f"{start:.3f}"] if start else []
+    gain = ["-af", f"volume={gain_db}dB"] if gain_db else []
+    return seek, gain
+
+
+def transcode_args(source: str, target: str, bitrate: int, gain_db: float = 0.0, start: float = 0.0) -> list:
+    """
+    Builds the FFmpeg arguments that encode a sound to 48 kHz stereo Ogg/Opus in 20 ms frames
+    """
+    # Bake the loudness gain and silence trim into the transcode
+    seek, gain = profile_args(gain_db, start)
+    return [
+        FFMPEG, "-nostdin", "-hide_banner", "-loglevel", "error", "-y",
+        *seek, "-i", source, "-vn", *gain,
+        "-c:a", "libopus", "-b:a", f"{bitrate}k", "-ar", "48000", "-ac", "2",
+        "-frame_duration", "20", "-application", "audio",
+        "-f", "ogg", target,
+    ]
+
+
+class OggOpusSource(discord.AudioSource):
+    """
+    Streams Opus packets straight from a cached Ogg file without FFmpeg
+    """
+    def __init__(self, path: str) -> None:
+        self._file = open(path, "rb")
+        self._packets = OggStream(self._file).iter_packets()
+
+    def read(self) -> bytes:
+        for packet in self._packets:
+            # Skip the stream headers
+            if packet[:8] in OPUS_HEADERS:
+                continue
+            return packet
+        return b""
+
+    def is_opus(self) -> bool:
+        return True
+
+    def cleanup(self) -> None:
+        self._file.close()
+
+
+class TranscodeCache(object):
+    """
+    Content-hashed cache of sounds pre-encoded to Ogg/Opus
+    """
+    def __init__(self, cache_dir: str, logger, bitrate: int = 96, workers: int = 2, loudness=None,
+                 fingerprints: Fingerprints = None, readonly: bool = False, admission=None) -> None:
+        # Cache directory
+        self.cache_dir = cache_dir
+        # Read-only caches never transcode and pick up what the writing process adds
+        self.readonly = readonly
+        # Loudness store whose gain is baked into transcodes, optional
+        self.loudness = loudness
+        # Bot logger
+        self.logger = logger
+        # Opus bitrate in kbit/s
+        self.bitrate = bitrate
+        # Concurrent FFmpeg transcodes in the background stage
+        self.workers = workers
+        # FFmpeg process budget shared with playback, optional
+        self.admission = admission
+        # Content hashes that transcodes are keyed by, shared with the sound index
+        if fingerprints is None:
+            fingerprints = Fingerprints(FINGERPRINT_FILE, logger, readonly=readonly)
+        self.fingerprints = fingerprints
+        # Background transcode queue
+        self._queue = None
+        self._queued = set()
+        # Content hashes being transcoded, so duplicates wait for one shared transcode
+        self._transcoding = set()
+        self._tasks = []
+        # Playback lookup counters
+        self.hits = 0
+        self.misses = 0
+        if not readonly:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    """ ------------------------------------------ Fingerprints ------------------------------------------------ """
+    def reload(self) -> None:
+        """
+        Re-reads fingerprints and the loudness store if the writing process changed them (blocking)
+        """
+        if self.fingerprints.reload() and self.loudness is not None:
+            self.loudness.reload()
+
+    def save(self) -> None:
+        """
+        Writes content hashes and loudness measurements to disk
+        """
+        self.fingerprints.save()
+        if self.loudness is not None:
+            self.loudness.save()
+
+    """ ------------------------------------------ Lookups ------------------------------------------------ """
+    def profile(self, digest: str) -> tuple:
+        """
+        Gets the (gain dB, start offset) baked into the transcode of a content hash
+        """
+        return self.loudness.profile(digest) if self.loudness is not None else (0.0, 0.0)
+
+    def target(self, digest: str, gain_db: float = 0.0, start: float = 0.0) -> str:
+        """
+        Gets the cache path of a content hash transcoded with a gain and start offset
+        """
+        parts = [digest]
+        if gain_db:
+            parts.append(f"{gain_db:+.1f}dB")
+        if start:
+            parts.append(f"{round(start * 1000)}ms")
+        return os.path.join(self.cache_dir, ".".join(parts) + ".ogg")
+
+    def cached(self, path: str) -> str:
+        """
+        Gets the transcoded file of a sound, or None if there is none yet, without counting a lookup
+        """
+        digest = self.fingerprints.cached(path)
+        target = self.target(digest, *self.profile(digest)) if digest is not None else None
+        if target is None or not os.path.exists(target):
+            return None
+        return target
+
+    def lookup(self, path: str) -> str:
+        """
+        Gets the transcoded file of a sound, or None on a miss
+        """
+        target = self.cached(path)
+        if target is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return target
+
+    def transcode(self, path: str) -> str:
+        """
+        Transcodes one sound if it isn't cached yet, within the FFmpeg process budget if there is one (blocking)
+        """
+        if self.admission is None:
+            return self._transcode(path)
+        self.admission.acquire_background()
+        try:
+            return self._transcode(path)
+        finally:
+            self.admission.release()
+
+    def _transcode(self, path: str) -> str:
+        """
+        Measures loudness and transcodes one sound, one FFmpeg process at a time (blocking)
+        """
+        digest = self.fingerprints.hash_of(path)
+        if self.loudness is not None and digest not in self.loudness:
+            try:
+                # Measure first so the gain and trim can be baked in
+                self.loudness.measure(digest, path)
+            except (ValueError, subprocess.CalledProcessError) as e:
+                self.logger.error(f"Failed to analyze `{path}`: {e}")
+        gain_db, start = self.profile(digest)
+        target = self.target(digest, gain_db, start)
+        if os.path.exists(target):
+            return target
+        # Write to a temp file so readers never see a partial transcode
+        temp = f"{target}.{os.getpid()}.{threading.get_ident()}.tmp"
+        # Pack members are piped straight from the mapped archive
+        source, data = packs.ffmpeg_input(path)
+        try:
+            args = transcode_args(source, temp, self.bitrate, gain_db, start)
+            subprocess.run(args, input=data, check=True, capture_output=True)
+            os.replace(temp, target)
+        finally:
+            if data is not None:
+                data.release()
+            if os.path.exists(temp):
+                os.remove(temp)
+        return target
+
+    """ ------------------------------------------ Background Stage ------------------------------------------------ """
+    @property
+    def running(self) -> bool:
+        return bool(self._tasks)
+
+    def start(self, loop: asyncio.AbstractEventLoop) -> None:
+        """
+        Starts the background transcode workers, or the change checks of a read-only cache
+        """
+        if self._tasks:
+            return
+        if self.readonly:
+            self._tasks = [loop.create_task(self._watch())]
+            return
+        self._queue = asyncio.Queue()
+        self._tasks = [loop.create_task(self._worker()) for _ in range(self.workers)]
+
+    def stop(self) -> None:
+        """
+        Stops the background transcode workers
+        """
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    def enqueue(self, path: str) -> None:
+        """
+        Queues a sound for background transcoding
+        """
+        if self._queue is None or path in self._queued:
+            return
+        self._queued.add(path)
+        self._queue.put_nowait(path)
+
+    def enqueue_all(self, paths) -> None:
+        """
+        Queues every given sound for background transcoding
+        """
+        for path in paths:
+            self.enqueue(path)
+
+    async def _watch(self) -> None:
+        """
+        Picks up fingerprints and measurements the writing process saves, off the loop so lookups never read files
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(MANIFEST_CHECK_INTERVAL)
+            try:
+                await loop.run_in_executor(None, self.reload)
+            except OSError as e:
+                self.logger.error(f"Failed to reload fingerprints: {e}")
+
+    async def _worker(self) -> None:
+        """
+        Transcodes queued sounds one at a time in a worker thread, once per distinct content
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            path = await self._queue.get()
+            digest = None
+            try:
+                if self.cached(path) is None:
+                    digest = await loop.run_in_executor(None, self.fingerprints.hash_of, path)
+                    if digest in self._transcoding:
+                        # A byte-identical sound is being transcoded, this one shares its file
+                        digest = None
+                    else:
+                        self._transcoding.add(digest)
+                        await loop.run_in_executor(None, self.transcode, path)
+                        self.logger.debug(f"Transcoded: {path}")
+            except FileNotFoundError:
+                pass
+            except (OSError, subprocess.CalledProcessError) as e:
+                self.logger.error(f"Failed to transcode `{path}`: {e}")
+            finally:
+                self._transcoding.discard(digest)
+                self._queued.discard(path)
+                self._queue.task_done()
+            # Persist hashes and measurements once the queue drains
+            if self._queue.empty():
+                await loop.run_in_executor(None, self.save)
+
+
+def sound_paths(root: str):
+    """
+    Yields every sound file below root
+    """
+    for directory, _, files in os.walk(root):
+        for file in files:
+            if file.endswith(".mp3"):
+                yield os.path.join(directory, file)
+
+
+def main() -> None:
+    """
+    Pre-warms the transcode cache for the whole library
+    """
+    parser = argparse.ArgumentParser(description="Pre-transcode the sound library to Ogg/Opus.")
+    parser.add_argument("--sounds", default="data/audio/sounds", help="sound library directory")
+    parser.add_argument("--packs", default=packs.PACKS_DIR, help="sound pack directory")
+    parser.add_argument("--cache", default=CACHE_DIR, help="transcode cache directory")
+    parser.add_argument("--bitrate", type=int, default=96, help="Opus bitrate in kbit/s")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="parallel FFmpeg processes")
+    parser.add_argument("--no-normalize", action="store_true", help="don't bake loudness gain into transcodes")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)-8s %(message)s")
+    logger = logging.getLogger("AudioBot")
+    # Imported here, the loudness module builds on this one
+    from utils.loudness import LOUDNESS_FILE, LoudnessStore
+    loudness = None if args.no_normalize else LoudnessStore(LOUDNESS_FILE, logger)
+    cache = TranscodeCache(args.cache, logger, bitrate=args.bitrate, loudness=loudness)
+    digests = cache.fingerprints.hash_all([*sound_paths(args.sounds), *packs.pack_sound_paths(args.packs)])
+    # One transcode per distinct content, byte-identical sounds share it
+    paths = list({digest: path for path, digest in digests.items()}.values())
+    logger.info(f"Transcoding {len(paths)} distinct sounds of {len(digests)} with {args.jobs} jobs...")
+
+    def run(path):
+        try:
+            cache.transcode(path)
+        except (OSError, subprocess.CalledProcessError) as e:
+            logger.error(f"Failed to transcode `{path}`: {e}")
+
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        list(pool.map(run, paths))
+    cache.save()
+    logger.info("Transcode cache warm")
+
+
+if __name__ == "__main__":
+    main()
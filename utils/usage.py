@@ -0,0 +1,166 @@
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Play history shared by every cluster
+USAGE_DB = "data/audio/cache/usage.db"
+# Seconds between batched writes
+FLUSH_INTERVAL = 5.0
+# Plays held in memory before the oldest are dropped, should the disk stall
+BUFFER_LIMIT = 10000
+# Days of history kept
+RETENTION_DAYS = 90
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS plays (
+    played_at REAL NOT NULL,
+    guild_id INTEGER NOT NULL,
+    sound TEXT NOT NULL,
+    latency REAL,
+    cache_hit INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS plays_sound ON plays (sound);
+CREATE INDEX IF NOT EXISTS plays_guild ON plays (guild_id, sound);
+"""
+
+
+class UsageStore(object):
+    """
+    Records plays into SQLite (WAL); plays are buffered in memory and written in batches on one worker thread
+    """
+    def __init__(self, path: str, logger, flush_interval: float = FLUSH_INTERVAL) -> None:
+        # Database file
+        self.path = path
+        # Bot logger
+        self.logger = logger
+        # Seconds between batched writes
+        self.flush_interval = flush_interval
+        # (played_at, guild id, sound path, latency, cache hit) rows waiting to be written
+        self._buffer = []
+        self._lock = threading.Lock()
+        # The connection lives on this thread only
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="usage-store")
+        self._db = None
+        self._task = None
+        # Plays written and plays dropped because the buffer was full
+        self.written = 0
+        self.dropped = 0
+
+    """ ------------------------------------------ Writing ------------------------------------------------ """
+    def record(self, guild_id: int, sound: str, latency: float = None, cache_hit: bool = False) -> None:
+        """
+        Buffers one play, never touching the disk
+        """
+        with self._lock:
+            if len(self._buffer) >= BUFFER_LIMIT:
+                self._buffer.pop(0)
+                self.dropped += 1
+            self._buffer.append((time.time(), guild_id, sound, latency, int(cache_hit)))
+
+    @property
+    def pending(self) -> int:
+        return len(self._buffer)
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            # Other clusters write the same file, wait for their transactions instead of failing
+            db = sqlite3.connect(self.path, timeout=10.0)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.executescript(SCHEMA)
+            with db:
+                db.execute("DELETE FROM plays WHERE played_at < ?", (time.time() - RETENTION_DAYS * 86400,))
+            self._db = db
+        return self._db
+
+    def _flush(self) -> int:
+        """
+        Writes buffered plays in one transaction (blocking, worker thread)
+        """
+        with self._lock:
+            rows, self._buffer = self._buffer, []
+        if not rows:
+            return 0
+        try:
+            db = self._connect()
+            with db:
+                db.executemany("INSERT INTO plays VALUES (?, ?, ?, ?, ?)", rows)
+        except (sqlite3.Error, OSError) as e:
+            self.logger.error(f"Failed to write {len(rows)} plays: {e}")
+            # Put back as many as fit for the next flush
+            with self._lock:
+                keep = max(0, min(len(rows), BUFFER_LIMIT - len(self._buffer)))
+                self.dropped += len(rows) - keep
+                self._buffer[:0] = rows[len(rows) - keep:]
+            return 0
+        self.written += len(rows)
+        return len(rows)
+
+    async def flush(self) -> int:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._flush)
+
+    def start(self, loop: asyncio.AbstractEventLoop) -> None:
+        """
+        Starts the periodic batched writes
+        """
+        if self._task is None:
+            self._task = loop.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def close(self) -> None:
+        """
+        Writes what is left and closes the database
+        """
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._close)
+        self._executor.shutdown(wait=False)
+
+    def _close(self) -> None:
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    """ ------------------------------------------ Queries ------------------------------------------------ """
+    async def _query(self, sql: str, args: tuple = ()) -> list:
+        def run():
+            try:
+                return self._connect().execute(sql, args).fetchall()
+            except (sqlite3.Error, OSError) as e:
+                self.logger.error(f"Failed to read plays: {e}")
+                return []
+        # Count what is still buffered too
+        await self.flush()
+        return await asyncio.get_running_loop().run_in_executor(self._executor, run)
+
+    async def top(self, limit: int, guild_id: int = None) -> list:
+        """
+        Gets [(sound path, plays)] of the most played sounds, overall or in one guild
+        """
+        if guild_id is None:
+            sql, args = "SELECT sound, COUNT(*) AS n FROM plays GROUP BY sound ORDER BY n DESC LIMIT ?", (limit,)
+        else:
+            sql = "SELECT sound, COUNT(*) AS n FROM plays WHERE guild_id = ? GROUP BY sound ORDER BY n DESC LIMIT ?"
+            args = (guild_id, limit)
+        return await self._query(sql, args)
+
+    async def summary(self, guild_id: int = None) -> dict:
+        """
+        Gets play count, distinct sounds, mean time to first packet and cache hit ratio, overall or in one guild
+        """
+        where, args = ("WHERE guild_id = ?", (guild_id,)) if guild_id is not None else ("", ())
+        rows = await self._query(
+            f"SELECT COUNT(*), COUNT(DISTINCT sound), AVG(latency), AVG(cache_hit) FROM plays {where}", args
+        )
+        plays, sounds, latency, hit_ratio = rows[0] if rows else (0, 0, None, None)
+        return {"plays": plays, "sounds": sounds, "latency": latency, "hit_ratio": hit_ratio or 0.0}
@@ -0,0 +1,217 @@
+import asyncio
+import random
+import time
+
+import discord
+
+from utils.metrics import Histogram
+
+
+class VoicePool(object):
+    """
+    Keeps one warm voice connection per guild, reused and moved instead of reconnected
+    """
+    def __init__(self, logger, idle_timeout: float = 300.0, autojoin=(), retries: int = 4,
+                 backoff: float = 1.0, max_backoff: float = 30.0, timeout: float = 15.0) -> None:
+        # Bot logger
+        self.logger = logger
+        # Seconds without playback before a connection is closed
+        self.idle_timeout = idle_timeout
+        # Channel ids the bot pre-connects to when a user joins them
+        self.autojoin = set(autojoin)
+        # Connect attempts, first retry delay, delay cap and per-attempt timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        # Guild id -> connect task in progress
+        self._connecting = {}
+        # Guild id -> channel id the bot should stay in, cleared on purposeful disconnects
+        self._wanted = {}
+        # Guild id -> idle disconnect timer
+        self._idle = {}
+        # Latencies of new connections and of moves between channels
+        self.connect_latency = Histogram()
+        self.move_latency = Histogram()
+        # Counters
+        self.reused = 0
+        self.moved = 0
+        self.connected = 0
+        self.reconnects = 0
+        self.idle_disconnects = 0
+        self.failures = 0
+
+    """ ------------------------------------------ Connections ------------------------------------------------ """
+    async def connect(self, channel) -> discord.VoiceClient:
+        """
+        Gets a voice client in channel, reusing or moving the guild's connection when there is one
+        """
+        guild = channel.guild
+        # One connect at a time per guild
+        pending = self._connecting.get(guild.id)
+        while pending is not None and not pending.done():
+            await asyncio.wait([pending])
+            pending = self._connecting.get(guild.id)
+        task = self._connecting[guild.id] = asyncio.get_running_loop().create_task(self._connect(channel))
+        try:
+            return await task
+        finally:
+            if self._connecting.get(guild.id) is task:
+                del self._connecting[guild.id]
+
+    async def _connect(self, channel) -> discord.VoiceClient:
+        """
+        Reuses, moves or opens the guild's connection
+        """
+        guild = channel.guild
+        self._wanted[guild.id] = channel.id
+        voice_client = guild.voice_client
+        if voice_client is not None and voice_client.is_connected():
+            if voice_client.channel.id != channel.id:
+                started = time.perf_counter()
+                await voice_client.move_to(channel, timeout=self.timeout)
+                self.move_latency.observe(time.perf_counter() - started)
+                self.moved += 1
+                self.logger.info(f"Moved voice connection to {channel.name} in {(time.perf_counter() - started) * 1000:.0f} ms")
+            else:
+                self.reused += 1
+            self.touch(guild)
+            return voice_client
+        if voice_client is not None:
+            # Half-open connection left behind by a drop
+            await voice_client.disconnect(force=True)
+        delay = self.backoff
+        for attempt in range(1, self.retries + 1):
+            started = time.perf_counter()
+            try:
+                voice_client = await channel.connect(timeout=self.timeout, reconnect=True)
+            except (asyncio.TimeoutError, discord.ClientException, OSError) as e:
+                self.failures += 1
+                if attempt == self.retries:
+                    self._wanted.pop(guild.id, None)
+                    raise
+                # Exponential backoff with jitter so guilds don't retry in lockstep
+                wait = min(delay, self.max_backoff) * random.uniform(0.5, 1.0)
+                self.logger.warning(f"Voice connect to {channel.name} failed ({e or type(e).__name__}), retrying in {wait:.1f}s")
+                await asyncio.sleep(wait)
+                delay *= 2
+                continue
+            latency = time.perf_counter() - started
+            self.connect_latency.observe(latency)
+            self.connected += 1
+            summary = self.connect_latency.summary()
+            self.logger.info(
+                f"Connected to {channel.name} in {latency * 1000:.0f} ms "
+                f"(p50 <= {summary['p50'] * 1000:.0f} ms, p99 <= {summary['p99'] * 1000:.0f} ms)"
+            )
+            self.touch(guild)
+            return voice_client
+
+    async def disconnect(self, guild) -> None:
+        """
+        Closes the guild's connection on purpose, so it is not reconnected
+        """
+        self._wanted.pop(guild.id, None)
+        timer = self._idle.pop(guild.id, None)
+        if timer is not None:
+            timer.cancel()
+        if guild.voice_client is not None:
+            await guild.voice_client.disconnect()
+
+    def close(self) -> None:
+        """
+        Stops the idle timers on shutdown, the client closes the connections itself
+        """
+        for timer in self._idle.values():
+            timer.cancel()
+        self._idle.clear()
+        self._wanted.clear()
+
+    """ ------------------------------------------ Idle Policy ------------------------------------------------ """
+    def touch(self, guild) -> None:
+        """
+        Restarts the guild's idle timer, called whenever the connection is used
+        """
+        timer = self._idle.pop(guild.id, None)
+        if timer is not None:
+            timer.cancel()
+        if self.idle_timeout:
+            loop = asyncio.get_running_loop()
+            self._idle[guild.id] = loop.call_later(self.idle_timeout, self._idle_check, guild)
+
+    def _idle_check(self, guild) -> None:
+        """
+        Disconnects a guild whose connection sat unused for the idle timeout
+        """
+        self._idle.pop(guild.id, None)
+        voice_client = guild.voice_client
+        if voice_client is None:
+            return
+        if voice_client.is_playing():
+            # Long sound, check again later
+            self.touch(guild)
+            return
+        self.idle_disconnects += 1
+        self.logger.info(f"Leaving voice in {guild.name} after {self.idle_timeout:.0f}s idle")
+        asyncio.get_running_loop().create_task(self.disconnect(guild))
+
+    """ ------------------------------------------ Events ------------------------------------------------ """
+    def on_voice_state_update(self, me, member, before, after) -> None:
+        """
+        Pre-connects to autojoin channels and reconnects after drops
+        """
+        guild = member.guild
+        if member.id == me.id:
+            if after.channel is not None:
+                # Moved by someone else, stay where we were put
+                if guild.id in self._wanted:
+                    self._wanted[guild.id] = after.channel.id
+            elif guild.id in self._wanted and guild.id not in self._connecting:
+                asyncio.get_running_loop().create_task(self._reconnect(guild))
+            return
+        if member.bot or after.channel is None or after.channel.id not in self.autojoin:
+            return
+        if before.channel == after.channel or guild.voice_client is not None:
+            return
+        # Connect before the first play command so it skips the handshake
+        asyncio.get_running_loop().create_task(self._preconnect(after.channel))
+
+    async def _reconnect(self, guild) -> None:
+        """
+        Reconnects a guild whose connection dropped
+        """
+        channel = guild.get_channel(self._wanted.get(guild.id, 0))
+        if channel is None:
+            self._wanted.pop(guild.id, None)
+            return
+        self.reconnects += 1
+        self.logger.warning(f"Voice connection in {guild.name} dropped, reconnecting...")
+        try:
+            await self.connect(channel)
+        except Exception as e:
+            self.logger.error(f"Failed to reconnect to {channel.name}: {e}")
+
+    async def _preconnect(self, channel) -> None:
+        """
+        Connects to an autojoin channel ahead of any command
+        """
+        try:
+            await self.connect(channel)
+        except Exception as e:
+            self.logger.error(f"Failed to pre-connect to {channel.name}: {e}")
+
+    def stats(self) -> dict:
+        """
+        Gets pool counters and latency summaries
+        """
+        return {
+            "connections": len(self._wanted),
+            "reused": self.reused,
+            "moved": self.moved,
+            "connected": self.connected,
+            "reconnects": self.reconnects,
+            "idle_disconnects": self.idle_disconnects,
+            "failures": self.failures,
+            "connect_latency": self.connect_latency.summary(),
+            "move_latency": self.move_latency.summary(),
+        }